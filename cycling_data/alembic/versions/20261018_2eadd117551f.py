@@ -0,0 +1,118 @@
+"""Add content hash to StationWeatherData and remove duplicate reports
+
+Revision ID: 2eadd117551f
+Revises: b3f1c2d4e5a6
+Create Date: 2026-10-18 14:37:05.102398
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2eadd117551f'
+down_revision = 'b3f1c2d4e5a6'
+branch_labels = None
+depends_on = None
+
+# Rows read per query
+batch_size=1000
+
+def metar_hash(station_name,report_time,metar):
+
+    import hashlib
+
+    if report_time is not None and report_time.tzinfo is not None:
+        from pytz import utc
+        report_time=report_time.astimezone(utc).replace(tzinfo=None)
+
+    key='{}|{}|{}'.format(
+        station_name,
+        report_time.isoformat() if report_time is not None else '',
+        metar)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def upgrade():
+
+    with op.batch_alter_table('stationweatherdata', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('metar_hash', sa.String(length=40), nullable=True))
+
+    stationweatherdata=sa.table(
+        'stationweatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('metar',sa.Text()),
+        sa.column('report_time',sa.DateTime()),
+        sa.column('metar_hash',sa.String(40))
+    )
+
+    weatherdata=sa.table(
+        'weatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('wx_station',sa.Integer())
+    )
+
+    location=sa.table(
+        'location',
+        sa.column('id',sa.Integer()),
+        sa.column('name',sa.String(255))
+    )
+
+    conn=op.get_bind()
+
+    query=sa.select([
+        stationweatherdata.c.id,
+        location.c.name,
+        stationweatherdata.c.report_time,
+        stationweatherdata.c.metar
+    ]).select_from(
+        stationweatherdata.join(
+            weatherdata,weatherdata.c.id==stationweatherdata.c.id
+        ).outerjoin(
+            location,location.c.id==weatherdata.c.wx_station)
+    ).order_by(stationweatherdata.c.id).limit(batch_size)
+
+    update=stationweatherdata.update().where(
+        stationweatherdata.c.id==sa.bindparam('wx_id')
+    ).values(metar_hash=sa.bindparam('wx_hash'))
+
+    # Keep the first copy of each report
+    seen=set()
+    last_id=0
+
+    while True:
+
+        rows=conn.execute(query.where(stationweatherdata.c.id>last_id)).fetchall()
+
+        if len(rows)==0:
+            break
+
+        last_id=rows[-1].id
+
+        hashes=[]
+        duplicates=[]
+
+        for row in rows:
+            wx_hash=metar_hash(row.name,row.report_time,row.metar)
+            if wx_hash in seen:
+                duplicates.append(row.id)
+            else:
+                seen.add(wx_hash)
+                hashes.append({'wx_id':row.id,'wx_hash':wx_hash})
+
+        if len(hashes)>0:
+            conn.execute(update,hashes)
+
+        if len(duplicates)>0:
+            conn.execute(stationweatherdata.delete().where(
+                stationweatherdata.c.id.in_(duplicates)))
+            conn.execute(weatherdata.delete().where(
+                weatherdata.c.id.in_(duplicates)))
+
+    with op.batch_alter_table('stationweatherdata', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stationweatherdata_metar_hash'), ['metar_hash'], unique=True)
+
+def downgrade():
+    with op.batch_alter_table('stationweatherdata', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_stationweatherdata_metar_hash'))
+        batch_op.drop_column('metar_hash')
@@ -0,0 +1,169 @@
+"""Add weather_coverage table and seed it from fetch logs and stored reports
+
+Revision ID: 40a3de78669c
+Revises: 2eadd117551f
+Create Date: 2026-10-18 16:02:19.734511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '40a3de78669c'
+down_revision = '2eadd117551f'
+branch_labels = None
+depends_on = None
+
+# Part of a fetch ending this long before the fetch is final
+final_delay_seconds=3600
+
+# Consecutive stored reports further apart than this are not taken as
+# covering the time between them
+max_report_gap_seconds=3*3600
+
+# Stored reports more recent than this are left to be fetched again
+min_report_age_seconds=2*86400
+
+def union(intervals):
+
+    merged=[]
+
+    for dtstart,dtend,fetch_time in sorted(intervals):
+        if len(merged)>0 and dtstart<=merged[-1][1]:
+            last=merged[-1]
+            merged[-1]=(last[0],max(last[1],dtend),max(last[2],fetch_time))
+        else:
+            merged.append((dtstart,dtend,fetch_time))
+
+    return merged
+
+def upgrade():
+
+    from datetime import datetime, timedelta
+
+    op.create_table('weather_coverage',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('station_id', sa.Integer(), nullable=True),
+    sa.Column('dtstart', sa.DateTime(), nullable=True),
+    sa.Column('dtend', sa.DateTime(), nullable=True),
+    sa.Column('fetch_time', sa.DateTime(), nullable=True),
+    sa.Column('final', sa.Boolean(), nullable=True),
+    sa.ForeignKeyConstraint(['station_id'], ['location.id'], name='fk_weather_coverage_location_id'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_weather_coverage'))
+    )
+    with op.batch_alter_table('weather_coverage', schema=None) as batch_op:
+        batch_op.create_index('ix_weather_coverage_station_id_dtstart', ['station_id', 'dtstart'], unique=False)
+
+    weather_fetch_log=sa.table(
+        'weather_fetch_log',
+        sa.column('time',sa.DateTime()),
+        sa.column('station_id',sa.Integer()),
+        sa.column('dtstart',sa.DateTime()),
+        sa.column('dtend',sa.DateTime())
+    )
+
+    weatherdata=sa.table(
+        'weatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('wx_station',sa.Integer())
+    )
+
+    stationweatherdata=sa.table(
+        'stationweatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('report_time',sa.DateTime())
+    )
+
+    weather_coverage=sa.table(
+        'weather_coverage',
+        sa.column('station_id',sa.Integer()),
+        sa.column('dtstart',sa.DateTime()),
+        sa.column('dtend',sa.DateTime()),
+        sa.column('fetch_time',sa.DateTime()),
+        sa.column('final',sa.Boolean())
+    )
+
+    conn=op.get_bind()
+
+    now=datetime.utcnow()
+    intervals={}
+
+    # Seed only final coverage; anything that could still change will be
+    # fetched again
+
+    for row in conn.execute(sa.select([
+            weather_fetch_log.c.station_id,
+            weather_fetch_log.c.dtstart,
+            weather_fetch_log.c.dtend,
+            weather_fetch_log.c.time])):
+
+        if None in row: continue
+
+        # Day logs end one second before midnight
+        dtend=row.dtend
+        if dtend.second==59:
+            dtend=dtend+timedelta(seconds=1)
+
+        dtend=min(dtend,row.time-timedelta(seconds=final_delay_seconds))
+
+        if dtend>row.dtstart:
+            intervals.setdefault(row.station_id,[]).append(
+                (row.dtstart,dtend,row.time))
+
+    max_report_gap=timedelta(seconds=max_report_gap_seconds)
+    newest=now-timedelta(seconds=min_report_age_seconds)
+
+    # Reports are read one station at a time, so the migration never holds
+    # more than one station's report times
+
+    stations=[row.wx_station for row in conn.execute(
+        sa.select([weatherdata.c.wx_station]).where(
+            weatherdata.c.wx_station!=None
+        ).distinct().order_by(weatherdata.c.wx_station))]
+
+    for station in stations:
+
+        report_times=[row.report_time for row in conn.execute(sa.select([
+                stationweatherdata.c.report_time
+        ]).select_from(
+            stationweatherdata.join(
+                weatherdata,weatherdata.c.id==stationweatherdata.c.id)
+        ).where(
+            sa.and_(weatherdata.c.wx_station==station,
+                    stationweatherdata.c.report_time!=None,
+                    stationweatherdata.c.report_time<newest)
+        ).order_by(stationweatherdata.c.report_time)).fetchall()]
+
+        run_start=None
+
+        for i,report_time in enumerate(report_times):
+
+            if run_start is None:
+                run_start=report_time
+
+            if i==len(report_times)-1 \
+               or report_times[i+1]-report_time>max_report_gap:
+                if report_time>run_start:
+                    intervals.setdefault(station,[]).append(
+                        (run_start,report_time,now))
+                run_start=None
+
+    coverage=[]
+
+    for station_id,station_intervals in intervals.items():
+        for dtstart,dtend,fetch_time in union(station_intervals):
+            coverage.append({'station_id':station_id,
+                             'dtstart':dtstart,
+                             'dtend':dtend,
+                             'fetch_time':fetch_time,
+                             'final':True})
+
+    if len(coverage)>0:
+        op.bulk_insert(weather_coverage,coverage)
+
+def downgrade():
+    with op.batch_alter_table('weather_coverage', schema=None) as batch_op:
+        batch_op.drop_index('ix_weather_coverage_station_id_dtstart')
+
+    op.drop_table('weather_coverage')
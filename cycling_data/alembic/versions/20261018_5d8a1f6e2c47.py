@@ -0,0 +1,56 @@
+"""Add station_quality and station_report_day tables
+
+Revision ID: 5d8a1f6e2c47
+Revises: 7c0e93b4d1a2
+Create Date: 2026-10-18 19:26:03.841177
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8a1f6e2c47'
+down_revision = '7c0e93b4d1a2'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('station_quality',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('station_id', sa.Integer(), nullable=True),
+    sa.Column('report_interval', sa.Float(), nullable=True),
+    sa.Column('last_report', sa.DateTime(), nullable=True),
+    sa.Column('recent_fetches', sa.Float(), nullable=True),
+    sa.Column('recent_empty_fetches', sa.Float(), nullable=True),
+    sa.Column('last_fetch', sa.DateTime(), nullable=True),
+    sa.Column('last_fetch_reports', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['station_id'], ['location.id'], name='fk_station_quality_location_id'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_station_quality'))
+    )
+    with op.batch_alter_table('station_quality', schema=None) as batch_op:
+        batch_op.create_index('ix_station_quality_station_id', ['station_id'], unique=True)
+
+    op.create_table('station_report_day',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('station_id', sa.Integer(), nullable=True),
+    sa.Column('day', sa.Date(), nullable=True),
+    sa.Column('reports', sa.Integer(), nullable=True),
+    sa.Column('checked', sa.DateTime(), nullable=True),
+    sa.Column('final', sa.Boolean(), nullable=True),
+    sa.ForeignKeyConstraint(['station_id'], ['location.id'], name='fk_station_report_day_location_id'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_station_report_day'))
+    )
+    with op.batch_alter_table('station_report_day', schema=None) as batch_op:
+        batch_op.create_index('ix_station_report_day_station_id_day', ['station_id', 'day'], unique=True)
+
+def downgrade():
+    with op.batch_alter_table('station_report_day', schema=None) as batch_op:
+        batch_op.drop_index('ix_station_report_day_station_id_day')
+
+    op.drop_table('station_report_day')
+
+    with op.batch_alter_table('station_quality', schema=None) as batch_op:
+        batch_op.drop_index('ix_station_quality_station_id')
+
+    op.drop_table('station_quality')
@@ -0,0 +1,125 @@
+"""Add decoded rain and snow to StationWeatherData and fill in weather codes
+
+Revision ID: 7c0e93b4d1a2
+Revises: 40a3de78669c
+Create Date: 2026-10-18 18:11:42.519304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c0e93b4d1a2'
+down_revision = '40a3de78669c'
+branch_labels = None
+depends_on = None
+
+# Rows read and updated per statement
+batch_size=1000
+
+def weather_to_numeric(weathers):
+    totalrain=0
+    totalsnow=0
+    for weather in weathers:
+        rain=0
+        if weather[2]=='BR':rain+=0.1
+        elif weather[2]=='DZ':rain+=0.3
+        elif weather[2]=='RA':rain+=0.3
+
+        if rain>0:
+            if weather[0]=='+': rain+=0.1
+            if weather[0]=='-': rain-=0.1
+
+        snow=0
+        if weather[2]=='SN':snow+=0.5
+        elif weather[2]=='SG':snow+=0.5
+        elif weather[2]=='IC':snow+=0.5
+        elif weather[2]=='PL':snow+=0.5
+
+        if snow>0:
+            if weather[0]=='+': snow+=0.2
+            if weather[0]=='-': snow-=0.2
+        totalrain+=rain
+        totalsnow+=snow
+    return totalrain,totalsnow
+
+def weather_codes(weathers):
+    return ' '.join(''.join(part for part in weather if part is not None)
+                    for weather in weathers)[:255]
+
+def upgrade():
+
+    from metar import Metar
+
+    with op.batch_alter_table('stationweatherdata', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rain', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('snow', sa.Float(), nullable=True))
+
+    stationweatherdata=sa.table(
+        'stationweatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('metar',sa.Text()),
+        sa.column('report_time',sa.DateTime()),
+        sa.column('weather',sa.String(255)),
+        sa.column('rain',sa.Float()),
+        sa.column('snow',sa.Float())
+    )
+
+    conn=op.get_bind()
+
+    query=sa.select([
+        stationweatherdata.c.id,
+        stationweatherdata.c.report_time,
+        stationweatherdata.c.metar
+    ]).where(
+        stationweatherdata.c.metar!=None
+    ).order_by(stationweatherdata.c.id).limit(batch_size)
+
+    update=stationweatherdata.update().where(
+        stationweatherdata.c.id==sa.bindparam('row_id')
+    ).values(
+        weather=sa.bindparam('row_weather'),
+        rain=sa.bindparam('row_rain'),
+        snow=sa.bindparam('row_snow')
+    )
+
+    last_id=0
+
+    while True:
+
+        rows=conn.execute(query.where(stationweatherdata.c.id>last_id)).fetchall()
+
+        if len(rows)==0:
+            break
+
+        last_id=rows[-1].id
+
+        values=[]
+
+        for row in rows:
+
+            # Only the present weather groups are needed, which don't
+            # depend on the report date
+            kwargs={}
+            if row.report_time is not None:
+                kwargs={'year':row.report_time.year,'month':row.report_time.month}
+
+            try:
+                weathers=Metar.Metar(row.metar,strict=False,**kwargs).weather
+            except Metar.ParserError:
+                continue
+
+            rain,snow=weather_to_numeric(weathers)
+            values.append({'row_id':row.id,
+                           'row_weather':weather_codes(weathers),
+                           'row_rain':rain,
+                           'row_snow':snow})
+
+        if len(values)>0:
+            conn.execute(update,values)
+
+def downgrade():
+    with op.batch_alter_table('stationweatherdata', schema=None) as batch_op:
+        batch_op.drop_column('snow')
+        batch_op.drop_column('rain')
@@ -0,0 +1,24 @@
+"""Add training_lock column to predictionmodel
+
+Revision ID: a8e5f2c71d34
+Revises: f1c6d83a2b90
+Create Date: 2026-10-18 23:41:07.562310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8e5f2c71d34'
+down_revision = 'f1c6d83a2b90'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    with op.batch_alter_table('predictionmodel', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('training_lock', sa.String(length=32), nullable=True))
+
+def downgrade():
+    with op.batch_alter_table('predictionmodel', schema=None) as batch_op:
+        batch_op.drop_column('training_lock')
@@ -0,0 +1,28 @@
+"""Add rate limiter reservations to SentRequestLog
+
+Revision ID: b3f1c2d4e5a6
+Revises: e52cd9d1994b
+Create Date: 2026-10-18 09:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2d4e5a6'
+down_revision = 'e52cd9d1994b'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    with op.batch_alter_table('sent_request_log', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('reservation', sa.String(length=255), nullable=True))
+        batch_op.create_index(batch_op.f('ix_sent_request_log_reservation'), ['reservation'], unique=False)
+        batch_op.create_index(batch_op.f('ix_sent_request_log_time'), ['time'], unique=False)
+
+def downgrade():
+    with op.batch_alter_table('sent_request_log', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_sent_request_log_time'))
+        batch_op.drop_index(batch_op.f('ix_sent_request_log_reservation'))
+        batch_op.drop_column('reservation')
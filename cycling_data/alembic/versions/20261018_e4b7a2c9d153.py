@@ -0,0 +1,83 @@
+"""Add weather_backlog table and queue rides without weather
+
+Revision ID: e4b7a2c9d153
+Revises: 5d8a1f6e2c47
+Create Date: 2026-10-18 21:02:17.406318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7a2c9d153'
+down_revision = '5d8a1f6e2c47'
+branch_labels = None
+depends_on = None
+
+# Rows inserted per statement
+batch_size=1000
+
+def upgrade():
+    from datetime import datetime
+
+    op.create_table('weather_backlog',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('ride_id', sa.Integer(), nullable=True),
+    sa.Column('state', sa.String(length=16), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('next_attempt', sa.DateTime(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['ride_id'], ['ride.id'], name='fk_weather_backlog_ride_id'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_weather_backlog'))
+    )
+    with op.batch_alter_table('weather_backlog', schema=None) as batch_op:
+        batch_op.create_index('ix_weather_backlog_ride_id', ['ride_id'], unique=True)
+        batch_op.create_index('ix_weather_backlog_state_next_attempt', ['state', 'next_attempt'], unique=False)
+
+    ride=sa.table(
+        'ride',
+        sa.column('id',sa.Integer()),
+        sa.column('wxdata_id',sa.Integer())
+    )
+
+    weatherdata=sa.table(
+        'weatherdata',
+        sa.column('id',sa.Integer()),
+        sa.column('wx_station',sa.Integer())
+    )
+
+    weather_backlog=sa.table(
+        'weather_backlog',
+        sa.column('ride_id',sa.Integer()),
+        sa.column('state',sa.String(16)),
+        sa.column('attempts',sa.Integer()),
+        sa.column('next_attempt',sa.DateTime()),
+        sa.column('updated',sa.DateTime())
+    )
+
+    conn=op.get_bind()
+
+    ride_ids=[row.id for row in conn.execute(
+        sa.select([ride.c.id]).select_from(
+            ride.outerjoin(weatherdata,ride.c.wxdata_id==weatherdata.c.id)
+        ).where(
+            sa.or_(ride.c.wxdata_id==None,weatherdata.c.wx_station==None)
+        ).order_by(ride.c.id)
+    )]
+
+    now=datetime.utcnow()
+
+    for i in range(0,len(ride_ids),batch_size):
+        conn.execute(weather_backlog.insert(),[
+            {'ride_id':ride_id,'state':'pending','attempts':0,
+             'next_attempt':now,'updated':now}
+            for ride_id in ride_ids[i:i+batch_size]])
+
+def downgrade():
+    with op.batch_alter_table('weather_backlog', schema=None) as batch_op:
+        batch_op.drop_index('ix_weather_backlog_state_next_attempt')
+        batch_op.drop_index('ix_weather_backlog_ride_id')
+
+    op.drop_table('weather_backlog')
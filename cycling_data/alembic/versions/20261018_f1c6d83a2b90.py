@@ -0,0 +1,39 @@
+"""Add rate_limiter_lock table
+
+Revision ID: f1c6d83a2b90
+Revises: e4b7a2c9d153
+Create Date: 2026-10-18 23:14:52.118904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6d83a2b90'
+down_revision = 'e4b7a2c9d153'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('rate_limiter_lock',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=True),
+    sa.Column('locked_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_rate_limiter_lock'))
+    )
+    with op.batch_alter_table('rate_limiter_lock', schema=None) as batch_op:
+        batch_op.create_index('ix_rate_limiter_lock_name', ['name'], unique=True)
+
+    rate_limiter_lock=sa.table(
+        'rate_limiter_lock',
+        sa.column('name',sa.String(64))
+    )
+
+    op.bulk_insert(rate_limiter_lock,[{'name':'ogimet'}])
+
+def downgrade():
+    with op.batch_alter_table('rate_limiter_lock', schema=None) as batch_op:
+        batch_op.drop_index('ix_rate_limiter_lock_name')
+
+    op.drop_table('rate_limiter_lock')
@@ -1,14 +1,31 @@
 from celery import Celery
-from celery.signals import worker_process_init, worker_process_shutdown
+from celery.signals import worker_process_init, worker_process_shutdown, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
+from sqlalchemy.orm import scoped_session, sessionmaker
+import zope.sqlalchemy
 from . import models
+from .models.worker_pool import pool_metrics
 import configparser
+import threading
 
 logger = get_task_logger(__name__)
 
 engine=None
 settings=None
 
+# Connection pool counters of this worker process
+db_pool_metrics=pool_metrics()
+
+# Session shared by everything a task does, joined to the transaction
+# manager and removed when the task finishes. Tasks keep using objects
+# loaded before they commit, so commits don't expire them.
+worker_session=scoped_session(sessionmaker(expire_on_commit=False))
+zope.sqlalchemy.register(worker_session)
+
+# Depth of tasks running in this thread, counting tasks run eagerly from
+# inside another task
+task_depth=threading.local()
+
 config=configparser.ConfigParser()
 config.read('/run/secrets/production.ini')
 
@@ -31,9 +48,7 @@ def bootstrap_pyramid(signal, sender, **kwargs):
 
     global engine
     
-    import os
     from pyramid.paster import bootstrap
-    from sqlalchemy.pool import StaticPool
 
     try:
         global settings, env
@@ -44,44 +59,137 @@ def bootstrap_pyramid(signal, sender, **kwargs):
         warnings.warn('Settings file does not exist. Not configuring database session factory.')
         return
 
-    settings['sqlalchemy.poolclass']=StaticPool
+    from .models.worker_pool import get_worker_engine
 
-    engine=models.get_engine(settings,prefix='worker_sqlalchemy.')
-    
-    while True:
+    engine=get_worker_engine(settings,metrics=db_pool_metrics)
+    worker_session.configure(bind=engine)
 
-        # Here we try to connect to database server until connection succeeds.
-        # This is needed because the database server may take longer
-        # to start than the application
-        
-        import sqlalchemy.exc
+    # Pooled connections are checked before use, so a database that is
+    # down now or restarts later only fails the tasks run meanwhile
+    check_database()
 
-        try:
-            print("Checking database connection")
-            conn=engine.connect()
+    # Keep the settings and shared resources for the life of the process,
+    # rather than loading them again for each download
+    from .processing.worker_context import init_worker_context
+    init_worker_context(settings)
+
+    warm_station_registry()
+
+def warm_station_registry():
+
+    import transaction
+    import sqlalchemy.exc
+    from .processing.stations import get_station_registry
+
+    try:
+        with transaction.manager:
+            get_station_registry().warm(session_factory())
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.warning('Could not load the station registry: {}'.format(e))
+    finally:
+        worker_session.remove()
+
+def check_database():
+
+    import sqlalchemy.exc
+
+    try:
+        with engine.connect() as conn:
             conn.execute("select 'OK'")
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.warning('Database is not available yet: {}'.format(e))
+        return False
+
+    return True
+
+@worker_process_shutdown.connect
+def dispose_engine(**kwargs):
+
+    if engine is not None:
+        logger.info('Database pool: {}'.format(db_pool_metrics.stats()))
+        worker_session.remove()
+        engine.dispose()
+
+# Connected after dispose_engine, so the checkins of the connections it
+# closes are flushed too
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    from .metrics import get_metrics
+    get_metrics().close()
+
+@task_prerun.connect
+def enter_task_session(**kwargs):
+    task_depth.value=getattr(task_depth,'value',0)+1
+
+@task_postrun.connect
+def remove_task_session(**kwargs):
+    """
+    Close the session of a finished task, returning its connection to the
+    pool, unless the task ran inside another one
+    """
+
+    task_depth.value=max(getattr(task_depth,'value',1)-1,0)
+
+    if task_depth.value==0:
+        worker_session.remove()
+
+# Start times of the running tasks, by task id
+task_start_times={}
+
+@task_prerun.connect
+def start_task_timer(task_id=None,**kwargs):
+    import time
+    task_start_times[task_id]=time.perf_counter()
+
+@task_postrun.connect
+def observe_task_time(task_id=None,task=None,state=None,**kwargs):
+    import time
+    from .metrics import get_metrics
+
+    start=task_start_times.pop(task_id,None)
+
+    if start is None or task is None:
+        return
+
+    metrics=get_metrics()
+    metrics.observe('celery_task_seconds',time.perf_counter()-start,
+                    task=task.name,state=state)
+    metrics.flush()
 
-        except sqlalchemy.exc.OperationalError as e:
-            import time
-            print(e)
-            print("Connection failed. Sleeping.")
-            time.sleep(2)
-            continue
-        
-        # If we get to this line, connection has succeeded so we break
-        # out of the loop
-        conn.close()
-        break
-    
 def session_factory():
-    from sqlalchemy.orm import Session
-    from zope.sqlalchemy import ZopeTransactionExtension
+    """
+    Session of the running task
+    """
 
-    global engine
+    return worker_session()
+
+redis_client=None
+
+def get_redis():
+    """
+    Return a client for the Redis server shared by the workers, or None if
+    no Redis server is configured.
+    """
+
+    global redis_client
+
+    if redis_client is None:
+
+        try:
+            redis_url=config['celery']['redis_url']
+        except KeyError:
+            try:
+                redis_url=config['celery']['backend_url']
+            except KeyError:
+                return None
+
+        if not redis_url.startswith('redis://'):
+            return None
 
-    session=Session(engine, extension=ZopeTransactionExtension())
+        import redis
+        redis_client=redis.Redis.from_url(redis_url)
 
-    return session
+    return redis_client
 
 def create_app():
     try:
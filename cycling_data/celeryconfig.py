@@ -1,2 +1,37 @@
+from kombu import Queue
+
 enable_utc = True
-imports = ['cycling_data.processing.weather','cycling_data.processing.locations','cycling_data.processing.regression']
+imports = ['cycling_data.processing.weather','cycling_data.processing.locations','cycling_data.processing.regression','cycling_data.processing.prefetch','cycling_data.processing.recompute']
+
+# Weather for rides and locations users have just saved
+interactive_queue='weather_interactive'
+
+# Periodic and bulk weather work: filling in missing weather, prefetching
+# and recomputing stored weather
+backfill_queue='weather_backfill'
+
+# Prediction model training
+training_queue='training'
+
+task_queues = [
+    Queue('task_default'),
+    Queue(interactive_queue),
+    Queue(backfill_queue),
+    Queue(training_queue),
+]
+
+# update_rides_weather is interactive unless sent to the backfill queue by
+# fill_missing_weather. Retries stay on the queue a task came from.
+task_routes = {
+    'cycling_data.processing.weather.update_ride_weather': {'queue': interactive_queue},
+    'cycling_data.processing.weather.update_rides_weather': {'queue': interactive_queue},
+    'cycling_data.processing.weather.update_location_rides_weather': {'queue': interactive_queue},
+    'cycling_data.processing.weather.fill_missing_weather': {'queue': backfill_queue},
+    'cycling_data.processing.prefetch.prefetch_weather': {'queue': backfill_queue},
+    'cycling_data.processing.recompute.*': {'queue': backfill_queue},
+    'cycling_data.processing.regression.*': {'queue': training_queue},
+}
+
+# Workers take one task at a time, so a long task doesn't hold back others
+# already delivered to the same process
+worker_prefetch_multiplier = 1
@@ -0,0 +1,410 @@
+from functools import wraps
+import json
+import math
+import os
+import socket
+import threading
+import time
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets
+default_buckets=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.,2.5,5.,10.,30.,60.,
+                 300.,1800.,math.inf)
+
+# Processes add their counts to the shared totals at most this often
+metrics_flush_interval=10
+
+# Gauges of a process that has stopped flushing are dropped after this long
+metrics_gauge_ttl=300
+
+metric_definitions={
+    'ogimet_requests_total':('counter','OGIMET requests sent, by path and outcome'),
+    'ogimet_request_seconds':('histogram','Time until OGIMET responds to a request'),
+    'ogimet_rate_limiter_total':('counter','OGIMET rate limiter decisions, by outcome'),
+    'weather_fetch_seconds':('histogram','Time to fetch METARs from OGIMET'),
+    'weather_download_seconds':('histogram','Time to download and store the METARs of a station'),
+    'weather_average_seconds':('histogram','Time to average the weather of a ride'),
+    'weather_average_rides_seconds':('histogram','Time to average the weather of a batch of rides from one station'),
+    'model_training_seconds':('histogram','Time to train a prediction model'),
+    'model_dataset_seconds':('histogram','Time to prepare a prediction model dataset'),
+    'celery_task_seconds':('histogram','Celery task durations, by task and state'),
+    'http_request_seconds':('histogram','Pyramid view latency, by route and status'),
+    'celery_queue_messages':('gauge','Messages waiting in each Celery queue'),
+    'weather_backlog_rides':('gauge','Rides in the weather backlog, by state'),
+    'db_pool_events_total':('counter','Worker database pool checkouts, checkins, connections, invalidations and timeouts, by event'),
+    'db_pool_wait_seconds':('histogram','Time worker tasks wait for a pooled database connection'),
+    'db_pool_checked_out':('gauge','Database connections checked out of worker pools'),
+}
+
+def escape_label(value):
+    return str(value).replace('\\','\\\\').replace('\n','\\n').replace('"','\\"')
+
+def format_labels(labels):
+
+    if len(labels)==0:
+        return ''
+
+    return '{'+','.join('{}="{}"'.format(name,escape_label(value))
+                        for name,value in labels)+'}'
+
+def format_value(value):
+
+    if value==math.inf:
+        return '+Inf'
+
+    return repr(float(value))
+
+def render(series,gauges={}):
+    """
+    Text exposition of metric series for Prometheus
+
+    series: dict mapping (name, labels, part) keys to values. labels is a
+        tuple of (name, value) pairs. part is 'value' for counters, 'sum'
+        and 'count' for histograms, or the upper bound of a histogram
+        bucket, whose count is not cumulative.
+    gauges: dict mapping gauge names to dicts mapping labels to values
+    """
+
+    by_name={}
+
+    for (name,labels,part),value in series.items():
+        by_name.setdefault(name,{}).setdefault(labels,{})[part]=value
+
+    for name,values in gauges.items():
+        by_name[name]={labels:{'value':value} for labels,value in values.items()}
+
+    lines=[]
+
+    for name in sorted(by_name):
+
+        kind,description=metric_definitions.get(name,('untyped',''))
+
+        lines.append('# HELP {} {}'.format(name,description))
+        lines.append('# TYPE {} {}'.format(name,kind))
+
+        for labels in sorted(by_name[name]):
+
+            parts=by_name[name][labels]
+
+            if kind!='histogram':
+                lines.append('{}{} {}'.format(name,format_labels(labels),
+                                              format_value(parts['value'])))
+                continue
+
+            total=0
+            for bound in default_buckets:
+                total+=parts.get(bound,0)
+                lines.append('{}_bucket{} {}'.format(
+                    name,format_labels(labels+(('le',format_value(bound)),)),
+                    format_value(total)))
+            lines.append('{}_sum{} {}'.format(name,format_labels(labels),
+                                             format_value(parts.get('sum',0))))
+            lines.append('{}_count{} {}'.format(name,format_labels(labels),
+                                               format_value(parts.get('count',0))))
+
+    return '\n'.join(lines)+'\n'
+
+class metrics_registry(object):
+    """
+    Counters and histograms of one process.
+
+    Recording a value only updates a dict in this process. If Redis is
+    available, the changes are added to totals shared by all processes at
+    most every flush_interval seconds, with one pipelined request, and the
+    shared totals are what gets exported.
+
+    Gauges are read from functions when flushing. Each process stores its
+    values in its own Redis hash, which expires gauge_ttl seconds after the
+    last flush, and the values of all processes are summed when collected.
+    """
+
+    series_key='metrics:series'
+    gauges_key_prefix='metrics:gauges:'
+
+    def __init__(self,redis=None,flush_interval=metrics_flush_interval,
+                 gauge_ttl=metrics_gauge_ttl):
+        self.redis=redis
+        self.flush_interval=flush_interval
+        self.gauge_ttl=gauge_ttl
+        self.lock=threading.Lock()
+        self.series={}
+        self.unflushed={}
+        self.gauges={}
+        self.last_flush=time.monotonic()
+
+    def add(self,key,value):
+        self.series[key]=self.series.get(key,0)+value
+        self.unflushed[key]=self.unflushed.get(key,0)+value
+
+    def inc(self,name,value=1,**labels):
+
+        labels=tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.add((name,labels,'value'),value)
+
+    def observe(self,name,value,**labels):
+
+        labels=tuple(sorted(labels.items()))
+
+        bound=next(bound for bound in default_buckets if value<=bound)
+
+        with self.lock:
+            self.add((name,labels,bound),1)
+            self.add((name,labels,'sum'),value)
+            self.add((name,labels,'count'),1)
+
+    def add_gauge(self,name,read,**labels):
+        """
+        Report the value read() returns as this process's value of a gauge
+        """
+
+        with self.lock:
+            self.gauges[name,tuple(sorted(labels.items()))]=read
+
+    def read_gauges(self):
+
+        with self.lock:
+            gauges=dict(self.gauges)
+
+        return {key:read() for key,read in gauges.items()}
+
+    def gauges_key(self):
+        # Read at each flush, as the registry may be inherited by a forked
+        # process
+        return '{}{}:{}'.format(self.gauges_key_prefix,socket.gethostname(),os.getpid())
+
+    def measure(self,name,**labels):
+        """
+        Context manager observing the time spent in a block
+        """
+
+        return timer(self,name,labels)
+
+    def flush(self,force=False):
+        """
+        Add this process's counts since the last flush to the shared totals
+        """
+
+        if self.redis is None:
+            return
+
+        now=time.monotonic()
+
+        with self.lock:
+            if not force and now-self.last_flush<self.flush_interval:
+                return
+            unflushed=self.unflushed
+            self.unflushed={}
+            self.last_flush=now
+
+        gauges=self.read_gauges()
+
+        if len(unflushed)==0 and len(gauges)==0:
+            return
+
+        import redis.exceptions
+
+        pipe=self.redis.pipeline(transaction=False)
+        for (name,labels,part),value in unflushed.items():
+            pipe.hincrbyfloat(self.series_key,
+                              json.dumps([name,labels,part]),value)
+
+        if len(gauges)>0:
+            gauges_key=self.gauges_key()
+            for (name,labels),value in gauges.items():
+                pipe.hset(gauges_key,json.dumps([name,labels]),value)
+            pipe.expire(gauges_key,self.gauge_ttl)
+
+        try:
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning('Could not flush metrics: {}'.format(e))
+            with self.lock:
+                for key,value in unflushed.items():
+                    self.unflushed[key]=self.unflushed.get(key,0)+value
+
+    def collect(self):
+        """
+        Totals of all processes if Redis is available, otherwise of this
+        process
+        """
+
+        if self.redis is None:
+            with self.lock:
+                return dict(self.series)
+
+        self.flush(force=True)
+
+        series={}
+
+        for field,value in self.redis.hgetall(self.series_key).items():
+            name,labels,part=json.loads(field)
+            if not isinstance(part,str):
+                part=float(part)
+            series[name,tuple(tuple(label) for label in labels),part]=float(value)
+
+        return series
+
+    def collect_gauges(self):
+        """
+        Gauge values summed over all processes if Redis is available,
+        otherwise of this process
+
+        Returns: dict mapping gauge names to dicts mapping labels to values,
+            as render takes them
+        """
+
+        if self.redis is None:
+            values=self.read_gauges()
+        else:
+            self.flush(force=True)
+            values={}
+            for gauges_key in self.redis.scan_iter(match=self.gauges_key_prefix+'*'):
+                for field,value in self.redis.hgetall(gauges_key).items():
+                    name,labels=json.loads(field)
+                    key=(name,tuple(tuple(label) for label in labels))
+                    values[key]=values.get(key,0)+float(value)
+
+        gauges={}
+
+        for (name,labels),value in values.items():
+            gauges.setdefault(name,{})[labels]=value
+
+        return gauges
+
+    def close(self):
+        """
+        Flush this process's counts and drop its gauges, when it exits
+        """
+
+        self.flush(force=True)
+
+        if self.redis is not None and len(self.gauges)>0:
+
+            import redis.exceptions
+
+            try:
+                self.redis.delete(self.gauges_key())
+            except redis.exceptions.RedisError as e:
+                logger.warning('Could not drop gauges: {}'.format(e))
+
+class timer(object):
+
+    def __init__(self,registry,name,labels):
+        self.registry=registry
+        self.name=name
+        self.labels=labels
+
+    def __enter__(self):
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.registry.observe(self.name,time.perf_counter()-self.start,
+                              **self.labels)
+
+registry=None
+
+def get_metrics():
+
+    global registry
+
+    if registry is None:
+        from .celery import get_redis
+        registry=metrics_registry(get_redis())
+
+    return registry
+
+def timed(name,**labels):
+    """
+    Decorator observing the duration of each call of a function
+    """
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args,**kwargs):
+            with get_metrics().measure(name,**labels):
+                return function(*args,**kwargs)
+
+        return wrapper
+
+    return decorator
+
+def metrics_tween_factory(handler,app_registry):
+    """
+    Tween observing the latency of every view, labelled by route name and
+    status code
+    """
+
+    def metrics_tween(request):
+
+        start=time.perf_counter()
+        status=500
+
+        try:
+            response=handler(request)
+            status=response.status_code
+            return response
+        finally:
+            route=request.matched_route.name \
+                if getattr(request,'matched_route',None) is not None else ''
+            metrics=get_metrics()
+            metrics.observe('http_request_seconds',time.perf_counter()-start,
+                            route=route,status=status)
+            metrics.flush()
+
+    return metrics_tween
+
+def queue_depths():
+    """
+    Number of messages waiting in each Celery queue. Queues that can't be
+    read, such as those no worker has declared yet, are left out.
+    """
+
+    from .celery import celery
+
+    depths={}
+
+    with celery.connection_for_read() as conn:
+
+        try:
+            conn.ensure_connection(max_retries=1)
+        except conn.connection_errors as e:
+            logger.warning('Could not read Celery queue depths: {}'.format(e))
+            return depths
+
+        for queue in celery.conf.task_queues or []:
+            # A failed passive declare closes the channel, so each queue
+            # gets its own
+            try:
+                with conn.channel() as channel:
+                    depths[queue.name]=channel.queue_declare(
+                        queue=queue.name,passive=True).message_count
+            except conn.channel_errors+conn.connection_errors:
+                pass
+
+    return depths
+
+def flush_metrics():
+    """
+    Flush the counts of this process if it recorded any, and drop its
+    gauges
+    """
+
+    if registry is not None:
+        registry.close()
+
+def includeme(config):
+
+    import atexit
+
+    config.add_tween('cycling_data.metrics.metrics_tween_factory')
+
+    # Web processes flush their last counts at exit, as workers do when
+    # they shut down
+    atexit.register(flush_metrics)
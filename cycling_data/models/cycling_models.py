@@ -7,6 +7,7 @@ from sqlalchemy import (
     Float,
     ForeignKey,
     Sequence,
+    Date,
     DateTime,
     Boolean,
     Interval,
@@ -91,6 +92,9 @@ class PredictionModel(Base,TimestampedRecord):
     output_size_=Column('output_size',Integer)
     training_in_progress=Column(Boolean,default=False)
 
+    # Token of the worker holding the training lock, when there is no Redis
+    training_lock=Column(String(32))
+
     def __init__(self,*args,**kwargs):
 
         super(PredictionModel,self).__init__(*args,**kwargs)
@@ -499,6 +503,102 @@ class RideWeatherData(WeatherData):
         'polymorphic_identity':'rideweatherdata'
         }
 
+def metar_hash(station_name,report_time,metar):
+    """
+    Content hash identifying a METAR report, used to detect duplicates.
+    Report times are hashed as naive UTC, as they are stored.
+    """
+
+    import hashlib
+
+    if report_time is not None and report_time.tzinfo is not None:
+        from pytz import utc
+        report_time=report_time.astimezone(utc).replace(tzinfo=None)
+
+    key='{}|{}|{}'.format(
+        station_name,
+        report_time.isoformat() if report_time is not None else '',
+        metar)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def weather_to_numeric(weathers):
+    """
+    Rain and snow intensities for a list of METAR present weather groups,
+    given as (intensity, description, precipitation, obscuration, other)
+    tuples
+    """
+
+    totalrain=0
+    totalsnow=0
+    for weather in weathers:
+        rain=0
+        if weather[2]=='BR':rain+=0.1
+        elif weather[2]=='DZ':rain+=0.3
+        elif weather[2]=='RA':rain+=0.3
+        
+        if rain>0:
+            if weather[0]=='+': rain+=0.1
+            if weather[0]=='-': rain-=0.1
+        
+        snow=0
+        if weather[2]=='SN':snow+=0.5
+        elif weather[2]=='SG':snow+=0.5
+        elif weather[2]=='IC':snow+=0.5
+        elif weather[2]=='PL':snow+=0.5
+        
+        if snow>0:
+            if weather[0]=='+': snow+=0.2
+            if weather[0]=='-': snow-=0.2
+        totalrain+=rain
+        totalsnow+=snow
+    return totalrain,totalsnow
+
+def weather_codes(weathers):
+    """
+    METAR present weather groups as they appear in a report, e.g. '-RA BR'
+    """
+
+    return ' '.join(''.join(part for part in weather if part is not None)
+                    for weather in weathers)[:255]
+
+def metar_fields(obs):
+    """
+    StationWeatherData attribute values for a parsed METAR.
+
+    The values are plain Python objects, so they can be computed in another
+    process and passed back for storage.
+    """
+
+    fields={}
+
+    try:
+        vapres=6.1121*math.exp((18.678-obs.temp.value(units='C')/234.5)*obs.temp.value(units='C')/(obs.temp.value(units='C')+257.14))
+        vapres_dew=6.1121*math.exp((18.678-obs.dewpt.value(units='C')/234.5)*obs.dewpt.value(units='C')/(obs.dewpt.value(units='C')+257.14))
+        rh=vapres_dew/vapres
+    except:
+        rh=None
+    fields['windspeed']=obs.wind_speed.value(units='mph') \
+        if obs.wind_speed is not None else None
+    try: fields['winddir']=obs.wind_dir.value()
+    except AttributeError: fields['winddir']=None
+    try: fields['gust']=obs.wind_gust.value(units='mph')
+    except AttributeError: fields['gust']=None
+    try: fields['temperature']=obs.temp.value(units='C')
+    except AttributeError: fields['temperature']=None
+    try: fields['dewpoint']=obs.dewpt.value(units='C')
+    except AttributeError: fields['dewpoint']=None
+    try: fields['pressure']=obs.press.value('hpa')
+    except AttributeError: fields['pressure']=None
+    fields['relative_humidity_stored']=rh
+    fields['weather']=weather_codes(obs.weather)
+    fields['rain'],fields['snow']=weather_to_numeric(obs.weather)
+    fields['report_time']=obs.time
+    fields['metar']=obs.code
+    fields['metar_hash']=metar_hash(obs.station_id,obs.time,obs.code)
+
+    return fields
+
 class StationWeatherData(WeatherData):
     __tablename__='stationweatherdata'
     __table_args__={'mysql_encrypted':'yes'}
@@ -510,7 +610,10 @@ class StationWeatherData(WeatherData):
     metar = Column(Text)
     report_time = Column(DateTime)
     weather = Column(String(255))
+    rain = Column(Float)
+    snow = Column(Float)
     parse_error = Column(Boolean)
+    metar_hash = Column(String(40),index=True,unique=True)
 
     __mapper_args__ = {
         'polymorphic_identity':'stationweatherdata'
@@ -550,33 +653,61 @@ class StationWeatherData(WeatherData):
             assert(isinstance(obs,Metar.Metar))
             from sqlalchemy import and_
             
-            try:
-                self.station=session.query(Location).filter(and_(Location.name==obs.station_id,Location.loctype_id==2)).one()
-                self.report_time=obs.time
-            except NoResultFound:
-                location=Location(name=obs.station_id,loctype_id=2)
-                session.add(location)
+            # The station can be passed in by callers that have already
+            # looked it up
+            if self.station is None and self.wx_station is None:
+                try:
+                    self.station=session.query(Location).filter(and_(Location.name==obs.station_id,Location.loctype_id==2)).one()
+                except NoResultFound:
+                    self.station=Location(name=obs.station_id,loctype_id=2)
+                    session.add(self.station)
 
-            try:
-                vapres=6.1121*math.exp((18.678-obs.temp.value(units='C')/234.5)*obs.temp.value(units='C')/(obs.temp.value(units='C')+257.14))
-                vapres_dew=6.1121*math.exp((18.678-obs.dewpt.value(units='C')/234.5)*obs.dewpt.value(units='C')/(obs.dewpt.value(units='C')+257.14))
-                rh=vapres_dew/vapres
-            except:
-                rh=None
-            self.windspeed=obs.wind_speed.value(units='mph') \
-                if obs.wind_speed is not None else None
-            try: self.winddir=obs.wind_dir.value()
-            except AttributeError: self.winddir=None
-            try: self.gust=obs.wind_gust.value(units='mph')
-            except AttributeError: self.gust=None
-            try: self.temperature=obs.temp.value(units='C')
-            except AttributeError: self.temperature=None
-            try: self.dewpoint=obs.dewpt.value(units='C')
-            except AttributeError: self.dewpoint=None
-            try: self.pressure=obs.press.value('hpa')
-            except AttributeError: self.pressure=None
-            self.relative_humidity_stored=rh
-            self.metar=obs.code
+            for key,value in metar_fields(obs).items():
+                setattr(self,key,value)
+
+def queue_station_invalidation(target,names):
+    """
+    Invalidate the station registries once the session commits, so workers
+    can't cache the old name again before the change is visible
+    """
+
+    session=sa.orm.object_session(target)
+
+    if session is None:
+        from ..processing.stations import location_changed
+        location_changed(names)
+    else:
+        session.info.setdefault('changed_stations',set()).update(names)
+
+@sa.event.listens_for(Location,'after_update')
+def location_updated(mapper, connection, target):
+
+    state=sa.inspect(target)
+    name=state.attrs.name.history
+    loctype=state.attrs.loctype_id.history
+
+    if name.has_changes() or loctype.has_changes():
+        queue_station_invalidation(
+            target,list(name.deleted)+list(name.added)+list(name.unchanged))
+
+@sa.event.listens_for(Location,'after_delete')
+def location_deleted(mapper, connection, target):
+
+    queue_station_invalidation(target,[target.name])
+
+@sa.event.listens_for(sa.orm.Session,'after_commit')
+def invalidate_changed_stations(session):
+
+    names=session.info.pop('changed_stations',None)
+
+    if names:
+        from ..processing.stations import location_changed
+        location_changed(names)
+
+@sa.event.listens_for(sa.orm.Session,'after_rollback')
+def discard_changed_stations(session):
+
+    session.info.pop('changed_stations',None)
 
 class Ride(Base,TimestampedRecord):
     __tablename__ = 'ride'
@@ -988,11 +1119,14 @@ class SentRequestLog(Base):
 
     id = Column(Integer, Sequence('sentrequestlog_seq'), primary_key=True)
 
-    time=Column(DateTime)
+    time=Column(DateTime,index=True)
     url=Column(Text)
     status_code=Column(Integer)
     rate_limited=Column(Boolean,default=False)
 
+    # Rate limiter token for a slot reserved but not yet used
+    reservation=Column(String(255),index=True)
+
     def __init__(self,*args,**kwargs):
 
         super(SentRequestLog,self).__init__(*args,**kwargs)
@@ -1000,6 +1134,21 @@ class SentRequestLog(Base):
         if self.rate_limited is None:
             self.rate_limited=False
 
+class RateLimiterLock(Base):
+    """
+    Row a rate limiter locks while it reserves a slot, so reservations are
+    made one at a time
+    """
+
+    __tablename__='rate_limiter_lock'
+    __table_args__=(
+        Index('ix_rate_limiter_lock_name','name',unique=True),
+    )
+
+    id = Column(Integer, Sequence('ratelimiterlock_seq'), primary_key=True)
+    name=Column(String(64))
+    locked_at=Column(DateTime)
+
 class WeatherFetchLog(Base):
 
     __tablename__='weather_fetch_log'
@@ -1012,6 +1161,140 @@ class WeatherFetchLog(Base):
 
     station=relationship(Location)
 
+class WeatherCoverage(Base):
+    """
+    Interval of time for which a station's reports have been fetched.
+    Intervals of the same station do not overlap.
+    """
+
+    __tablename__='weather_coverage'
+    __table_args__=(
+        Index('ix_weather_coverage_station_id_dtstart','station_id','dtstart'),
+    )
+
+    id = Column(Integer, Sequence('weathercoverage_seq'), primary_key=True)
+    station_id=Column(Integer, ForeignKey('location.id',name='fk_weather_coverage_location_id'))
+    dtstart=Column(DateTime)
+    dtend=Column(DateTime)
+    fetch_time=Column(DateTime)
+
+    # Whether the interval was fetched long enough after its end that no
+    # more reports can be added
+    final=Column(Boolean)
+
+    station=relationship(Location)
+
+class StationQuality(Base):
+    """
+    Reporting record of a weather station, used to decide which stations
+    to fetch reports from
+    """
+
+    __tablename__='station_quality'
+    __table_args__=(
+        Index('ix_station_quality_station_id','station_id',unique=True),
+    )
+
+    id = Column(Integer, Sequence('stationquality_seq'), primary_key=True)
+    station_id=Column(Integer, ForeignKey('location.id',name='fk_station_quality_location_id'))
+
+    # Typical time between reports, in seconds
+    report_interval=Column(Float)
+    last_report=Column(DateTime)
+
+    # Fetch counts in which each earlier fetch is given less weight
+    recent_fetches=Column(Float)
+    recent_empty_fetches=Column(Float)
+
+    last_fetch=Column(DateTime)
+    last_fetch_reports=Column(Integer)
+
+    station=relationship(Location)
+
+class StationReportDay(Base):
+    """
+    Number of reports a station made on a UTC day, recorded once all of
+    the day's reports have been fetched
+    """
+
+    __tablename__='station_report_day'
+    __table_args__=(
+        Index('ix_station_report_day_station_id_day','station_id','day',unique=True),
+    )
+
+    id = Column(Integer, Sequence('stationreportday_seq'), primary_key=True)
+    station_id=Column(Integer, ForeignKey('location.id',name='fk_station_report_day_location_id'))
+    day=Column(Date)
+    reports=Column(Integer)
+    checked=Column(DateTime)
+
+    # Whether the day was counted long enough after it ended that no more
+    # reports can be added
+    final=Column(Boolean)
+
+    station=relationship(Location)
+
+class WeatherBacklog(Base):
+    """
+    Weather work for a ride: whether its weather is still to be found, how
+    many attempts have failed and when it may be tried again
+    """
+
+    __tablename__='weather_backlog'
+    __table_args__=(
+        Index('ix_weather_backlog_ride_id','ride_id',unique=True),
+        Index('ix_weather_backlog_state_next_attempt','state','next_attempt'),
+    )
+
+    id = Column(Integer, Sequence('weatherbacklog_seq'), primary_key=True)
+    ride_id=Column(Integer, ForeignKey('ride.id',name='fk_weather_backlog_ride_id'))
+
+    # 'pending', 'done' or 'failed'. Failed rides are not tried again until
+    # they are edited.
+    state=Column(String(16))
+    attempts=Column(Integer)
+    last_error=Column(Text)
+    next_attempt=Column(DateTime)
+    updated=Column(DateTime)
+
+    ride=relationship(Ride)
+
+# Ride columns the weather of a ride depends on
+ride_weather_columns=['start_time_','end_time_','start_timezone_',
+                      'end_timezone_','timezone','startloc_id','endloc_id']
+
+@sa.event.listens_for(Ride,'after_insert')
+def ride_inserted(mapper, connection, target):
+    from ..processing.backlog import enqueue_rides
+
+    enqueue_rides(connection,[target.id])
+
+@sa.event.listens_for(Ride,'after_update')
+def ride_updated(mapper, connection, target):
+    from ..processing.backlog import enqueue_rides
+
+    state=sa.inspect(target)
+
+    if any(state.attrs[name].history.has_changes()
+           for name in ride_weather_columns):
+        enqueue_rides(connection,[target.id])
+
+@sa.event.listens_for(Ride,'before_delete')
+def ride_deleted(mapper, connection, target):
+    from ..processing.backlog import remove_rides
+
+    remove_rides(connection,[target.id])
+
+@sa.event.listens_for(Location,'after_update')
+def location_moved(mapper, connection, target):
+    from ..processing.backlog import enqueue_location_rides
+
+    state=sa.inspect(target)
+
+    if any(state.attrs[name].history.has_changes()
+           for name in ('lat','lon','elevation')):
+        enqueue_location_rides(connection,target.id)
+
 class PredictionModelResult(Base,TimestampedRecord):
     __tablename__ = 'predictionmodel_result'
     __table_args__={'mysql_encrypted':'yes'}
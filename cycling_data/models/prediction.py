@@ -5,6 +5,7 @@ tfd = tfp.distributions
 from tensorflow import keras
 from tensorflow.keras import layers
 from sqlalchemy import func
+from ..metrics import timed
 
 predict_vars=['avspeed','maxspeed','total_time']
 
@@ -104,6 +105,7 @@ def est_total_time(ride, dbsession):
 
         return rolling_time*float(avg_total_time/avg_rolling_time)
 
+@timed('model_dataset_seconds')
 def prepare_model_dataset(rides,dbsession,predict_columns,extra_fields=[],tm=None):
     from .cycling_models import Ride, RiderGroup, SurfaceType, Equipment, Location
     import pandas as pd
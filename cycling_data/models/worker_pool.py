@@ -0,0 +1,182 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Defaults for the worker connection pool. Each worker process runs one
+# task at a time, so it needs few connections.
+worker_pool_size=2
+worker_max_overflow=3
+worker_pool_timeout=30
+worker_pool_recycle=3600
+
+class pool_metrics(object):
+    """
+    Counts of a connection pool's checkouts, checkins, new connections and
+    invalidated connections (including those found dead by pre-ping), and
+    the time spent waiting for a connection.
+
+    The counts are also recorded in a metrics registry (see
+    cycling_data.metrics), the process's own unless one is given, so they
+    are exported with the other metrics, along with a gauge of the
+    connections checked out.
+    """
+
+    def __init__(self,registry=None):
+        self.registry=registry
+        self.lock=threading.Lock()
+        self.checkouts=0
+        self.checkins=0
+        self.connects=0
+        self.invalidations=0
+        self.timeouts=0
+        self.wait_time=0.
+        self.max_wait_time=0.
+        self.engine=None
+
+    def attach(self,engine):
+
+        # The engine's pool is replaced when it is disposed
+        self.engine=engine
+
+        self.get_registry().add_gauge('db_pool_checked_out',self.checked_out)
+
+        event.listen(engine,'checkout',self.on_checkout)
+        event.listen(engine,'checkin',self.on_checkin)
+        event.listen(engine,'connect',self.on_connect)
+        event.listen(engine,'invalidate',self.on_invalidate)
+
+    def get_registry(self):
+
+        if self.registry is None:
+            from ..metrics import get_metrics
+            return get_metrics()
+
+        return self.registry
+
+    def increment(self,name,event):
+
+        with self.lock:
+            setattr(self,name,getattr(self,name)+1)
+
+        self.get_registry().inc('db_pool_events_total',event=event)
+
+    def on_checkout(self,dbapi_connection,connection_record,connection_proxy):
+        self.increment('checkouts','checkout')
+
+    def on_checkin(self,dbapi_connection,connection_record):
+        self.increment('checkins','checkin')
+
+    def on_connect(self,dbapi_connection,connection_record):
+        self.increment('connects','connect')
+
+    def on_invalidate(self,dbapi_connection,connection_record,exception):
+        self.increment('invalidations','invalidate')
+
+    def record_wait(self,seconds,timed_out=False):
+
+        with self.lock:
+            self.wait_time+=seconds
+            self.max_wait_time=max(self.max_wait_time,seconds)
+
+        self.get_registry().observe('db_pool_wait_seconds',seconds)
+
+        if timed_out:
+            self.increment('timeouts','timeout')
+
+    def stats(self):
+
+        with self.lock:
+            stats={'checkouts':self.checkouts,
+                   'checkins':self.checkins,
+                   'connects':self.connects,
+                   'invalidations':self.invalidations,
+                   'timeouts':self.timeouts,
+                   'wait_time':self.wait_time,
+                   'max_wait_time':self.max_wait_time}
+
+        pool=self.engine.pool if self.engine is not None else None
+
+        if isinstance(pool,QueuePool):
+            stats.update({'size':pool.size(),
+                          'checked_out':pool.checkedout(),
+                          'overflow':pool.overflow()})
+
+        return stats
+
+    def checked_out(self):
+
+        pool=self.engine.pool if self.engine is not None else None
+
+        if isinstance(pool,QueuePool):
+            return pool.checkedout()
+
+        with self.lock:
+            return self.checkouts-self.checkins
+
+class timed_queue_pool(QueuePool):
+    """
+    QueuePool recording how long each checkout waits for a connection
+    """
+
+    def __init__(self,creator,metrics=None,**kwargs):
+        super(timed_queue_pool,self).__init__(creator,**kwargs)
+        self.metrics=metrics
+
+    def recreate(self):
+        pool=super(timed_queue_pool,self).recreate()
+        pool.metrics=self.metrics
+        return pool
+
+    def _do_get(self):
+
+        from sqlalchemy.exc import TimeoutError
+
+        start=time.monotonic()
+
+        try:
+            connection=super(timed_queue_pool,self)._do_get()
+        except TimeoutError:
+            if self.metrics is not None:
+                self.metrics.record_wait(time.monotonic()-start,timed_out=True)
+            raise
+
+        if self.metrics is not None:
+            self.metrics.record_wait(time.monotonic()-start)
+
+        return connection
+
+def get_worker_engine(settings,prefix='worker_sqlalchemy.',metrics=None):
+    """
+    Engine for a worker process, with a bounded pool whose connections are
+    checked before use and replaced after pool_recycle seconds
+    """
+
+    from sqlalchemy import engine_from_config
+    from sqlalchemy.pool import StaticPool
+    from pyramid.settings import asbool
+
+    url=settings[prefix+'url']
+
+    if url.startswith('sqlite') and ':memory:' in url:
+        # Every connection would get its own empty database
+        return engine_from_config(settings,prefix,poolclass=StaticPool)
+
+    def setting(name,default,convert=int):
+        return convert(settings.get(prefix+name,default))
+
+    engine=engine_from_config(
+        settings,prefix,
+        poolclass=timed_queue_pool,
+        metrics=metrics,
+        pool_size=setting('pool_size',worker_pool_size),
+        max_overflow=setting('max_overflow',worker_max_overflow),
+        pool_timeout=setting('pool_timeout',worker_pool_timeout),
+        pool_recycle=setting('pool_recycle',worker_pool_recycle),
+        pool_pre_ping=setting('pool_pre_ping',True,asbool))
+
+    if metrics is not None:
+        metrics.attach(engine)
+
+    return engine
@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Largest number of OGIMET requests a worker has in flight at once
+ogimet_fetch_concurrency=8
+
+def ogimet_params(station,dtstart,dtend):
+    """
+    Query parameters for OGIMET's display_metars2.php
+    """
+
+    return {
+        'lang':'en',
+        'lugar':station,
+        'tipo':'ALL',
+        'ord':'DIR',
+        'nil':'NO',
+        'fmt':'txt',
+        'ano':dtstart.year,
+        'mes':'{:02d}'.format(dtstart.month),
+        'day':'{:02d}'.format(dtstart.day),
+        'hora':'{:02d}'.format(dtstart.hour),
+        'anof':dtend.year,
+        'mesf':'{:02d}'.format(dtend.month),
+        'dayf':'{:02d}'.format(dtend.day),
+        'horaf':'{:02d}'.format(dtend.hour),
+        'minf':'{:02d}'.format(dtend.minute),
+        'send':'send'
+    }
+
+def ogimet_get(session,url,params,path,stream=False):
+    """
+    Send a request to OGIMET, counting it and observing how long OGIMET
+    takes to respond
+
+    path: Label telling single requests from concurrent ones
+    """
+
+    import time
+    import requests
+    from ..metrics import get_metrics
+
+    metrics=get_metrics()
+
+    start=time.perf_counter()
+
+    try:
+        r=session.get(url,params=params,stream=stream)
+    except requests.RequestException:
+        metrics.inc('ogimet_requests_total',path=path,outcome='error')
+        raise
+
+    metrics.observe('ogimet_request_seconds',time.perf_counter()-start,path=path)
+    metrics.inc('ogimet_requests_total',path=path,outcome=str(r.status_code))
+
+    r.raise_for_status()
+
+    return r
+
+def pooled_session(pool_size=ogimet_fetch_concurrency):
+    """
+    requests.Session that keeps up to pool_size connections alive
+    """
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session=requests.Session()
+    adapter=HTTPAdapter(pool_connections=1,pool_maxsize=pool_size)
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+
+    return session
+
+class concurrent_fetcher(object):
+    """
+    Fetch many OGIMET queries concurrently.
+
+    Requests are sent from a fixed pool of threads sharing one keep-alive
+    requests.Session, each at the time the rate limiter reserved for it.
+    Only the HTTP requests run concurrently; responses are returned to the
+    caller to parse and store, so no database session is shared between
+    threads.
+    """
+
+    def __init__(self,concurrency=ogimet_fetch_concurrency,session=None):
+        self.concurrency=concurrency
+        self.session=session if session is not None else pooled_session(concurrency)
+        self.executor=ThreadPoolExecutor(concurrency)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def get(self,url,station,dtstart,dtend,send_time=None):
+
+        if send_time is not None:
+            delay=send_time-time.time()
+            if delay>0:
+                time.sleep(delay)
+
+        r=ogimet_get(self.session,url,ogimet_params(station,dtstart,dtend),
+                     'concurrent')
+
+        # Read the body while still in the worker thread
+        r.text
+
+        return r
+
+    def fetch(self,url,queries,send_times=None):
+        """
+        Fetch a list of (station name, dtstart, dtend) queries
+
+        send_times: Time (seconds since the epoch) to send each query at,
+            as reserved from the rate limiter. Queries are sent at once if
+            not given.
+
+        Returns: List of responses in the same order as queries. A query
+            that failed has the exception in place of its response.
+        """
+
+        if send_times is None:
+            send_times=[None]*len(queries)
+
+        futures=[self.executor.submit(self.get,url,station,dtstart,dtend,send_time)
+                 for (station,dtstart,dtend),send_time in zip(queries,send_times)]
+
+        results=[]
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+def get_concurrent_fetcher():
+
+    from .worker_context import get_worker_context
+
+    return get_worker_context().fetcher
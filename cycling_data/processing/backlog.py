@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# New and edited rides wait this long before the backfill takes them, so
+# the update queued when the ride was saved gets to them first
+backlog_grace_period=timedelta(minutes=10)
+
+# Rides handed to a backfill task are not handed out again for this long,
+# unless the task records its outcome first
+backlog_lease=timedelta(hours=2)
+
+# Delay before retrying a ride after its first failed attempt, doubled
+# after each further failure up to backlog_max_retry_delay
+backlog_retry_delay=timedelta(hours=1)
+backlog_max_retry_delay=timedelta(days=30)
+
+# Rides are marked failed after this many failed attempts
+backlog_max_attempts=10
+
+def retry_delay(attempts):
+    """
+    Time to wait after a ride's weather has failed attempts times
+    """
+
+    return min(backlog_retry_delay*2**max(attempts-1,0),backlog_max_retry_delay)
+
+def enqueue_rides(connection,ride_ids,now=None):
+    """
+    Mark rides as needing weather. Called from mapper events, so it works
+    on the connection of the flush.
+    """
+
+    from ..models.cycling_models import WeatherBacklog
+
+    if now is None: now=datetime.utcnow()
+
+    backlog=WeatherBacklog.__table__
+
+    for ride_id in ride_ids:
+
+        values=dict(state='pending',attempts=0,last_error=None,
+                    next_attempt=now+backlog_grace_period,updated=now)
+
+        updated=connection.execute(
+            backlog.update().where(backlog.c.ride_id==ride_id).values(**values))
+
+        if updated.rowcount==0:
+            connection.execute(backlog.insert().values(ride_id=ride_id,**values))
+
+def remove_rides(connection,ride_ids):
+
+    from ..models.cycling_models import WeatherBacklog
+
+    backlog=WeatherBacklog.__table__
+
+    connection.execute(backlog.delete().where(backlog.c.ride_id.in_(ride_ids)))
+
+def enqueue_location_rides(connection,location_id,now=None):
+    """
+    Retry rides starting or ending at a location whose weather was not
+    found, after the location has moved
+    """
+
+    from sqlalchemy import select, or_
+    from ..models.cycling_models import Ride, WeatherBacklog
+
+    if now is None: now=datetime.utcnow()
+
+    backlog=WeatherBacklog.__table__
+    ride=Ride.__table__
+
+    connection.execute(backlog.update().where(
+        backlog.c.ride_id.in_(select([ride.c.id]).where(
+            or_(ride.c.startloc_id==location_id,ride.c.endloc_id==location_id)))
+    ).where(
+        backlog.c.state!='done'
+    ).values(state='pending',attempts=0,last_error=None,next_attempt=now,
+             updated=now))
+
+def claim_rides(session,limit,now=None,lease=backlog_lease):
+    """
+    Take the rides whose weather is due, oldest first, and lease them so
+    they are not handed out again while being worked on
+
+    Returns: List of ride ids
+    """
+
+    from zope.sqlalchemy import mark_changed
+    from ..models.cycling_models import WeatherBacklog
+
+    if now is None: now=datetime.utcnow()
+
+    ride_ids=[ride_id for ride_id, in session.query(WeatherBacklog.ride_id).filter(
+        WeatherBacklog.state=='pending',
+        WeatherBacklog.next_attempt<=now
+    ).order_by(WeatherBacklog.next_attempt,WeatherBacklog.id).limit(limit)]
+
+    if len(ride_ids)>0:
+        session.query(WeatherBacklog).filter(
+            WeatherBacklog.ride_id.in_(ride_ids)
+        ).update({WeatherBacklog.next_attempt:now+lease},
+                 synchronize_session=False)
+        mark_changed(session)
+
+    return ride_ids
+
+def record_outcomes(session,updated=(),failures={},now=None):
+    """
+    Record the outcome of weather updates
+
+    updated: ids of rides whose weather was found
+    failures: dict mapping ride ids to (error message, permanent) tuples.
+        Rides with permanent errors are marked failed at once, others are
+        retried later.
+    """
+
+    from ..models.cycling_models import WeatherBacklog
+
+    if now is None: now=datetime.utcnow()
+
+    updated=set(updated)
+    ride_ids=updated|set(failures.keys())
+
+    if len(ride_ids)==0:
+        return
+
+    entries={entry.ride_id:entry for entry in session.query(WeatherBacklog).filter(
+        WeatherBacklog.ride_id.in_(ride_ids))}
+
+    for ride_id in ride_ids:
+
+        entry=entries.get(ride_id)
+
+        if entry is None:
+            entry=WeatherBacklog(ride_id=ride_id,attempts=0)
+            session.add(entry)
+
+        entry.updated=now
+
+        if ride_id in updated:
+            entry.state='done'
+            entry.last_error=None
+            entry.next_attempt=None
+            continue
+
+        error,permanent=failures[ride_id]
+
+        entry.attempts=(entry.attempts or 0)+1
+        entry.last_error=error
+
+        if permanent or entry.attempts>=backlog_max_attempts:
+            entry.state='failed'
+            entry.next_attempt=None
+        else:
+            entry.state='pending'
+            entry.next_attempt=now+retry_delay(entry.attempts)
+
+def backlog_counts(session):
+    """
+    Number of rides in each backlog state
+    """
+
+    from sqlalchemy import func
+    from ..models.cycling_models import WeatherBacklog
+
+    return dict(session.query(WeatherBacklog.state,func.count(WeatherBacklog.id)).group_by(
+        WeatherBacklog.state))
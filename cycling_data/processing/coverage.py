@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+# Reports can still be added to OGIMET for this long after their time, so
+# only the part of a fetch ending this long before the fetch is final
+final_delay=timedelta(hours=1)
+
+# Provisional coverage (fetched too soon to be final) is trusted only for
+# this long, after which it is fetched again
+provisional_ttl=timedelta(minutes=15)
+
+def to_naive_utc(dt):
+    if dt.tzinfo is not None:
+        dt=dt.astimezone(utc).replace(tzinfo=None)
+    return dt
+
+def merge_coverage(intervals):
+    """
+    Merge coverage intervals into non-overlapping intervals.
+
+    Where intervals overlap, final coverage takes precedence over
+    provisional coverage, and otherwise the most recent fetch does. Touching
+    final intervals are joined; touching provisional intervals are joined
+    only if they come from the same fetch, so each keeps its own expiry.
+
+    intervals: Iterable of (dtstart, dtend, fetch_time, final) tuples
+
+    Returns: List of (dtstart, dtend, fetch_time, final) tuples in
+        chronological order
+    """
+
+    intervals=[interval for interval in intervals if interval[1]>interval[0]]
+
+    points=sorted(set(t for interval in intervals for t in interval[:2]))
+
+    merged=[]
+
+    for dtstart,dtend in zip(points[:-1],points[1:]):
+
+        covering=[interval for interval in intervals
+                  if interval[0]<=dtstart and interval[1]>=dtend]
+
+        if len(covering)==0: continue
+
+        best=max(covering,key=lambda interval: (interval[3],interval[2]))
+        fetch_time,final=best[2],best[3]
+
+        if len(merged)>0:
+            last=merged[-1]
+            if last[1]==dtstart and last[3]==final \
+               and (final or last[2]==fetch_time):
+                merged[-1]=(last[0],dtend,max(last[2],fetch_time),final)
+                continue
+
+        merged.append((dtstart,dtend,fetch_time,final))
+
+    return merged
+
+def covering_rows(session,station_id,dtstart,dtend,inclusive=False):
+    """
+    Query the coverage rows of a station that overlap an interval.
+
+    The rows of a station do not overlap, so the only row starting before
+    dtstart that can reach into the interval is the last one. Bounding the
+    query by its start keeps it to a range scan of the (station_id,
+    dtstart) index.
+    """
+
+    from ..models.cycling_models import WeatherCoverage
+    from sqlalchemy import func
+
+    floor=session.query(func.max(WeatherCoverage.dtstart)).filter(
+        WeatherCoverage.station_id==station_id,
+        WeatherCoverage.dtstart<=dtstart
+    ).as_scalar()
+
+    q=session.query(WeatherCoverage).filter(
+        WeatherCoverage.station_id==station_id,
+        WeatherCoverage.dtstart>=func.coalesce(floor,dtstart))
+
+    if inclusive:
+        q=q.filter(WeatherCoverage.dtstart<=dtend,
+                   WeatherCoverage.dtend>=dtstart)
+    else:
+        q=q.filter(WeatherCoverage.dtstart<dtend,
+                   WeatherCoverage.dtend>dtstart)
+
+    return q.order_by(WeatherCoverage.dtstart)
+
+def station_lock(session,station_id):
+    """
+    Query locking a station's row until the end of the transaction
+    """
+
+    from ..models.cycling_models import Location
+
+    return session.query(Location.id).filter(
+        Location.id==station_id).with_for_update()
+
+def record_coverage(session,station_id,dtstart,dtend,fetch_time=None):
+    """
+    Record that a station's reports for an interval have been fetched.
+
+    Must be called inside a transaction. Writers of a station's coverage
+    are serialized by locking the station's row, so two of them can't both
+    insert rows that overlap.
+    """
+
+    from ..models.cycling_models import WeatherCoverage
+
+    if fetch_time is None: fetch_time=datetime.utcnow()
+
+    dtstart=to_naive_utc(dtstart)
+    dtend=min(to_naive_utc(dtend),fetch_time)
+
+    if dtend<=dtstart:
+        return
+
+    station_lock(session,station_id).all()
+
+    # Split the fetch into the part that can no longer change and the part
+    # that may still receive reports
+    cutoff=fetch_time-final_delay
+    new=[
+        (dtstart,min(dtend,cutoff),fetch_time,True),
+        (max(dtstart,cutoff),dtend,fetch_time,False)
+    ]
+
+    rows=covering_rows(session,station_id,dtstart,dtend,inclusive=True).all()
+
+    merged=merge_coverage(
+        [(row.dtstart,row.dtend,row.fetch_time,row.final) for row in rows]+new)
+
+    for row in rows:
+        session.delete(row)
+
+    for interval_start,interval_end,interval_fetch_time,final in merged:
+        session.add(WeatherCoverage(station_id=station_id,
+                                    dtstart=interval_start,
+                                    dtend=interval_end,
+                                    fetch_time=interval_fetch_time,
+                                    final=final))
+
+    session.flush()
+
+def coverage_gaps(session,station_id,dtstart,dtend,now=None):
+    """
+    Find the parts of an interval for which a station's reports still need
+    to be fetched. Times after now are never reported as missing.
+
+    Returns: List of (dtstart, dtend) tuples in UTC, in chronological order
+    """
+
+    if now is None: now=datetime.utcnow()
+
+    query_start=to_naive_utc(dtstart)
+    query_end=min(to_naive_utc(dtend),now)
+
+    gaps=[]
+    cursor=query_start
+
+    for row in covering_rows(session,station_id,query_start,query_end):
+
+        if not (row.final or now-row.fetch_time<provisional_ttl):
+            continue
+
+        if row.dtstart>cursor:
+            gaps.append((cursor,row.dtstart))
+
+        cursor=max(cursor,row.dtend)
+
+        if cursor>=query_end: break
+
+    if cursor<query_end:
+        gaps.append((cursor,query_end))
+
+    return [(gap_start.replace(tzinfo=utc),gap_end.replace(tzinfo=utc))
+            for gap_start,gap_end in gaps]
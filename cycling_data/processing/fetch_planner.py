@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+# Longest interval we request from OGIMET in a single query
+ogimet_max_request_span=timedelta(days=31)
+
+# Missing intervals separated by less than this are fetched together
+ogimet_merge_gap=timedelta(hours=1)
+
+def merge_intervals(intervals,max_gap=timedelta(0)):
+    """
+    Merge overlapping intervals, and intervals separated by no more than
+    max_gap, into the smallest set of non-overlapping intervals.
+
+    intervals: Iterable of (dtstart, dtend) tuples
+
+    Returns: List of (dtstart, dtend) tuples in chronological order
+    """
+
+    merged=[]
+
+    for dtstart,dtend in sorted(intervals):
+
+        if dtend<dtstart:
+            raise ValueError('Interval end {} is before its start {}'.format(dtend,dtstart))
+
+        if len(merged)>0 and dtstart-merged[-1][1]<=max_gap:
+            merged[-1]=(merged[-1][0],max(merged[-1][1],dtend))
+        else:
+            merged.append((dtstart,dtend))
+
+    return merged
+
+def split_interval(dtstart,dtend,max_span=ogimet_max_request_span):
+    """
+    Split an interval into consecutive pieces no longer than max_span
+    """
+
+    if max_span<=timedelta(0):
+        raise ValueError('max_span must be positive (got {})'.format(max_span))
+
+    pieces=[]
+
+    while dtend-dtstart>max_span:
+        pieces.append((dtstart,dtstart+max_span))
+        dtstart=dtstart+max_span
+
+    pieces.append((dtstart,dtend))
+
+    return pieces
+
+def split_by_day(dtstart,dtend):
+    """
+    Split an interval at UTC day boundaries.
+
+    Each piece ends one second before midnight, matching the per-day
+    intervals recorded in older WeatherFetchLog rows.
+    """
+
+    pieces=[]
+
+    interval_start=dtstart
+
+    while interval_start<dtend:
+
+        day_start=interval_start.replace(
+            hour=0,minute=0,second=0,microsecond=0)
+
+        day_end=day_start+timedelta(1)-timedelta(seconds=1)
+
+        pieces.append((interval_start,min(day_end,dtend)))
+
+        interval_start=day_start+timedelta(1)
+
+    return pieces
+
+def plan_fetches(missing,max_span=ogimet_max_request_span,max_gap=ogimet_merge_gap):
+    """
+    Plan the OGIMET requests needed to cover a set of missing intervals.
+
+    missing: Iterable of (station, dtstart, dtend) tuples. Stations may be
+        Location objects or anything else hashable with a usable id.
+
+    Returns: List of (station, dtstart, dtend) tuples, one per request,
+        grouped by station and in chronological order. Overlapping and
+        adjacent intervals for the same station are merged, and merged
+        intervals longer than max_span are split.
+    """
+
+    stations={}
+    intervals={}
+
+    for station,dtstart,dtend in missing:
+        key=getattr(station,'id',station)
+        stations.setdefault(key,station)
+        intervals.setdefault(key,[]).append((dtstart,dtend))
+
+    plan=[]
+
+    for key,station_intervals in intervals.items():
+        for dtstart,dtend in merge_intervals(station_intervals,max_gap):
+            for piece_start,piece_end in split_interval(dtstart,dtend,max_span):
+                plan.append((stations[key],piece_start,piece_end))
+
+    return plan
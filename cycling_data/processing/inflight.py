@@ -0,0 +1,165 @@
+from datetime import timedelta
+import threading
+import time
+import uuid
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Claims expire after this many seconds in case a worker dies mid-fetch
+inflight_claim_ttl=600
+
+# Claim every day touched by an interval only if none of them are claimed
+claim_script="""
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('set', key, ARGV[1], 'px', ARGV[2])
+end
+return 1
+"""
+
+# Release only the days still held by the given token
+release_script="""
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('del', key)
+    end
+end
+return 1
+"""
+
+def claim_keys(station_id,dtstart,dtend,prefix='ogimet_fetch'):
+    """
+    Registry keys for each UTC day touched by an interval
+    """
+
+    day=dtstart.replace(hour=0,minute=0,second=0,microsecond=0)
+
+    keys=[]
+
+    while day<=dtend:
+        keys.append('{}:{}:{}'.format(prefix,station_id,day.strftime('%Y%m%d')))
+        day=day+timedelta(1)
+
+    return keys
+
+class inflight_registry(object):
+    """
+    Registry of OGIMET fetches currently in progress.
+
+    A worker claims a (station, interval) before fetching it and releases
+    the claim when the fetch finishes. A claim covers every UTC day the
+    interval touches, and can only be acquired if none of those days are
+    already claimed, so no two workers fetch the same station-day at the
+    same time. Claims are kept in Redis when it is available, so they are
+    shared by all workers; otherwise they are only shared within the
+    current process.
+    """
+
+    def __init__(self,redis=None,ttl=inflight_claim_ttl):
+        self.redis=redis
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        self.local_claims={}
+
+        if self.redis is not None:
+            self.claim_script=self.redis.register_script(claim_script)
+            self.release_script=self.redis.register_script(release_script)
+
+    def claim(self,station_id,dtstart,dtend):
+        """
+        Try to claim an interval.
+
+        Returns: A token to pass to release(), or None if another fetch
+            already holds part of the interval
+        """
+
+        keys=claim_keys(station_id,dtstart,dtend)
+        token=uuid.uuid4().hex
+
+        if self.redis is not None:
+            claimed=self.claim_script(keys=keys,args=[token,int(self.ttl*1000)])
+        else:
+            with self.lock:
+                self.expire_local_claims()
+                claimed=not any(key in self.local_claims for key in keys)
+                if claimed:
+                    expires=time.monotonic()+self.ttl
+                    for key in keys:
+                        self.local_claims[key]=(token,expires)
+
+        if not claimed:
+            return None
+
+        return (token,keys)
+
+    def release(self,claim):
+
+        token,keys=claim
+
+        if self.redis is not None:
+            self.release_script(keys=keys,args=[token])
+        else:
+            with self.lock:
+                for key in keys:
+                    if self.local_claims.get(key,(None,))[0]==token:
+                        del self.local_claims[key]
+
+    def remaining(self,station_id,dtstart,dtend):
+        """
+        Seconds until every claim on an interval expires, or 0 if the
+        interval is not claimed
+        """
+
+        keys=claim_keys(station_id,dtstart,dtend)
+
+        if self.redis is not None:
+            pipe=self.redis.pipeline()
+            for key in keys:
+                pipe.pttl(key)
+            return max([ms/1000 for ms in pipe.execute() if ms>0],default=0)
+        else:
+            with self.lock:
+                self.expire_local_claims()
+                now=time.monotonic()
+                return max([self.local_claims[key][1]-now for key in keys
+                            if key in self.local_claims],default=0)
+
+    def wait(self,station_id,dtstart,dtend,timeout,poll_interval=1):
+        """
+        Wait for claims on an interval to be released.
+
+        Returns: True if the interval was released before the timeout
+        """
+
+        deadline=time.monotonic()+timeout
+
+        while self.remaining(station_id,dtstart,dtend)>0:
+            if time.monotonic()>=deadline:
+                return False
+            time.sleep(poll_interval)
+
+        return True
+
+    def expire_local_claims(self):
+        now=time.monotonic()
+        for key in [key for key,(token,expires) in self.local_claims.items()
+                    if expires<=now]:
+            del self.local_claims[key]
+
+fetch_registry=None
+
+def get_fetch_registry():
+
+    global fetch_registry
+
+    if fetch_registry is None:
+        from ..celery import get_redis
+        fetch_registry=inflight_registry(get_redis())
+
+    return fetch_registry
@@ -0,0 +1,279 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, time
+import threading
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Station-days kept by each worker
+observation_cache_size=4096
+
+# Station-days shared through Redis expire after this long without being
+# stored again
+observation_cache_ttl=timedelta(days=2)
+
+class observation_cache(object):
+    """
+    Cache of stored station observations keyed by (station id, UTC day),
+    holding each day as an array of observation records (see
+    weather_math.observation_dtype).
+
+    Each worker keeps the most recently used days, and shares them with
+    the other workers through Redis, where every day has a version
+    counter. Storing new reports for a day increments its version, so
+    entries loaded before are no longer used by any worker. Days are
+    loaded from the database again when their cached version is out of
+    date.
+
+    Without Redis, reports stored by one worker could not invalidate the
+    days cached by others, so nothing is cached and every day is loaded
+    from the database.
+
+    Hits in this worker, hits in Redis and misses are counted here and in
+    totals shared by all workers.
+    """
+
+    key_prefix='observation_cache'
+    stats_key='observation_cache:stats'
+
+    def __init__(self,maxsize=observation_cache_size,redis=None,
+                 ttl=observation_cache_ttl):
+        self.maxsize=maxsize
+        self.redis=redis
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        self.entries=OrderedDict()
+        self.hits=0
+        self.redis_hits=0
+        self.misses=0
+        self.invalidations=0
+
+    def version_key(self,station_id,day):
+        return '{}:version:{}:{}'.format(self.key_prefix,station_id,day.isoformat())
+
+    def data_key(self,station_id,day,version):
+        return '{}:data:{}:{}:{}'.format(self.key_prefix,station_id,day.isoformat(),version)
+
+    def versions(self,keys):
+        """
+        Current versions of station-days
+        """
+
+        return [int(version) if version is not None else 0 for version in
+                self.redis.mget([self.version_key(*key) for key in keys])]
+
+    def get_local(self,key,version):
+
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is None or entry[0]!=version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def add_local(self,key,version,records):
+
+        with self.lock:
+            self.entries[key]=(version,records)
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_days(self,session,station_id,days):
+        """
+        Observation records of a station for each of the given UTC days,
+        querying the database once for all days not cached
+
+        Returns: dict mapping days to arrays of observation records
+        """
+
+        import numpy as np
+        from .weather_math import observation_dtype
+
+        keys=[(station_id,day) for day in days]
+
+        if self.redis is None:
+            found=self.query_days(session,station_id,keys)
+            self.count(0,0,len(keys))
+            return {day:found[station_id,day] for station_id,day in keys}
+
+        # Versions are read before the database, so reports stored while
+        # loading a day leave its entry out of date
+        versions=dict(zip(keys,self.versions(keys)))
+
+        found={}
+
+        for key in keys:
+            records=self.get_local(key,versions[key])
+            if records is not None:
+                found[key]=records
+
+        hits=len(found)
+
+        missing=[key for key in keys if key not in found]
+
+        if len(missing)>0:
+            for key,data in zip(missing,self.redis.mget(
+                    [self.data_key(*key,versions[key]) for key in missing])):
+                if data is not None:
+                    records=np.frombuffer(data,dtype=observation_dtype).copy()
+                    self.add_local(key,versions[key],records)
+                    found[key]=records
+
+        redis_hits=len(found)-hits
+
+        missing=[key for key in keys if key not in found]
+
+        if len(missing)>0:
+
+            pipe=self.redis.pipeline()
+
+            for key,day_records in self.query_days(session,station_id,missing).items():
+                self.add_local(key,versions[key],day_records)
+                found[key]=day_records
+                pipe.set(self.data_key(*key,versions[key]),
+                         day_records.tobytes(),
+                         ex=int(self.ttl.total_seconds()))
+
+            pipe.execute()
+
+        self.count(hits,redis_hits,len(missing))
+
+        return {day:found[station_id,day] for station_id,day in keys}
+
+    def query_days(self,session,station_id,keys):
+        """
+        Observation records of (station id, day) keys, loaded from the
+        database with one query
+
+        Returns: dict mapping keys to arrays of observation records
+        """
+
+        import numpy as np
+        from .weather import query_observations
+
+        first=min(day for station_id,day in keys)
+        last=max(day for station_id,day in keys)
+
+        records=query_observations(
+            session,station_id,datetime.combine(first,time()),
+            datetime.combine(last+timedelta(1),time())-timedelta(microseconds=1))
+        record_days=records['report_time'].astype('datetime64[D]')
+
+        return {key:records[record_days==np.datetime64(key[1],'D')] for key in keys}
+
+    def load(self,session,station_id,dtstart,dtend):
+        """
+        Observation records of a station from dtstart to dtend
+
+        Returns: Structured array sorted by report time
+        """
+
+        import numpy as np
+        from .coverage import to_naive_utc
+        from .weather_math import observation_records
+
+        dtstart=to_naive_utc(dtstart)
+        dtend=to_naive_utc(dtend)
+
+        if dtend<dtstart:
+            return observation_records([])
+
+        days=[dtstart.date()+timedelta(i)
+              for i in range((dtend.date()-dtstart.date()).days+1)]
+
+        records=np.concatenate(list(self.get_days(session,station_id,days).values()))
+        times=records['report_time']
+
+        return records[(times>=np.datetime64(dtstart,'us'))
+                       &(times<=np.datetime64(dtend,'us'))]
+
+    def invalidate(self,keys):
+        """
+        Drop station-days from this worker's cache and, if Redis is
+        available, from every worker's
+
+        keys: (station id, day) tuples
+        """
+
+        keys=set(keys)
+
+        if len(keys)==0:
+            return
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key,None)
+            self.invalidations+=len(keys)
+
+        if self.redis is not None:
+            pipe=self.redis.pipeline()
+            for key in keys:
+                pipe.incr(self.version_key(*key))
+            pipe.hincrby(self.stats_key,'invalidations',len(keys))
+            pipe.execute()
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+    def count(self,hits,redis_hits,misses):
+
+        with self.lock:
+            self.hits+=hits
+            self.redis_hits+=redis_hits
+            self.misses+=misses
+
+        if self.redis is not None:
+            pipe=self.redis.pipeline()
+            for name,value in (('hits',hits),('redis_hits',redis_hits),('misses',misses)):
+                if value>0:
+                    pipe.hincrby(self.stats_key,name,value)
+            pipe.execute()
+
+    def stats(self):
+        """
+        Hit and miss counts of this worker, and the totals of all workers if
+        Redis is available
+        """
+
+        with self.lock:
+            stats={'worker':{'hits':self.hits,
+                             'redis_hits':self.redis_hits,
+                             'misses':self.misses,
+                             'invalidations':self.invalidations,
+                             'entries':len(self.entries)}}
+
+        if self.redis is not None:
+            stats['shared']=shared_stats(self.redis)
+
+        return stats
+
+def shared_stats(redis):
+    """
+    Hit and miss counts totalled over all workers
+    """
+
+    shared=redis.hgetall(observation_cache.stats_key)
+
+    return {name:int(shared.get(name.encode(),0)) for name in
+            ('hits','redis_hits','misses','invalidations')}
+
+def get_observation_cache():
+
+    from .worker_context import get_worker_context
+
+    return get_worker_context().observations
+
+def reports_stored(reports):
+    """
+    Invalidate the cached days of newly stored reports
+
+    reports: (station id, report time) tuples
+    """
+
+    get_observation_cache().invalidate(
+        (station_id,report_time.date()) for station_id,report_time in reports
+        if station_id is not None and report_time is not None)
@@ -0,0 +1,106 @@
+from datetime import datetime
+import io
+
+# Number of lines from the start of a response kept for error messages
+response_head_lines=50
+
+def iter_metars_from_ogimet(lines):
+    """
+    Extract METAR and SPECI reports from an OGIMET text response.
+
+    lines: Iterable of lines (str or bytes), e.g. an open file or the
+        iter_lines() of a streamed HTTP response
+
+    Yields: (date, metar) tuples in the order they appear in the response.
+        Reports that continue over several lines are returned with their
+        original line breaks.
+    """
+
+    report=None
+
+    for line in lines:
+
+        if isinstance(line,bytes):
+            line=line.decode('utf-8',errors='replace')
+
+        line=line.rstrip('\r\n')
+
+        if report is None:
+
+            # Skip comments, empty lines and anything else outside a report
+            if not line[:12].isdigit():
+                continue
+
+            report=[line]
+
+        elif len(line.strip())>0:
+            report.append(line)
+
+        if not line.endswith('='):
+            continue
+
+        text='\n'.join(report)[:-1]
+        report=None
+
+        date=datetime.strptime(text[:12],'%Y%m%d%H%M')
+        metar=text[13:]
+        if metar.endswith('$'): metar=metar[:-1]
+
+        if metar.startswith('METAR') or metar.startswith('SPECI'):
+            yield date,metar
+
+class ogimet_response_reader(object):
+    """
+    Iterate over the lines of an OGIMET response while noting the error
+    messages OGIMET returns in place of data.
+    """
+
+    def __init__(self,lines):
+        self.lines=lines
+        self.head=[]
+        self.rate_limited=False
+        self.database_error=False
+        self.found_reports=False
+
+    def __iter__(self):
+
+        for line in self.lines:
+
+            if isinstance(line,bytes):
+                line=line.decode('utf-8',errors='replace')
+
+            if len(self.head)<response_head_lines:
+                self.head.append(line.rstrip('\r\n'))
+
+            if '#Sorry' in line:
+                self.rate_limited=True
+            if 'SELECT command denied' in line:
+                self.database_error=True
+            if 'METAR' in line or 'SPECI' in line:
+                self.found_reports=True
+
+            yield line
+
+    @property
+    def text(self):
+        """
+        Start of the response, for error messages
+        """
+
+        return '\n'.join(self.head)
+
+def response_lines(response):
+    """
+    Iterate over the lines of an HTTP response without loading the whole
+    body, falling back to the response text for objects that only provide
+    .text
+    """
+
+    import requests
+
+    if isinstance(response,requests.Response):
+        if response.encoding is None:
+            response.encoding='utf-8'
+        return response.iter_lines(decode_unicode=True)
+
+    return io.StringIO(response.text)
@@ -0,0 +1,171 @@
+from datetime import datetime, timedelta
+
+from celery.utils.log import get_task_logger
+
+from ..celery import celery
+
+logger = get_task_logger(__name__)
+
+# Number of most used ride locations whose weather is kept current
+prefetch_locations=10
+
+# Rides started this recently count toward a location's use
+prefetch_usage_period=timedelta(days=180)
+
+# Weather stations kept current for each location
+prefetch_stations_per_location=2
+
+# Days of recent reports kept current
+prefetch_days=3
+
+# The prefetcher only sends requests while fewer than this share of the
+# OGIMET request budget is in use
+prefetch_budget_share=0.5
+
+# Most requests sent by one prefetch run
+prefetch_max_requests=4
+
+def busiest_locations(session,limit=prefetch_locations,since=None):
+    """
+    Locations where the most rides started or ended
+
+    Returns: List of Locations with coordinates, most used first
+    """
+
+    from ..models.cycling_models import Ride, Location
+    from sqlalchemy import func
+
+    counts={}
+
+    for column in (Ride.startloc_id,Ride.endloc_id):
+        query=session.query(column,func.count(Ride.id)).filter(column!=None)
+        if since is not None:
+            query=query.filter(Ride.start_time_>=since)
+        for location_id,count in query.group_by(column):
+            counts[location_id]=counts.get(location_id,0)+count
+
+    locations={location.id:location for location in session.query(Location).filter(
+        Location.id.in_(counts.keys()),
+        Location.lat!=None,
+        Location.lon!=None)}
+
+    ranked=sorted(locations,key=lambda location_id: -counts[location_id])
+
+    return [locations[location_id] for location_id in ranked[:limit]]
+
+def prefetch_stations(session,locations,now=None,
+                      per_location=prefetch_stations_per_location):
+    """
+    Weather stations fetch_metars_for_ride would try first for a ride
+    starting or ending at one of the locations
+    """
+
+    from ..models.cycling_models import Location
+    from .locations import get_nearby_locations
+    from .station_quality import rank_stations
+    from .weather import metar_window_expansion
+
+    if now is None: now=datetime.utcnow()
+
+    stations=[]
+    station_ids=set()
+
+    for location in locations:
+
+        nearby=get_nearby_locations(session,location.lat,location.lon).filter(
+            Location.loctype_id==2).limit(10).all()
+
+        ranked=rank_stations(session,nearby,now-timedelta(hours=1),now,
+                             metar_window_expansion,now)
+
+        for station in ranked[:per_location]:
+            if station.id not in station_ids:
+                station_ids.add(station.id)
+                stations.append(station)
+
+    return stations
+
+def prefetch_plan(session,stations,now=None,days=prefetch_days):
+    """
+    Requests needed to bring the recent reports of each station up to date
+    """
+
+    from .coverage import coverage_gaps
+    from .fetch_planner import plan_fetches
+
+    if now is None: now=datetime.utcnow()
+
+    missing=[]
+
+    for station in stations:
+        for gap_start,gap_end in coverage_gaps(session,station.id,
+                                               now-timedelta(days),now,now):
+            missing.append((station,gap_start,gap_end))
+
+    return plan_fetches(missing)
+
+def idle_requests(limiter,now=None,share=prefetch_budget_share,
+                  max_requests=prefetch_max_requests):
+    """
+    Number of requests the prefetcher may send without taking budget that
+    ride weather updates could need, at most max_requests
+    """
+
+    import time
+    from .ratelimit import ogimet_request_budget
+
+    if now is None: now=time.time()
+
+    if limiter.circuit_until(now) is not None:
+        return 0
+
+    return max(0,min(max_requests,
+                     int(ogimet_request_budget*share)-limiter.usage(now)))
+
+@celery.task(ignore_result=False)
+def prefetch_weather():
+    """
+    Keep the recent reports of the stations serving the most used
+    locations up to date, so that weather for new rides is usually already
+    stored
+    """
+
+    from ..celery import session_factory
+    from .ratelimit import get_rate_limiter
+    from .weather import download_planned_metars
+
+    import transaction
+
+    tm=transaction.manager
+
+    dbsession=session_factory()
+
+    allowed=idle_requests(get_rate_limiter(dbsession))
+
+    if allowed==0:
+        logger.info('OGIMET request budget is in use, not prefetching weather')
+        return 0
+
+    now=datetime.utcnow()
+
+    with tm:
+        locations=busiest_locations(dbsession,since=now-prefetch_usage_period)
+        stations=prefetch_stations(dbsession,locations,now)
+        plan=prefetch_plan(dbsession,stations,now)[:allowed]
+
+    if len(plan)==0:
+        return 0
+
+    logger.info('Prefetching weather with {} requests for {} stations'.format(len(plan),len(stations)))
+
+    # Each request reserves its own rate limiter slot, so they go out
+    # spaced like any others. Without a task, a failed request is not
+    # retried; the next run picks it up again.
+    busy=download_planned_metars(dbsession,plan)
+
+    return len(plan)-len(busy)
+
+@celery.on_after_finalize.connect
+def schedule_prefetch_weather(sender,**kwargs):
+    from celery.schedules import crontab
+    sender.add_periodic_task(crontab(minute='20,50'), prefetch_weather.s())
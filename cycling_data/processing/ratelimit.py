@@ -0,0 +1,427 @@
+from datetime import datetime, timedelta
+import time
+import uuid
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# OGIMET allows roughly this many slow queries in a rolling window
+ogimet_request_budget=55
+ogimet_budget_window=3600*2
+
+# Minimum time between two slow queries
+ogimet_min_spacing=60*5
+
+# Minimum time between two requests that are not slow queries
+ogimet_fast_spacing=2
+
+# How long every worker stops querying OGIMET after a rate limit response
+ogimet_cooldown=3600
+
+# A reserved slot this close to the current time is considered due
+slot_tolerance=1
+
+def next_free_slot(reserved,now,budget=ogimet_request_budget,
+                   window=ogimet_budget_window,min_spacing=ogimet_min_spacing):
+    """
+    Find the earliest time a request can be sent.
+
+    reserved: Sorted list of send times (seconds since the epoch) of past
+        requests and of slots already reserved for future requests
+    now: Current time (seconds since the epoch)
+
+    Returns: Earliest time not before now that is at least min_spacing after
+        the latest reservation and leaves fewer than budget requests in the
+        preceding window
+    """
+
+    slot=now
+
+    if len(reserved)>0:
+        slot=max(slot,reserved[-1]+min_spacing)
+
+    if len(reserved)>=budget:
+        slot=max(slot,reserved[-budget]+window)
+
+    return slot
+
+def first_free_gap(reserved,now,spacing=ogimet_fast_spacing):
+    """
+    Find the earliest time a request that is not a slow query can be sent.
+
+    reserved: Sorted list of send times (seconds since the epoch) of past
+        requests and of slots already reserved for future requests
+    now: Current time (seconds since the epoch)
+
+    Returns: Earliest time not before now that is at least spacing away from
+        every reservation
+    """
+
+    slot=now
+
+    for reservation in reserved:
+        if reservation>=slot+spacing:
+            break
+        if reservation>slot-spacing:
+            slot=reservation+spacing
+
+    return slot
+
+reserve_script="""
+local cooldown = redis.call('pttl', KEYS[2])
+if cooldown > 0 then
+    return {'circuit', tostring(cooldown)}
+end
+
+local existing = redis.call('zscore', KEYS[1], ARGV[5])
+if existing then
+    return {'slot', existing}
+end
+
+local now = tonumber(ARGV[1])
+local budget = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local spacing = tonumber(ARGV[4])
+
+redis.call('zremrangebyscore', KEYS[1], '-inf', now - window)
+
+local slot = now
+
+local last = redis.call('zrange', KEYS[1], -1, -1, 'withscores')
+if #last > 0 then
+    slot = math.max(slot, tonumber(last[2]) + spacing)
+end
+
+local count = redis.call('zcard', KEYS[1])
+if count >= budget then
+    local kth = redis.call('zrange', KEYS[1], count - budget, count - budget, 'withscores')
+    slot = math.max(slot, tonumber(kth[2]) + window)
+end
+
+redis.call('zadd', KEYS[1], slot, ARGV[5])
+
+return {'slot', tostring(slot)}
+"""
+
+reserve_fast_script="""
+local cooldown = redis.call('pttl', KEYS[2])
+if cooldown > 0 then
+    return {'circuit', tostring(cooldown)}
+end
+
+local now = tonumber(ARGV[1])
+local spacing = tonumber(ARGV[2])
+
+redis.call('zrem', KEYS[1], ARGV[3])
+
+local slot = now
+
+local reserved = redis.call('zrangebyscore', KEYS[1], now - spacing, '+inf', 'withscores')
+for i = 2, #reserved, 2 do
+    local reservation = tonumber(reserved[i])
+    if reservation >= slot + spacing then
+        break
+    end
+    if reservation > slot - spacing then
+        slot = reservation + spacing
+    end
+end
+
+redis.call('zadd', KEYS[1], slot, ARGV[3])
+
+return {'slot', tostring(slot)}
+"""
+
+class redis_rate_limiter(object):
+    """
+    OGIMET rate limiter shared by all workers through Redis.
+
+    Reservations are kept in a sorted set scored by send time. Each
+    reservation is made by a single Lua script, so concurrent workers never
+    receive overlapping slots and no lock is held.
+    """
+
+    slots_key='ogimet:slots'
+    circuit_key='ogimet:circuit'
+
+    def __init__(self,redis,budget=ogimet_request_budget,
+                 window=ogimet_budget_window,min_spacing=ogimet_min_spacing,
+                 fast_spacing=ogimet_fast_spacing):
+        self.redis=redis
+        self.budget=budget
+        self.window=window
+        self.min_spacing=min_spacing
+        self.fast_spacing=fast_spacing
+        self.reserve_script=redis.register_script(reserve_script)
+        self.reserve_fast_script=redis.register_script(reserve_fast_script)
+
+    def reserve(self,token,now=None):
+        """
+        Reserve the next free slot, or return the slot already reserved
+        under token.
+
+        Returns: Slot time (seconds since the epoch), or None if the circuit
+            breaker is open
+        """
+
+        if now is None: now=time.time()
+
+        kind,value=self.reserve_script(
+            keys=[self.slots_key,self.circuit_key],
+            args=[now,self.budget,self.window,self.min_spacing,token])
+
+        if kind==b'circuit':
+            return None
+
+        return float(value)
+
+    def reserve_fast(self,token,now=None):
+        """
+        Reserve a slot for a request that is not a slow query: the earliest
+        time at least fast_spacing away from every other request. Such
+        requests count towards the slow query budget but don't wait for it.
+        A slot already reserved under token is replaced.
+
+        Returns: Slot time (seconds since the epoch), or None if the circuit
+            breaker is open
+        """
+
+        if now is None: now=time.time()
+
+        kind,value=self.reserve_fast_script(
+            keys=[self.slots_key,self.circuit_key],
+            args=[now,self.fast_spacing,token])
+
+        if kind==b'circuit':
+            return None
+
+        return float(value)
+
+    def consume(self,token,now=None):
+        """
+        Mark a reserved slot as used, so the token can reserve another one
+        """
+
+        if now is None: now=time.time()
+
+        pipe=self.redis.pipeline()
+        pipe.zrem(self.slots_key,token)
+        pipe.zadd(self.slots_key,{uuid.uuid4().hex:now})
+        pipe.execute()
+
+    def cancel(self,token):
+        self.redis.zrem(self.slots_key,token)
+
+    def usage(self,now=None):
+        """
+        Number of requests sent in the current window or reserved for later
+        """
+
+        if now is None: now=time.time()
+
+        return self.redis.zcount(self.slots_key,now-self.window,'+inf')
+
+    def trip(self,cooldown=ogimet_cooldown):
+        """
+        Open the circuit breaker, stopping all workers for cooldown seconds
+        """
+
+        self.redis.set(self.circuit_key,time.time()+cooldown,px=int(cooldown*1000))
+
+    def circuit_until(self,now=None):
+        """
+        Time the circuit breaker closes, or None if it is closed
+        """
+
+        until=self.redis.get(self.circuit_key)
+
+        return float(until) if until is not None else None
+
+class database_rate_limiter(object):
+    """
+    OGIMET rate limiter backed by SentRequestLog, used when Redis is not
+    available.
+
+    A reservation is a SentRequestLog row whose time is the reserved slot.
+    Slots are found and reserved in one transaction holding the limiter's
+    RateLimiterLock row, so concurrent reservations are made one after the
+    other and each sees the slots reserved before it.
+    """
+
+    lock_name='ogimet'
+    max_attempts=5
+
+    def __init__(self,dbsession,budget=ogimet_request_budget,
+                 window=ogimet_budget_window,min_spacing=ogimet_min_spacing,
+                 fast_spacing=ogimet_fast_spacing):
+        self.dbsession=dbsession
+        self.budget=budget
+        self.window=window
+        self.min_spacing=min_spacing
+        self.fast_spacing=fast_spacing
+
+    def reserve(self,token,now=None):
+
+        from ..models.cycling_models import SentRequestLog
+        import transaction
+
+        if self.circuit_until(now) is not None:
+            return None
+
+        with transaction.manager:
+            existing=self.dbsession.query(SentRequestLog).filter(
+                SentRequestLog.reservation==token).first()
+
+            if existing is not None:
+                return existing.time.timestamp()
+
+        return self.place(token,now,self.min_spacing,self.next_slot)
+
+    def reserve_fast(self,token,now=None):
+
+        if self.circuit_until(now) is not None:
+            return None
+
+        return self.place(token,now,self.fast_spacing,self.next_fast_slot)
+
+    def next_slot(self,now):
+
+        from ..models.cycling_models import SentRequestLog
+
+        recent=self.dbsession.query(SentRequestLog.time).filter(
+            SentRequestLog.time>datetime.fromtimestamp(now-self.window)
+        ).order_by(SentRequestLog.time.desc()).limit(self.budget).all()
+
+        return next_free_slot(
+            sorted(row.time.timestamp() for row in recent),now,
+            self.budget,self.window,self.min_spacing)
+
+    def next_fast_slot(self,now):
+
+        from ..models.cycling_models import SentRequestLog
+
+        reserved=self.dbsession.query(SentRequestLog.time).filter(
+            SentRequestLog.time>datetime.fromtimestamp(now-self.fast_spacing)
+        ).order_by(SentRequestLog.time)
+
+        return first_free_gap([row.time.timestamp() for row in reserved],
+                              now,self.fast_spacing)
+
+    def lock(self):
+        """
+        Lock the limiter until the current transaction ends. The lock row is
+        updated rather than selected for update, which locks it on SQLite
+        too.
+        """
+
+        from zope.sqlalchemy import mark_changed
+        from ..models.cycling_models import RateLimiterLock
+
+        locked=self.dbsession.query(RateLimiterLock).filter(
+            RateLimiterLock.name==self.lock_name
+        ).update({RateLimiterLock.locked_at:datetime.utcnow()},
+                 synchronize_session=False)
+
+        if locked==0:
+            self.dbsession.add(RateLimiterLock(name=self.lock_name,
+                                               locked_at=datetime.utcnow()))
+            self.dbsession.flush()
+
+        mark_changed(self.dbsession)
+
+    def place(self,token,now,spacing,find_slot):
+        """
+        Insert a reservation at the slot find_slot(now) returns, holding the
+        limiter lock
+        """
+
+        from sqlalchemy.exc import IntegrityError
+        from ..models.cycling_models import SentRequestLog
+        import transaction
+
+        for attempt in range(self.max_attempts):
+
+            try:
+                with transaction.manager:
+
+                    self.lock()
+
+                    slot=find_slot(now if now is not None else time.time())
+
+                    self.dbsession.add(SentRequestLog(
+                        time=datetime.fromtimestamp(slot),reservation=token))
+
+                return slot
+
+            except IntegrityError:
+                # Another worker created the lock row first
+                continue
+
+        raise RuntimeError('Could not reserve an OGIMET request slot after {} attempts'.format(self.max_attempts))
+
+    def consume(self,token,now=None):
+        # Reservations are SentRequestLog rows, which download_metars
+        # updates when the request is sent
+        pass
+
+    def cancel(self,token):
+
+        from ..models.cycling_models import SentRequestLog
+        import transaction
+
+        with transaction.manager:
+            self.dbsession.query(SentRequestLog).filter(
+                SentRequestLog.reservation==token).delete()
+
+    def usage(self,now=None):
+
+        from ..models.cycling_models import SentRequestLog
+        import transaction
+
+        if now is None: now=time.time()
+
+        with transaction.manager:
+            return self.dbsession.query(SentRequestLog).filter(
+                SentRequestLog.time>datetime.fromtimestamp(now-self.window)
+            ).count()
+
+    def trip(self,cooldown=ogimet_cooldown):
+        # The rate limited SentRequestLog row opens the circuit breaker
+        pass
+
+    def circuit_until(self,now=None):
+
+        from ..models.cycling_models import SentRequestLog
+        import transaction
+
+        if now is None: now=time.time()
+
+        with transaction.manager:
+            last_rate_limited=self.dbsession.query(SentRequestLog.time).filter(
+                SentRequestLog.rate_limited==True,
+                SentRequestLog.time>datetime.fromtimestamp(now-ogimet_cooldown)
+            ).order_by(SentRequestLog.time.desc()).first()
+
+        if last_rate_limited is None:
+            return None
+
+        return last_rate_limited.time.timestamp()+ogimet_cooldown
+
+redis_limiter=None
+
+def get_rate_limiter(dbsession):
+
+    global redis_limiter
+
+    from ..celery import get_redis
+
+    redis=get_redis()
+
+    if redis is None:
+        return database_rate_limiter(dbsession)
+
+    if redis_limiter is None:
+        redis_limiter=redis_rate_limiter(redis)
+
+    return redis_limiter
@@ -0,0 +1,191 @@
+from celery.utils.log import get_task_logger
+
+from ..celery import celery
+
+logger = get_task_logger(__name__)
+
+# RideWeatherData rows written per bulk update
+recompute_write_batch_size=1000
+
+def ride_weather_stations(session):
+    """
+    Ids of the stations rides have weather from
+    """
+
+    from ..models.cycling_models import RideWeatherData
+
+    return [station_id for station_id, in session.query(
+        RideWeatherData.wx_station).filter(
+            RideWeatherData.wx_station!=None).distinct().order_by(
+                RideWeatherData.wx_station)]
+
+def station_rides(session,station_id):
+    """
+    Rides with weather from a station
+
+    Returns: List of (ride weather id, dtstart, dtend, altitude) tuples
+    """
+
+    from sqlalchemy.orm import joinedload
+    from ..models.cycling_models import Ride, RideWeatherData
+    from .weather import ride_times_utc, ride_altitude
+
+    rides=[]
+
+    for ride in session.query(Ride).join(
+            RideWeatherData,Ride.wxdata_id==RideWeatherData.id
+    ).options(
+        joinedload(Ride.startloc),joinedload(Ride.endloc)
+    ).filter(
+        RideWeatherData.wx_station==station_id
+    ).order_by(Ride.id):
+
+        if ride.startloc is None or ride.endloc is None:
+            continue
+
+        dtstart,dtend=ride_times_utc(ride)
+
+        if dtstart is None or dtend is None:
+            continue
+
+        rides.append((ride.wxdata_id,dtstart,dtend,ride_altitude(ride)))
+
+    return rides
+
+def station_observations(session,station_id,rides):
+    """
+    Stored observations of a station spanning a list of rides, loaded with
+    one query and bypassing the observation cache
+    """
+
+    from .weather import query_observations, metar_window_expansion
+
+    return query_observations(
+        session,station_id,
+        min(dtstart for wxdata_id,dtstart,dtend,altitude in rides)-metar_window_expansion,
+        max(dtend for wxdata_id,dtstart,dtend,altitude in rides)+metar_window_expansion)
+
+def compute_station_weather(records,rides):
+    """
+    Average the weather of a station's rides. Runs in a worker process.
+
+    Returns: List of RideWeatherData mappings for bulk_update_mappings.
+        Rides the observations don't span are left out.
+    """
+
+    import numpy as np
+    from .weather import average_rides_weather
+
+    averages=average_rides_weather(
+        records,[(dtstart,dtend,altitude)
+                 for wxdata_id,dtstart,dtend,altitude in rides])
+
+    mappings=[]
+
+    for (wxdata_id,dtstart,dtend,altitude),values in zip(rides,averages):
+
+        if values is None:
+            continue
+
+        mapping={key:(None if np.isnan(value) else float(value))
+                 for key,value in values.items()}
+        mapping['id']=wxdata_id
+
+        mappings.append(mapping)
+
+    return mappings
+
+def write_ride_weather(session,mappings,batch_size=recompute_write_batch_size):
+    """
+    Store recomputed ride weather with bulk updates, one transaction per
+    batch
+    """
+
+    import transaction
+    from zope.sqlalchemy import mark_changed
+    from ..models.cycling_models import RideWeatherData
+
+    for i in range(0,len(mappings),batch_size):
+        with transaction.manager:
+            session.bulk_update_mappings(RideWeatherData,mappings[i:i+batch_size])
+            # Bulk updates bypass the unit of work, so the transaction
+            # manager would not otherwise commit them
+            mark_changed(session)
+
+def recompute_station(session,station_id):
+    """
+    Recompute and store the weather of a station's rides
+
+    Returns: Number of rides updated
+    """
+
+    import transaction
+
+    with transaction.manager:
+        rides=station_rides(session,station_id)
+        if len(rides)==0:
+            return 0
+        records=station_observations(session,station_id,rides)
+
+    mappings=compute_station_weather(records,rides)
+
+    write_ride_weather(session,mappings)
+
+    return len(mappings)
+
+@celery.task(ignore_result=False)
+def recompute_station_weather(station_id):
+    """
+    Recompute the weather of every ride with weather from a station, from
+    stored observations only
+
+    Returns: Number of rides updated
+    """
+
+    from ..celery import session_factory
+
+    dbsession=session_factory()
+
+    updated=recompute_station(dbsession,station_id)
+
+    logger.info('Recomputed the weather of {} rides from station {}'.format(updated,station_id))
+
+    return updated
+
+@celery.task(ignore_result=False)
+def recompute_all_rides_weather():
+    """
+    Recompute the weather of every ride from stored observations, with one
+    task per station, and re-train the prediction model when finished
+    """
+
+    from celery import chord
+    from ..celery import session_factory
+    import transaction
+
+    dbsession=session_factory()
+
+    with transaction.manager:
+        station_ids=ride_weather_stations(dbsession)
+
+    if len(station_ids)==0:
+        return []
+
+    chord(
+        recompute_station_weather.s(station_id) for station_id in station_ids
+    )(recompute_finished.s())
+
+    return station_ids
+
+@celery.task(ignore_result=False)
+def recompute_finished(counts):
+
+    updated=sum(counts)
+
+    logger.info('Recomputed the weather of {} rides'.format(updated))
+
+    if updated>0:
+        from .regression import request_training
+        request_training()
+
+    return updated
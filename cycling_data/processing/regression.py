@@ -2,8 +2,6 @@ from ..celery import celery
 
 from celery.utils.log import get_task_logger
 
-from celery import group
-
 logger = get_task_logger(__name__)
 
 import transaction
@@ -13,117 +11,190 @@ from sqlalchemy.orm.exc import NoResultFound
 
 import numpy as np
 
-@celery.task(ignore_result=False)
-def train_model(predict_var='avspeed',epochs=None,patience=100):
+def training_due(dbsession,model_id):
+    """
+    Whether rides have changed since a model was last trained
+    """
 
-    from ..celery import session_factory, settings
-    from ..models import get_tm_session
-    from ..models.cycling_models import Ride, PredictionModel, PredictionModelResult
+    from ..models.cycling_models import Ride, PredictionModel
     from sqlalchemy import func
+
+    model=dbsession.query(PredictionModel).filter(
+        PredictionModel.id==model_id).one()
+
+    data_modified_date = dbsession.query(func.max(Ride.modified_date).label('last_modified')).one().last_modified
+
+    return (
+        model.modified_date is None
+        or model.weightsbuf is None
+        or data_modified_date is None
+        or data_modified_date > model.modified_date
+    )
+
+def fit_model(dbsession,model_id,predict_var,epochs=None,patience=100):
+    """
+    Train a model and record its predictions. The caller holds the model's
+    training lock.
+
+    Returns: Size of the training dataset
+    """
+
+    from ..celery import settings
+    from ..metrics import get_metrics
+    from ..models.cycling_models import PredictionModel, PredictionModelResult
     from ..models.prediction import get_data
-    from datetime import datetime
 
     if epochs is None:
         try:
             epochs=settings['celery.train_model_default_epochs']
-        except KeyError:
+        except (KeyError,TypeError):
             epochs=1000
 
-    logger.debug('Received train model task')
+    tm=transaction.manager
 
-    train_dataset_size=None
+    predict_columns=[predict_var]
 
-    if not(isinstance(predict_var,str)):
-        raise TypeError('predict_var should be a string, got {} (type {})'.format(predict_var, type(predict_var)))
+    with tm:
+        train_dataset=get_data(dbsession,predict_columns,tm=tm)
 
-    import transaction
+    if train_dataset is None:
+        raise ValueError('Empty training dataset')
 
-    dbsession=session_factory()
-    tm=transaction.manager
+    with tm, get_metrics().measure('model_training_seconds',predict_var=predict_var):
+        model=dbsession.query(PredictionModel).filter(
+            PredictionModel.id==model_id).one()
+        model.train(train_dataset,predict_columns,
+                    epochs=epochs,patience=patience)
+
+        train_dataset_size=model.train_dataset_size
 
     with tm:
+        model=dbsession.query(PredictionModel).filter(
+            PredictionModel.id==model_id).one()
+        predictions=model.predict(train_dataset)
+
+    for ride_id,prediction in zip(train_dataset['id'],predictions):
+        logger.debug('Recording regression result for ride {}'.format(ride_id))
+        with tm:
+            try:
+                ride_prediction=dbsession.query(PredictionModelResult).filter(
+                    PredictionModelResult.model_id==model_id,
+                    PredictionModelResult.ride_id==ride_id).one()
+            except NoResultFound:
+                ride_prediction=PredictionModelResult(
+                    model_id=model_id, ride_id=ride_id)
+
+            if predict_var=='avspeed':
+                ride_prediction.result=prediction[0] if not np.isnan(prediction[0]) else None
+
+            setattr(ride_prediction,predict_var,prediction[0] if not np.isnan(prediction[0]) else None)
+
+            dbsession.add(ride_prediction)
 
+    return train_dataset_size
+
+def get_model_id(dbsession,predict_var):
+
+    with transaction.manager:
         model=get_model(dbsession,predict_var)
         dbsession.flush()
-        model_id=model.id
+        return model.id
+
+@celery.task(ignore_result=False)
+def train_model(predict_var='avspeed',epochs=None,patience=100):
+    """
+    Train a model now if rides have changed since it was last trained and
+    no other worker is training it
+    """
+
+    from ..celery import session_factory
+    from .training_scheduler import get_training_scheduler
+
+    logger.debug('Received train model task')
+
+    if not(isinstance(predict_var,str)):
+        raise TypeError('predict_var should be a string, got {} (type {})'.format(predict_var, type(predict_var)))
 
-        if model.training_in_progress and model.modified_date > datetime.now() - timedelta(hours=1):
-            logger.debug('Training already in progress, exiting.')
-            return
+    dbsession=session_factory()
+    scheduler=get_training_scheduler()
 
-        data_modified_date = dbsession.query(func.max(Ride.modified_date).label('last_modified')).one().last_modified
+    model_id=get_model_id(dbsession,predict_var)
 
-        training_due=(
-            (
-                model.modified_date is None
-                or model.weightsbuf is None
-                or data_modified_date is None
-                or data_modified_date > model.modified_date
-            )
-            and not model.training_in_progress
-        )
+    with transaction.manager:
+        due=training_due(dbsession,model_id)
 
-    if not training_due:
+    if not due:
         logger.debug('Training is not due, exiting.')
+        return
 
-    if training_due:
+    token=scheduler.acquire(dbsession,model_id,predict_var)
 
-        with tm:
-            model=dbsession.query(PredictionModel).filter(
-                PredictionModel.id==model_id).one()
-            model.training_in_progress=True
+    if token is None:
+        logger.debug('Training already in progress, exiting.')
+        return
 
-        predict_columns=[predict_var]
+    try:
+        with scheduler.hold(dbsession,model_id,predict_var,token):
+            return fit_model(dbsession,model_id,predict_var,epochs,patience)
+    finally:
+        scheduler.release(dbsession,model_id,predict_var,token)
 
-        with tm:
-            train_dataset=get_data(dbsession,predict_columns,tm=tm)
+@celery.task(ignore_result=False)
+def scheduled_training(predict_var):
+    """
+    Train a model once its quiet period has ended. If another worker is
+    training the model, wait for it to finish. Triggers arriving meanwhile
+    are left to this task rather than scheduling another.
+    """
 
-        if train_dataset is None:
-            raise ValueError('Empty training dataset')
+    from ..celery import session_factory
+    from .training_scheduler import get_training_scheduler, training_retry_interval
 
-        try:
+    scheduler=get_training_scheduler()
 
-            with tm:
-                model=dbsession.query(PredictionModel).filter(
-                    PredictionModel.id==model_id).one()
-                model.train(train_dataset,predict_columns,
-                            epochs=epochs,patience=patience)
+    remaining=scheduler.quiet_remaining(predict_var)
 
-                train_dataset_size=model.train_dataset_size
+    if remaining>0:
+        scheduler.keep_scheduled(predict_var)
+        scheduled_training.apply_async((predict_var,),countdown=remaining)
+        return
 
-        finally:
-            with tm:
-                try:
-                    model=dbsession.query(PredictionModel).filter(
-                        PredictionModel.id==model_id).one()
-                except NoResultFound:
-                    pass
-                else:
-                    model.training_in_progress=False
+    dbsession=session_factory()
 
-        with tm:
-            model=dbsession.query(PredictionModel).filter(
-                PredictionModel.id==model_id).one()
-            predictions=model.predict(train_dataset)
+    model_id=get_model_id(dbsession,predict_var)
 
-        for ride_id,prediction in zip(train_dataset['id'],predictions):
-            logger.debug('Recording regression result for ride {}'.format(ride_id))
-            with tm:
-                try:
-                    ride_prediction=dbsession.query(PredictionModelResult).filter(
-                        PredictionModelResult.model_id==model_id,
-                        PredictionModelResult.ride_id==ride_id).one()
-                except NoResultFound:
-                    ride_prediction=PredictionModelResult(
-                        model_id=model_id, ride_id=ride_id)
+    token=scheduler.acquire(dbsession,model_id,predict_var)
 
-                if predict_var=='avspeed':
-                    ride_prediction.result=prediction[0] if not np.isnan(prediction[0]) else None
+    if token is None:
+        logger.debug('Training of {} in progress, retrying in {} s'.format(
+            predict_var,training_retry_interval))
+        scheduler.keep_scheduled(predict_var)
+        scheduled_training.apply_async((predict_var,),
+                                       countdown=training_retry_interval)
+        return
 
-                setattr(ride_prediction,predict_var,prediction[0] if not np.isnan(prediction[0]) else None)
+    try:
+        # Triggers from here on schedule a follow-up run. Rides changed
+        # while training may be older than the trained model, so the run is
+        # not skipped by comparing modification dates.
+        scheduler.unschedule(predict_var)
 
-                dbsession.add(ride_prediction)
+        with scheduler.hold(dbsession,model_id,predict_var,token):
+            return fit_model(dbsession,model_id,predict_var)
+    finally:
+        scheduler.release(dbsession,model_id,predict_var,token)
 
-    return train_dataset_size
+def request_training(predict_vars=predict_vars):
+    """
+    Ask for the models to be retrained because rides have changed. Requests
+    made within the quiet period of a model are coalesced into one run.
+    """
+
+    from .training_scheduler import get_training_scheduler
+
+    scheduler=get_training_scheduler()
 
-train_all_models=group(train_model.s(var) for var in predict_vars)
+    for predict_var in predict_vars:
+        if scheduler.trigger(predict_var):
+            scheduled_training.apply_async((predict_var,),
+                                           countdown=scheduler.quiet_period)
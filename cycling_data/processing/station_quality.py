@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta, time
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Weight kept by earlier fetches each time a station is fetched again
+fetch_outcome_decay=0.8
+
+# Weight of the latest fetch in a station's typical reporting interval
+report_interval_weight=0.3
+
+# A day without reports that could still get some is trusted to stay empty
+# for this long
+negative_cache_ttl=timedelta(hours=1)
+
+# Gaps in coverage shorter than this don't keep a day from being counted
+coverage_tolerance=timedelta(minutes=1)
+
+def utc_days(dtstart,dtend):
+    """
+    UTC days touched by an interval
+    """
+
+    from .coverage import to_naive_utc
+
+    dtstart=to_naive_utc(dtstart)
+    dtend=to_naive_utc(dtend)
+
+    days=[]
+    day=dtstart.date()
+
+    while True:
+        days.append(day)
+        day=day+timedelta(1)
+        if datetime.combine(day,time())>=dtend:
+            break
+
+    return days
+
+def record_report_days(session,station_id,dtstart,dtend,now=None):
+    """
+    Count the stored reports of each day touched by an interval, for the
+    days that are over and whose reports have all been fetched
+    """
+
+    from ..models.cycling_models import StationWeatherData, StationReportDay
+    from .coverage import coverage_gaps, final_delay, to_naive_utc
+
+    if now is None: now=datetime.utcnow()
+
+    dtstart=to_naive_utc(dtstart)
+    dtend=to_naive_utc(dtend)
+
+    days=[]
+
+    for day in utc_days(dtstart,dtend):
+
+        day_start=datetime.combine(day,time())
+        day_end=day_start+timedelta(1)
+
+        if day_end>now:
+            continue
+
+        # Days only partly in the interval may have been fetched before
+        if day_start<dtstart or day_end>dtend:
+            gaps=coverage_gaps(session,station_id,day_start,day_end,now)
+            if any(gap_end-gap_start>coverage_tolerance for gap_start,gap_end in gaps):
+                continue
+
+        days.append(day)
+
+    if len(days)==0:
+        return
+
+    counts=dict.fromkeys(days,0)
+
+    for report_time, in session.query(StationWeatherData.report_time).filter(
+            StationWeatherData.wx_station==station_id,
+            StationWeatherData.report_time>=datetime.combine(days[0],time()),
+            StationWeatherData.report_time<datetime.combine(days[-1],time())+timedelta(1)):
+        day=report_time.date()
+        if day in counts:
+            counts[day]+=1
+
+    existing={row.day:row for row in session.query(StationReportDay).filter(
+        StationReportDay.station_id==station_id,
+        StationReportDay.day.in_(days))}
+
+    for day,reports in counts.items():
+        row=existing.get(day)
+        if row is None:
+            row=StationReportDay(station_id=station_id,day=day)
+            session.add(row)
+        row.reports=reports
+        row.checked=now
+        row.final=datetime.combine(day,time())+timedelta(1)<=now-final_delay
+
+def record_fetch(session,station_id,dtstart,dtend,report_times,fetch_time=None):
+    """
+    Update a station's record after fetching its reports for an interval
+
+    report_times: Times of the reports the fetch returned
+    """
+
+    from ..models.cycling_models import StationQuality
+
+    if fetch_time is None: fetch_time=datetime.utcnow()
+
+    report_times=sorted(set(t for t in report_times if t is not None))
+
+    quality=session.query(StationQuality).filter(
+        StationQuality.station_id==station_id).first()
+
+    if quality is None:
+        quality=StationQuality(station_id=station_id,recent_fetches=0,
+                               recent_empty_fetches=0)
+        session.add(quality)
+
+    quality.recent_fetches=quality.recent_fetches*fetch_outcome_decay+1
+    quality.recent_empty_fetches=quality.recent_empty_fetches*fetch_outcome_decay \
+        +(1 if len(report_times)==0 else 0)
+    quality.last_fetch=fetch_time
+    quality.last_fetch_reports=len(report_times)
+
+    if len(report_times)>0 and (quality.last_report is None
+                                or report_times[-1]>quality.last_report):
+        quality.last_report=report_times[-1]
+
+    if len(report_times)>1:
+        intervals=sorted((t1-t0).total_seconds()
+                         for t0,t1 in zip(report_times[:-1],report_times[1:]))
+        interval=intervals[len(intervals)//2]
+        if quality.report_interval is None:
+            quality.report_interval=interval
+        else:
+            quality.report_interval=quality.report_interval*(1-report_interval_weight) \
+                +interval*report_interval_weight
+
+    record_report_days(session,station_id,dtstart,dtend,fetch_time)
+
+def expected_coverage(quality,report_days,days,window_expansion,now=None):
+    """
+    Estimated chance that a station's reports cover an interval
+
+    quality: StationQuality of the station, or None if it has never been
+        fetched
+    report_days: dict mapping days to the station's StationReportDay rows
+    days: UTC days touched by the interval
+    window_expansion: How far before and after the interval a report may be
+
+    Returns: Number between 0 and 1, 0 if the station is known to have no
+        reports for one of the days
+    """
+
+    if now is None: now=datetime.utcnow()
+
+    # Share of recent fetches that returned reports, starting from even odds
+    if quality is None:
+        success=0.5
+    else:
+        success=(quality.recent_fetches-quality.recent_empty_fetches+1) \
+            /(quality.recent_fetches+2)
+
+    expected=1.
+
+    for day in days:
+        row=report_days.get(day)
+        if row is None:
+            expected=min(expected,success)
+        elif row.reports>0:
+            continue
+        elif row.final or now-row.checked<negative_cache_ttl:
+            return 0.
+        else:
+            expected=min(expected,success)
+
+    # Reports further apart than the window expansion may miss either end
+    if quality is not None and quality.report_interval:
+        expected*=min(1.,window_expansion.total_seconds()/quality.report_interval)**2
+
+    return expected
+
+def rank_stations(session,stations,dtstart,dtend,window_expansion,now=None):
+    """
+    Order weather stations by how likely their reports are to cover an
+    interval, leaving out stations known to have none. Stations with
+    similar prospects keep their original order.
+    """
+
+    from ..models.cycling_models import StationQuality, StationReportDay
+
+    if len(stations)==0:
+        return []
+
+    if now is None: now=datetime.utcnow()
+
+    station_ids=[station.id for station in stations]
+    days=utc_days(dtstart,dtend)
+
+    qualities={quality.station_id:quality for quality in session.query(
+        StationQuality).filter(StationQuality.station_id.in_(station_ids))}
+
+    report_days={}
+    for row in session.query(StationReportDay).filter(
+            StationReportDay.station_id.in_(station_ids),
+            StationReportDay.day.in_(days)):
+        report_days.setdefault(row.station_id,{})[row.day]=row
+
+    ranked=[]
+
+    for index,station in enumerate(stations):
+
+        expected=expected_coverage(qualities.get(station.id),
+                                   report_days.get(station.id,{}),
+                                   days,window_expansion,now)
+
+        if expected==0:
+            logger.info('Skipping {}, which has no reports for {} - {}'.format(station.name,dtstart,dtend))
+            continue
+
+        ranked.append((-round(expected,1),index,station))
+
+    ranked.sort(key=lambda item: item[:2])
+
+    return [station for score,index,station in ranked]
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import threading
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Number of stations kept by each worker
+station_cache_size=2048
+
+class station_registry(object):
+    """
+    Per-worker cache mapping ICAO identifiers to weather station Location
+    ids, evicting the least recently used stations when full.
+
+    Only stations that exist are cached, so adding a Location never leaves
+    a stale entry behind. When an edit or deletion of a Location is
+    committed, its entry is dropped and, if Redis is available, a shared
+    version counter is incremented so that every other worker clears its
+    cache on its next lookup (see location_changed).
+    """
+
+    version_key='station_registry:version'
+
+    def __init__(self,maxsize=station_cache_size,redis=None):
+        self.maxsize=maxsize
+        self.redis=redis
+        self.lock=threading.Lock()
+        self.stations=OrderedDict()
+        self.version=None
+        self.hits=0
+        self.misses=0
+
+    def check_version(self):
+        """
+        Clear the cache if another worker has invalidated it
+        """
+
+        if self.redis is None:
+            return
+
+        version=self.redis.get(self.version_key)
+
+        with self.lock:
+            if version!=self.version:
+                self.stations.clear()
+                self.version=version
+
+    def get(self,name):
+
+        with self.lock:
+            try:
+                location_id=self.stations[name]
+            except KeyError:
+                self.misses+=1
+                return None
+            self.stations.move_to_end(name)
+            self.hits+=1
+            return location_id
+
+    def add(self,name,location_id):
+
+        with self.lock:
+            self.stations[name]=location_id
+            self.stations.move_to_end(name)
+            while len(self.stations)>self.maxsize:
+                self.stations.popitem(last=False)
+
+    def discard(self,name):
+
+        with self.lock:
+            self.stations.pop(name,None)
+
+    def clear(self):
+
+        with self.lock:
+            self.stations.clear()
+
+    def resolve(self,session,names):
+        """
+        Look up the Location ids of weather stations, querying the database
+        once for all stations not already cached.
+
+        Returns: dict mapping station names to Location ids. Stations not in
+            the database are left out.
+        """
+
+        from ..models.cycling_models import Location
+
+        self.check_version()
+
+        names=set(names)
+        resolved={}
+
+        for name in names:
+            location_id=self.get(name)
+            if location_id is not None:
+                resolved[name]=location_id
+
+        missing=names-set(resolved)
+
+        if len(missing)>0:
+            for name,location_id in session.query(
+                    Location.name,Location.id).filter(
+                        Location.name.in_(missing),
+                        Location.loctype_id==2):
+                self.add(name,location_id)
+                resolved[name]=location_id
+
+        return resolved
+
+    def warm(self,session):
+        """
+        Fill the cache with the stations that most recently reported
+        """
+
+        from ..models.cycling_models import Location, StationWeatherData
+        from sqlalchemy import func
+
+        self.check_version()
+
+        last_report=func.max(StationWeatherData.report_time)
+
+        stations=session.query(Location.name,Location.id).join(
+            StationWeatherData,StationWeatherData.wx_station==Location.id
+        ).filter(
+            Location.loctype_id==2
+        ).group_by(Location.id,Location.name).order_by(
+            last_report.desc()
+        ).limit(self.maxsize).all()
+
+        # Add the least recent first so the most recent are evicted last
+        for name,location_id in reversed(stations):
+            self.add(name,location_id)
+
+        logger.info('Loaded {} weather stations into the station registry'.format(len(stations)))
+
+def get_station_registry():
+
+    from .worker_context import get_worker_context
+
+    return get_worker_context().stations
+
+def location_changed(names):
+    """
+    Invalidate registry entries for a Location whose name or type changed,
+    or that was deleted. Called after the change is committed, also from
+    the web application, so it doesn't build a worker context.
+
+    names: Names the location had before and after the change
+    """
+
+    from . import worker_context
+    from ..celery import get_redis
+
+    names=[name for name in names if name is not None]
+
+    # Only a registry this process has already built needs updating
+    context=worker_context.context
+    if context is not None:
+        for name in names:
+            context.stations.discard(name)
+
+    client=get_redis()
+
+    if client is None:
+        return
+
+    import redis.exceptions
+
+    try:
+        client.incr(station_registry.version_key)
+    except redis.exceptions.RedisError as e:
+        logger.warning('Could not invalidate the station registries of other workers: {}'.format(e))
@@ -0,0 +1,289 @@
+from datetime import timedelta
+import threading
+import time
+import uuid
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Training starts once no new data has arrived for this many seconds
+training_quiet_period=300
+
+# A training lock is taken over after this many seconds in case a worker
+# dies mid-training. Workers renew their lock while training, every
+# training_lock_ttl*training_lock_renewal seconds.
+training_lock_ttl=3600
+training_lock_renewal=1/3.
+
+# Seconds a queued follow-up waits before checking the lock again
+training_retry_interval=60
+
+# Release the lock only if it is still held by the given token
+release_script="""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extend the lock only if it is still held by the given token
+renew_script="""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class training_scheduler(object):
+    """
+    Coordinates retraining of the prediction models.
+
+    Requests for a model within its quiet period are coalesced into one
+    scheduled run. A model is trained by at most one worker at a time,
+    holding a lock on it, and at most one more run is queued behind it.
+
+    With Redis the trigger times, scheduled runs and locks are shared by
+    all workers. Without it, triggers are only coalesced within a process,
+    and the lock is the model's training_in_progress flag and
+    training_lock token, taken with a single conditional UPDATE.
+    """
+
+    key_prefix='model_training'
+
+    def __init__(self,redis=None,quiet_period=training_quiet_period,
+                 lock_ttl=training_lock_ttl):
+        self.redis=redis
+        self.quiet_period=quiet_period
+        self.lock_ttl=lock_ttl
+        self.lock=threading.Lock()
+        self.local_triggers={}
+        self.local_scheduled=set()
+
+        if self.redis is not None:
+            self.release_script=self.redis.register_script(release_script)
+            self.renew_script=self.redis.register_script(renew_script)
+
+    def key(self,kind,predict_var):
+        return '{}:{}:{}'.format(self.key_prefix,kind,predict_var)
+
+    def trigger(self,predict_var,now=None):
+        """
+        Record new data for a model.
+
+        Returns: True if no run of the model is scheduled yet and the caller
+            should schedule one
+        """
+
+        if now is None: now=time.time()
+
+        if self.redis is not None:
+            # The scheduled flag expires in case its task is lost. Each
+            # trigger moves the end of the quiet period, so it also extends
+            # the flag.
+            pipe=self.redis.pipeline()
+            pipe.set(self.key('trigger',predict_var),now)
+            pipe.set(self.key('scheduled',predict_var),now,nx=True,
+                     px=self.scheduled_ttl())
+            pipe.pexpire(self.key('scheduled',predict_var),self.scheduled_ttl())
+            return bool(pipe.execute()[1])
+
+        with self.lock:
+            self.local_triggers[predict_var]=now
+            if predict_var in self.local_scheduled:
+                return False
+            self.local_scheduled.add(predict_var)
+            return True
+
+    def scheduled_ttl(self):
+        """
+        Milliseconds a scheduled run stays recorded without being renewed
+        """
+
+        return int((self.quiet_period+self.lock_ttl)*1000)
+
+    def keep_scheduled(self,predict_var):
+        """
+        Renew the record of a scheduled run whose task is being requeued
+        """
+
+        if self.redis is not None:
+            self.redis.pexpire(self.key('scheduled',predict_var),self.scheduled_ttl())
+
+    def quiet_remaining(self,predict_var,now=None):
+        """
+        Seconds until a model's quiet period ends
+        """
+
+        if now is None: now=time.time()
+
+        if self.redis is not None:
+            last=self.redis.get(self.key('trigger',predict_var))
+            last=float(last) if last is not None else None
+        else:
+            with self.lock:
+                last=self.local_triggers.get(predict_var)
+
+        if last is None:
+            return 0
+
+        return max(0,last+self.quiet_period-now)
+
+    def unschedule(self,predict_var):
+        """
+        Let the next trigger schedule a new run
+        """
+
+        if self.redis is not None:
+            self.redis.delete(self.key('scheduled',predict_var))
+        else:
+            with self.lock:
+                self.local_scheduled.discard(predict_var)
+
+    def acquire(self,dbsession,model_id,predict_var):
+        """
+        Try to take the training lock of a model
+
+        Returns: A token to pass to release(), or None if the model is being
+            trained
+        """
+
+        token=uuid.uuid4().hex
+
+        if self.redis is not None:
+            acquired=self.redis.set(self.key('lock',predict_var),token,
+                                    nx=True,px=int(self.lock_ttl*1000))
+            return token if acquired else None
+
+        import transaction
+        from sqlalchemy import or_, func
+        from zope.sqlalchemy import mark_changed
+        from ..models.cycling_models import PredictionModel
+
+        with transaction.manager:
+            # modified_date is set by the database server, so the lock's age
+            # is measured by the server's clock
+            server_now=dbsession.query(func.now()).scalar()
+            acquired=dbsession.query(PredictionModel).filter(
+                PredictionModel.id==model_id,
+                or_(PredictionModel.training_in_progress==None,
+                    PredictionModel.training_in_progress==False,
+                    PredictionModel.modified_date_<server_now-timedelta(seconds=self.lock_ttl))
+            ).update({PredictionModel.training_in_progress:True,
+                      PredictionModel.training_lock:token},
+                     synchronize_session=False)
+            mark_changed(dbsession)
+
+        return token if acquired==1 else None
+
+    def renew(self,dbsession,model_id,predict_var,token):
+        """
+        Restart the time to live of a training lock still held under token
+
+        Returns: True if the lock is still held
+        """
+
+        if self.redis is not None:
+            return bool(self.renew_script(keys=[self.key('lock',predict_var)],
+                                          args=[token,int(self.lock_ttl*1000)]))
+
+        import transaction
+        from zope.sqlalchemy import mark_changed
+        from ..models.cycling_models import PredictionModel
+
+        # The update sets modified_date, from which the lock's age is measured
+        with transaction.manager:
+            renewed=dbsession.query(PredictionModel).filter(
+                PredictionModel.id==model_id,
+                PredictionModel.training_lock==token
+            ).update({PredictionModel.training_in_progress:True},
+                     synchronize_session=False)
+            mark_changed(dbsession)
+
+        return renewed==1
+
+    def hold(self,dbsession,model_id,predict_var,token):
+        """
+        Context manager renewing a training lock while its block runs
+        """
+
+        return lock_renewer(self,dbsession,model_id,predict_var,token)
+
+    def release(self,dbsession,model_id,predict_var,token):
+        """
+        Release a training lock, unless it has been taken over since it was
+        acquired under token
+        """
+
+        if self.redis is not None:
+            self.release_script(keys=[self.key('lock',predict_var)],args=[token])
+            return
+
+        import transaction
+        from zope.sqlalchemy import mark_changed
+        from ..models.cycling_models import PredictionModel
+
+        with transaction.manager:
+            dbsession.query(PredictionModel).filter(
+                PredictionModel.id==model_id,
+                PredictionModel.training_lock==token
+            ).update({PredictionModel.training_in_progress:False,
+                      PredictionModel.training_lock:None},
+                     synchronize_session=False)
+            mark_changed(dbsession)
+
+class lock_renewer(object):
+    """
+    Renews a training lock from a background thread. Without Redis the
+    thread uses its own database session.
+    """
+
+    def __init__(self,scheduler,dbsession,model_id,predict_var,token):
+        self.scheduler=scheduler
+        self.dbsession=dbsession
+        self.model_id=model_id
+        self.predict_var=predict_var
+        self.token=token
+        self.stopped=threading.Event()
+        self.thread=None
+
+    def run(self):
+
+        import zope.sqlalchemy
+        from sqlalchemy.orm import Session
+
+        interval=self.scheduler.lock_ttl*training_lock_renewal
+
+        session=None
+
+        if self.scheduler.redis is None:
+            session=Session(bind=self.dbsession.get_bind())
+            zope.sqlalchemy.register(session)
+
+        try:
+            while not self.stopped.wait(interval):
+                try:
+                    if not self.scheduler.renew(session,self.model_id,
+                                                self.predict_var,self.token):
+                        logger.warning('Training lock of {} was taken over'.format(self.predict_var))
+                        return
+                except Exception as e:
+                    logger.warning('Could not renew the training lock of {}: {}'.format(self.predict_var,e))
+        finally:
+            if session is not None:
+                session.close()
+
+    def __enter__(self):
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.stopped.set()
+        self.thread.join()
+
+def get_training_scheduler():
+
+    from .worker_context import get_worker_context
+
+    return get_worker_context().training
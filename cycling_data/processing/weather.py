@@ -1,10 +1,12 @@
-from ..models.cycling_models import Ride, WeatherData, StationWeatherData, RideWeatherData, Location, SentRequestLog, WeatherFetchLog
+from ..models.cycling_models import Ride, WeatherData, StationWeatherData, RideWeatherData, Location, SentRequestLog, WeatherFetchLog, weather_to_numeric
 from metar import Metar
 from datetime import datetime, timedelta
 from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 from ..celery import celery
+from ..metrics import get_metrics, timed
 
+from celery.exceptions import Retry
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
@@ -17,6 +19,19 @@ from time import sleep
 
 update_weather_group_max=50
 
+# How far before and after a ride to look for weather reports
+metar_window_expansion=timedelta(hours=4)
+
+# A ride's window is covered once reports have been fetched for this many
+# of the station's reporting intervals before and after it
+bracket_intervals=2
+
+# Number of downloaded METARs stored per transaction
+metar_store_batch_size=500
+
+# Attempts to store a batch of METARs that conflicts with concurrent inserts
+metar_store_attempts=3
+
 def random_delay(min_delay=1,random_scale=None):
 
     import random
@@ -33,181 +48,350 @@ def random_delay(min_delay=1,random_scale=None):
     return min_delay+min(random.lognormvariate(log(random_scale),1),random_max)
 
 
-def fetch_metars(station,dtstart,dtend,url='https://www.ogimet.com/display_metars2.php'):
-
-    params={
-        'lang':'en',
-        'lugar':station,
-        'tipo':'ALL',
-        'ord':'DIR',
-        'nil':'NO',
-        'fmt':'txt',
-        'ano':dtstart.year,
-        'mes':'{:02d}'.format(dtstart.month),
-        'day':'{:02d}'.format(dtstart.day),
-        'hora':'{:02d}'.format(dtstart.hour),
-        'anof':dtend.year,
-        'mesf':'{:02d}'.format(dtend.month),
-        'dayf':'{:02d}'.format(dtend.day),
-        'horaf':'{:02d}'.format(dtend.hour),
-        'minf':'{:02d}'.format(dtend.minute),
-        'send':'send'
-    }
+@timed('weather_fetch_seconds')
+def fetch_metars(station,dtstart,dtend,url='https://www.ogimet.com/display_metars2.php',session=None):
 
-    r=requests.get(url,params=params)
+    from .async_fetch import ogimet_params, ogimet_get
+    from .worker_context import get_worker_context
 
-    r.raise_for_status()
+    if session is None:
+        session=get_worker_context().http_session
 
-    return r
+    # Stream the response so it can be parsed without holding the whole
+    # body in memory
+    return ogimet_get(session,url,ogimet_params(station,dtstart,dtend),
+                      'single',stream=True)
 
 def extract_metars_from_ogimet(text):
 
+    import io
+    from .ogimet_parser import iter_metars_from_ogimet
+
     dates=[]
     metars=[]
 
-    while True:
+    for date,metar in iter_metars_from_ogimet(io.StringIO(text)):
+        dates.append(date)
+        metars.append(metar)
 
-        # Find next METAR
-        head,sep,text=text.partition('=\n')
+    return dates,metars
 
-        # Check whether we reached the end of the string
-        if len(head)==0: break
+def parse_metar_code(date,metar_code):
+    """
+    Parse a METAR code reported at the given date
 
-        # Skip comments and empty lines
-        if head.startswith('#') or head.startswith('\n'):
-            head,sep,text=text.partition('\n')
+    Returns: (metar, parse_error) tuple
+    """
 
-        # Parse METAR
-        if head[:12].isdigit():
-            date=datetime.strptime(head[:12],'%Y%m%d%H%M%S')
-            dates.append(date)
-            metar=head[13:]
-            if(metar.endswith('$')): metar=metar[:-1]
-            if metar.startswith('METAR') or metar.startswith('SPECI'):
-                metars.append(metar)
+    try:
+        metar=Metar.Metar(
+            metar_code,year=date.year,month=date.month,utcdelta=0)
+    except Metar.ParserError:
+        # Try parsing with strict=False
+        metar=Metar.Metar(
+            metar_code,year=date.year,month=date.month,utcdelta=0,
+            strict=False)
+        parse_error=True
+    else:
+        parse_error=False
 
-    return dates,metars
+    return metar,parse_error
 
-def check_ogimet_request_rate(dbsession,task=None):
+def check_ogimet_request_rate(dbsession,token,task=None,slow_query=True):
+    """
+    Wait for permission to send an OGIMET request.
 
-    import random
-    import transaction
-    from pytz import utc
+    Slow queries reserve the next free slot in the shared request budget. If
+    that slot is in the future the task is retried exactly when the slot
+    comes due; the reservation is kept under token, so the retried task
+    finds it again. Other queries reserve the nearest slot a few seconds
+    from any other request, which the caller waits for. All queries are
+    refused while the circuit breaker is open.
 
-    tm=transaction.manager
+    Returns: Time (seconds since the epoch) to send the request at
+    """
 
-    with tm:
-        try:
-            last_request=dbsession.query(SentRequestLog).order_by(SentRequestLog.time.desc()).first()
-        except NoResultFound:
-            last_request=None
-        recent_request_count=dbsession.query(SentRequestLog).filter(
-                SentRequestLog.time>datetime.now()-timedelta(seconds=3600*2)).count()
+    import time
+    from .ratelimit import get_rate_limiter, slot_tolerance
 
-    min_delay_seconds=60*5
-    random_delay_scale=60*2
-    retry_delay=random_delay(min_delay_seconds,random_delay_scale)
+    limiter=get_rate_limiter(dbsession)
 
-    rate_limited_retry_delay=random_delay(3600*1,3600*1)
+    now=time.time()
 
-    if last_request is not None and (datetime.now()-last_request.time).total_seconds() < rate_limited_retry_delay and last_request.rate_limited:
-        raise RuntimeError('Last OGIMET request was {} minutes ago and was rate limited'.format((datetime.now()-last_request.time).total_seconds()/60))
+    circuit_until=limiter.circuit_until(now)
 
-    if recent_request_count>=55:
-        if task is not None:
-            raise task.retry(
-                exc=RuntimeError('Too many recent OGIMET queries. Retrying in {} seconds'.format(retry_delay)),countdown=retry_delay)
-        else:
-            raise RuntimeError('Too many recent OGIMET queries.')
+    metrics=get_metrics()
 
-    if last_request is not None and \
-       (datetime.now()-last_request.time).total_seconds() < min_delay_seconds:
+    if circuit_until is not None:
+        metrics.inc('ogimet_rate_limiter_total',outcome='circuit_open')
+        e=RuntimeError('Last OGIMET request was rate limited, not sending requests until {}'.format(datetime.fromtimestamp(circuit_until)))
         if task is not None:
-            raise task.retry(
-                exc=RuntimeError('Too soon since last OGIMET query. Retrying in {} seconds'.format(retry_delay)),countdown=retry_delay)
+            raise task.retry(exc=e,eta=datetime.utcfromtimestamp(circuit_until))
         else:
-            raise RuntimeError('Too soon since last OGIMET query.')
+            raise e
+
+    if not slow_query:
+        slot=limiter.reserve_fast(token,now)
+        if slot is None:
+            metrics.inc('ogimet_rate_limiter_total',outcome='circuit_open')
+            raise RuntimeError('Last OGIMET request was rate limited')
+        metrics.inc('ogimet_rate_limiter_total',outcome='spaced')
+        return slot
+
+    slot=limiter.reserve(token,now)
+
+    if slot is None:
+        metrics.inc('ogimet_rate_limiter_total',outcome='circuit_open')
+        raise RuntimeError('Last OGIMET request was rate limited')
+
+    if slot-now>slot_tolerance:
+        metrics.inc('ogimet_rate_limiter_total',outcome='deferred')
+        e=RuntimeError('Too soon since last OGIMET query. Retrying in {} seconds'.format(slot-now))
+        try:
+            if task is not None:
+                raise task.retry(exc=e,eta=datetime.utcfromtimestamp(slot))
+            else:
+                raise e
+        except Retry:
+            raise
+        except Exception:
+            # The task is out of retries or there is none, so nobody will
+            # come back for the slot. Release it.
+            limiter.cancel(token)
+            raise
+
+    limiter.consume(token,now)
+    metrics.inc('ogimet_rate_limiter_total',outcome='allowed')
+
+    return now
 
 def parse_and_store_metars(metars,session=None):
+    """
+    Store parsed METARs, skipping reports that are already stored.
 
-    import transaction
+    metars: Iterable of (metar, parse_error) tuples
 
-    tm=transaction.manager
+    Returns: StationWeatherData objects in the same order as metars
+    """
+
+    from ..models.cycling_models import metar_fields
 
-    stored_metars=[]
+    reports=[]
 
     for metar,parse_error in metars:
-        wxdata=StationWeatherData(session,obs=metar,parse_error=parse_error)
-
-        q=session.query(StationWeatherData).filter(
-            StationWeatherData.station==wxdata.station
-        ).filter(
-            StationWeatherData.report_time==wxdata.report_time
-        ).filter(
-            StationWeatherData.metar==wxdata.metar
-        )
-
-        if q.count()>=1:
-            wxdata=q.first()
-        else:
-            with tm:
-                session.add(wxdata)
-        stored_metars.append(wxdata)
+        fields=metar_fields(metar)
+        fields['parse_error']=parse_error
+        reports.append((metar.station_id,fields))
 
-    return stored_metars
+    return store_metar_fields(reports,session)
 
-def download_metars(station,dtstart,dtend,dbsession=None,task=None):
+def store_metar_fields(reports,session,registry=None,reload=True):
+    """
+    Store reports given as StationWeatherData attribute values (see
+    metar_fields), skipping reports that are already stored.
+
+    Stored reports are matched by content hash with one query per batch,
+    stations are resolved through the station registry, and the new
+    reports are inserted in a single flush. If another worker inserts one
+    of the same reports first, the unique index on metar_hash rejects the
+    batch and it is retried against the updated table.
+
+    reports: List of (station name, fields) tuples
+    reload: Whether to load newly stored reports again after committing
+        them. Without this the new objects in the result are expired.
+
+    Returns: StationWeatherData objects in the same order as reports
+    """
 
-    import random
     import transaction
+    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.orm import joinedload
+    from .stations import get_station_registry
+    from .observation_cache import reports_stored
+
+    tm=transaction.manager
+
+    if registry is None:
+        registry=get_station_registry()
+
+    if len(reports)==0:
+        return []
+
+    hashes=[fields['metar_hash'] for station_name,fields in reports]
+
+    def lookup(hashes):
+        return {
+            wxdata.metar_hash:wxdata for wxdata in
+            session.query(StationWeatherData).options(
+                joinedload(StationWeatherData.station)
+            ).filter(StationWeatherData.metar_hash.in_(set(hashes)))
+        }
+
+    for attempt in range(metar_store_attempts):
+
+        stored=lookup(hashes)
+
+        station_ids=registry.resolve(
+            session,set(station_name for station_name,fields in reports))
+        new_stations={}
+
+        new_metars={}
+
+        for station_name,fields in reports:
+
+            wx_hash=fields['metar_hash']
+
+            if wx_hash in stored or wx_hash in new_metars: continue
+
+            if station_name in station_ids:
+                station_args={'wx_station':station_ids[station_name]}
+            else:
+                if station_name not in new_stations:
+                    new_stations[station_name]=Location(
+                        name=station_name,loctype_id=2)
+                station_args={'station':new_stations[station_name]}
+
+            new_metars[wx_hash]=StationWeatherData(**fields,**station_args)
+
+        if len(new_metars)>0:
+            try:
+                with tm:
+                    session.add_all(new_metars.values())
+                    session.flush()
+                    new_station_ids=[(name,location.id) for name,location
+                                     in new_stations.items()]
+                    new_reports=[(wxdata.wx_station,wxdata.report_time)
+                                 for wxdata in new_metars.values()]
+            except IntegrityError:
+                if attempt+1>=metar_store_attempts:
+                    raise
+                logger.info('Duplicate METARs stored concurrently, retrying batch')
+
+                # A cached station may also have been deleted
+                for name in station_ids:
+                    registry.discard(name)
+
+                continue
+
+            for name,location_id in new_station_ids:
+                registry.add(name,location_id)
+
+            reports_stored(new_reports)
+
+            if reload:
+                # Committing expires the new rows, so load them again
+                stored.update(lookup(new_metars.keys()))
+            else:
+                stored.update(new_metars)
+
+        return [stored[wx_hash] for wx_hash in hashes]
+
+def is_slow_query(dtstart):
+    """
+    Whether OGIMET treats a query starting at dtstart as a slow query
+    """
+
+    from pytz import utc
+
+    return (datetime.utcnow().replace(tzinfo=utc)-dtstart).days > 84
+
+def get_ogimet_url():
+
+    from .worker_context import get_worker_context
+
+    return get_worker_context().ogimet_url
+
+def check_download_interval(dtstart,dtend):
+
     from pytz import utc
-    from sqlite3 import Connection as sqliteConnection
+    from .fetch_planner import ogimet_max_request_span
 
     dtstart=dtstart.astimezone(utc)
     dtend=dtend.astimezone(utc)
 
-    if dtstart.day!=dtend.day:
-        raise ValueError('dtstart and dtend must be different times on the same day')
-
     if dtend<=dtstart:
         raise ValueError('dtend must be greater than dtstart')
 
-    logger.info('Downloading METARS for {}, {} - {}'.format(station.name,dtstart,dtend))
+    if dtend-dtstart>ogimet_max_request_span:
+        raise ValueError('Requested interval {} - {} is longer than the maximum OGIMET request span ({})'.format(dtstart,dtend,ogimet_max_request_span))
 
-    slow_query=((datetime.utcnow().replace(tzinfo=utc)-dtstart).days > 84)
+    return dtstart,dtend
 
-    tm=transaction.manager
+def ogimet_request_token(station_id,dtstart,dtend,task=None):
+    """
+    Identifies a request's rate limiter reservation across task retries
+    """
 
-    from pyramid.paster import bootstrap
-    try:
-        settings = bootstrap('/run/secrets/production.ini')['registry'].settings
-        ogimet_url=settings['ogimet_url']
-    except:
-        ogimet_url='https://www.ogimet.com/display_metars2.php'
+    import uuid
 
-    conn=dbsession.bind
+    return '{}:{}:{}:{}'.format(
+        task.request.id if task is not None else uuid.uuid4().hex,
+        station_id,dtstart.isoformat(),dtend.isoformat())
 
-    try:
+def begin_ogimet_request(dbsession,station_id,dtstart,dtend,task=None,slow_query=True,token=None):
+    """
+    Wait for the rate limiter to allow a request and log it
 
-        if conn.dialect.name!='sqlite':
-            conn.execute('LOCK TABLES sent_request_log WRITE')
+    Returns: SentRequestLog for the request and the time (seconds since the
+        epoch) to send it at
+    """
 
-        if slow_query:
-            # Check past ogimet requests to avoid hitting rate limits
-            check_ogimet_request_rate(dbsession,task)
+    import transaction
 
-        with tm:
-            requestlog=SentRequestLog(time=datetime.now())
+    tm=transaction.manager
+
+    if token is None:
+        token=ogimet_request_token(station_id,dtstart,dtend,task)
+
+    # Check past ogimet requests to avoid hitting rate limits
+    send_time=check_ogimet_request_rate(dbsession,token,task,slow_query)
+
+    with tm:
+        requestlog=dbsession.query(SentRequestLog).filter(
+            SentRequestLog.reservation==token).first()
+        if requestlog is None:
+            requestlog=SentRequestLog()
             dbsession.add(requestlog)
+        requestlog.time=datetime.fromtimestamp(send_time)
+        requestlog.reservation=None
 
-    finally:
-        if conn.dialect.name!='sqlite':
-            conn.execute('UNLOCK TABLES')
-        pass
+    return requestlog,send_time
 
-    # Download METARs
-    ogimet_result=fetch_metars(station.name,dtstart,dtend,url=ogimet_url)
-    ogimet_text=ogimet_result.text
+def cancel_ogimet_request(dbsession,requestlog,token):
+    """
+    Give back the rate limiter slot and remove the log of a request begun
+    with begin_ogimet_request but never sent
+    """
+
+    import transaction
+    from .ratelimit import get_rate_limiter
+
+    get_rate_limiter(dbsession).cancel(token)
+
+    with transaction.manager:
+        dbsession.query(SentRequestLog).filter(
+            SentRequestLog.id==requestlog.id).delete()
+
+def store_ogimet_response(dbsession,station_name,station_id,dtstart,dtend,
+                          ogimet_result,requestlog,task=None):
+    """
+    Parse and store the reports in an OGIMET response as it streams in,
+    and record the interval as fetched
+
+    Returns: Stored METARs in chronological order
+    """
+
+    import transaction
+
+    from sqlalchemy.exc import IntegrityError
+    from .coverage import record_coverage
+    from .station_quality import record_fetch
+    from .ogimet_parser import iter_metars_from_ogimet, ogimet_response_reader, response_lines
+    from .worker_context import get_worker_context
+
+    tm=transaction.manager
+
+    batch_size=get_worker_context().metar_store_batch_size
 
     min_delay_seconds=60*3
     random_delay_scale=60*2
@@ -218,20 +402,37 @@ def download_metars(station,dtstart,dtend,dbsession=None,task=None):
         requestlog.status_code=ogimet_result.status_code
         requestlog.url=ogimet_result.url
 
+    # Parse and store the reports as the response streams in
+    response=ogimet_response_reader(response_lines(ogimet_result))
+
+    parsed_metars=[]
+    metars=[]
+
+    for date,metar_code in iter_metars_from_ogimet(response):
+
+        metars.append(parse_metar_code(date,metar_code))
+
+        if len(metars)>=batch_size:
+            parsed_metars+=parse_and_store_metars(metars,dbsession)
+            metars=[]
+
     try:
-        if ogimet_text.find('#Sorry')>-1:
-            e=ValueError('OGIMET quota limit reached, response was: "{}"'.format(ogimet_text))
-            e.text=ogimet_text
+        if response.rate_limited:
+            e=ValueError('OGIMET quota limit reached, response was: "{}"'.format(response.text))
+            e.text=response.text
             requestlog.rate_limited=True
+
+            # Stop all workers from querying OGIMET until the cool-down ends
+            from .ratelimit import get_rate_limiter, ogimet_cooldown
+            get_rate_limiter(dbsession).trip(ogimet_cooldown)
+
             if task is not None:
-                raise task.retry(exc=e,countdown=retry_delay)
+                raise task.retry(exc=e,countdown=ogimet_cooldown)
             else:
                 raise e
-        if not ogimet_text.find('METAR')>-1 \
-           and not ogimet_text.find('SPECI')>-1 \
-           and ogimet_text.find('SELECT command denied')>-1:
+        if not response.found_reports and response.database_error:
             e=ValueError('OGIMET internal database error')
-            e.text=ogimet_text
+            e.text=response.text
             if task is not None:
                 raise task.retry(exc=e,countdown=retry_delay)
             else:
@@ -240,140 +441,320 @@ def download_metars(station,dtstart,dtend,dbsession=None,task=None):
         with tm:
             dbsession.merge(requestlog)
 
-    # Get dates and METAR codes from returned text
-    dates,metar_codes=extract_metars_from_ogimet(ogimet_text)
+    if len(metars)>0:
+        parsed_metars+=parse_and_store_metars(metars,dbsession)
 
-    if len(metar_codes)==0:
-        logger.warn('No METARS found for {}, {} - {}, OGIMET response was {}'.format(station.name,dtstart,dtend,ogimet_text))
+    if len(parsed_metars)==0:
+        logger.warn('No METARS found for {}, {} - {}, OGIMET response was {}'.format(station_name,dtstart,dtend,response.text))
 
-    # Parse metar codes
-    metars=[]
-    for date, metar_code in zip(dates,metar_codes):
+    # Sort in chronological order
+    parsed_metars=sorted(parsed_metars,key=lambda m: m.report_time)
+    report_times=[metar.report_time for metar in parsed_metars]
+
+    with tm:
+        fetch_time=datetime.utcnow()
+        dbsession.add(WeatherFetchLog(time=fetch_time,
+                                      station_id=station_id,
+                                      dtstart=dtstart,
+                                      dtend=dtend))
+        record_coverage(dbsession,station_id,dtstart,dtend,fetch_time)
+
+    # The station record only guides later fetches, so losing an update to
+    # a concurrent one is harmless
+    try:
+        with tm:
+            record_fetch(dbsession,station_id,dtstart,dtend,report_times,fetch_time)
+    except IntegrityError as e:
+        logger.warning('Could not update the station record of {}: {}'.format(station_name,e))
+
+    return parsed_metars
+
+@timed('weather_download_seconds')
+def download_metars(station,dtstart,dtend,dbsession=None,task=None):
+
+    import time
+
+    dtstart,dtend=check_download_interval(dtstart,dtend)
+
+    logger.info('Downloading METARS for {}, {} - {}'.format(station.name,dtstart,dtend))
+
+    station_id=station.id
+    station_name=station.name
+
+    requestlog,send_time=begin_ogimet_request(dbsession,station_id,dtstart,dtend,
+                                              task,is_slow_query(dtstart))
+
+    # Requests that are not slow queries may have a slot a few seconds away
+    delay=send_time-time.time()
+    if delay>0:
+        sleep(delay)
+
+    # Download METARs
+    ogimet_result=fetch_metars(station_name,dtstart,dtend,url=get_ogimet_url())
+
+    return store_ogimet_response(dbsession,station_name,station_id,
+                                 dtstart,dtend,ogimet_result,requestlog,task)
+
+def download_recent_metars(dbsession,plan,task=None):
+    """
+    Download the METARs for requests that are not slow queries, each sent
+    at its rate limiter slot.
 
+    The slots are fast_spacing seconds apart (see ratelimit), so the
+    requests start one after another. They run concurrently only in that
+    each is sent without waiting for the responses to the earlier ones,
+    which take longer than the spacing.
+
+    plan: List of (station, dtstart, dtend) requests
+
+    Returns: Stored METARs for each request
+    """
+
+    from .async_fetch import get_concurrent_fetcher
+
+    # Read the stations before any commit expires them
+    queries=[(station.name,station.id)+check_download_interval(dtstart,dtend)
+             for station,dtstart,dtend in plan]
+
+    pending=[]
+
+    try:
+        for station_name,station_id,dtstart,dtend in queries:
+            logger.info('Downloading METARS for {}, {} - {}'.format(station_name,dtstart,dtend))
+            token=ogimet_request_token(station_id,dtstart,dtend,task)
+            requestlog,send_time=begin_ogimet_request(
+                dbsession,station_id,dtstart,dtend,task,slow_query=False,
+                token=token)
+            pending.append((station_name,station_id,dtstart,dtend,requestlog,send_time,token))
+    except Exception:
+        # None of the requests will be sent, so give back the slots already
+        # reserved for them
+        for station_name,station_id,dtstart,dtend,requestlog,send_time,token in pending:
+            cancel_ogimet_request(dbsession,requestlog,token)
+        raise
+
+    results=get_concurrent_fetcher().fetch(
+        get_ogimet_url(),
+        [(station_name,dtstart,dtend)
+         for station_name,station_id,dtstart,dtend,requestlog,send_time,token in pending],
+        [send_time for station_name,station_id,dtstart,dtend,requestlog,send_time,token in pending])
+
+    # Store every successful response before raising the first error
+    stored=[]
+    error=None
+
+    for (station_name,station_id,dtstart,dtend,requestlog,send_time,token),result in zip(pending,results):
         try:
-            metar=Metar.Metar(
-                metar_code,year=date.year,month=date.month,utcdelta=0)
-        except Metar.ParserError:
-            # Try parsing with strict=False
-            metar=Metar.Metar(
-                metar_code,year=date.year,month=date.month,utcdelta=0,
-                strict=False)
-            parse_error=True
-        else:
-            parse_error=False
+            if isinstance(result,Exception):
+                raise result
+            stored.append(store_ogimet_response(
+                dbsession,station_name,station_id,dtstart,dtend,result,
+                requestlog,task))
+        except Exception as e:
+            logger.warning('Failed to download METARS for {}, {} - {}: {}'.format(station_name,dtstart,dtend,e))
+            stored.append([])
+            if error is None: error=e
 
-        metars.append((metar,parse_error))
+    if error is not None:
+        raise error
 
-    # Sort in chronological order
-    metars=sorted(metars,key=lambda m: m[0].time)
-    
-    parsed_metars=parse_and_store_metars(metars,dbsession)
+    return stored
 
-    with tm:
-        log=WeatherFetchLog(time=datetime.utcnow(),
-                            station=station,
-                            dtstart=dtstart,
-                            dtend=dtend)
-        dbsession.add(log)
+def download_planned_metars(session,plan,task=None):
+    """
+    Download the METARs for each request in a fetch plan, skipping any
+    request that overlaps a fetch already in progress in another task.
+    Requests for recent periods are sent concurrently, and archival
+    requests one at a time through the slow query rate limiter.
 
-    return parsed_metars
+    Returns: List of (station, dtstart, dtend) requests that were skipped
+    """
 
-def get_metars(session,station,dtstart,dtend,window_expansion=timedelta(seconds=3600*4),task=None):
+    from .inflight import get_fetch_registry
+    from .worker_context import get_worker_context
 
-    from pytz import utc
-    import transaction
+    # Pick up a reload requested since the last download
+    get_worker_context().check_version()
 
-    logger.debug('Getting METARS from range {} - {}'.format(dtstart,dtend))
+    registry=get_fetch_registry()
 
-    tm=transaction.manager
+    busy=[]
+    claims=[]
+    recent=[]
+    archival=[]
 
-    # Convert times to UTC
-    dtstart=dtstart.astimezone(utc)
-    dtend=dtend.astimezone(utc)
+    try:
+        for station,dtstart,dtend in plan:
 
-    # Apply window expansion
-    dtstart_exp=dtstart-window_expansion
-    dtend_exp=dtend+window_expansion
+            claim=registry.claim(station.id,dtstart,dtend)
 
-    with tm:
-        stored_metars=get_stored_metars(session,station,dtstart_exp,dtend_exp)
+            if claim is None:
+                logger.info('METARS for {}, {} - {} are already being fetched'.format(station.name,dtstart,dtend))
+                busy.append((station,dtstart,dtend))
+                continue
 
-        # Check whether stored METARs span the requested interval
-        if len(stored_metars)>0:
-            data_spans_full_interval=stored_metars[0].report_time.replace(tzinfo=utc)<dtstart and stored_metars[-1].report_time.replace(tzinfo=utc)>dtend
-        else:
-            data_spans_full_interval=False
+            claims.append(claim)
 
-    if data_spans_full_interval:
-        return stored_metars
-            
-    interval_start=dtstart_exp
+            if is_slow_query(dtstart):
+                archival.append((station,dtstart,dtend))
+            else:
+                recent.append((station,dtstart,dtend))
 
-    metars=[]
+        # Recent requests are not subject to the slow query budget, so
+        # they are sent all at once
+        if len(recent)>0:
+            download_recent_metars(session,recent,task)
+
+        for station,dtstart,dtend in archival:
+            download_metars(station,dtstart,dtend,dbsession=session,task=task)
+
+    finally:
+        for claim in claims:
+            registry.release(claim)
+
+    return busy
 
-    while interval_start<dtend_exp:
+# Seconds to wait for another task to finish fetching METARs we need
+inflight_wait_timeout=60
 
-        day_start=interval_start.replace(
-            hour=0,minute=0,second=0,microsecond=0)
+def wait_for_fetches(fetches,task=None):
+    """
+    Wait for fetches in progress in other tasks. If they do not finish in
+    time, the task is rescheduled to run after their claims expire.
+    """
+
+    from .inflight import get_fetch_registry
+
+    registry=get_fetch_registry()
+
+    for station,dtstart,dtend in fetches:
+
+        if registry.wait(station.id,dtstart,dtend,inflight_wait_timeout):
+            continue
 
-        day_end=day_start+timedelta(1)-timedelta(seconds=1)
+        remaining=registry.remaining(station.id,dtstart,dtend)
 
-        interval_end=min(day_end,dtend_exp)
+        e=RuntimeError('METARS for {}, {} - {} are still being fetched by another task'.format(station.name,dtstart,dtend))
 
-        if len(stored_metars)>0:
-            data_spans_interval=stored_metars[0].report_time.replace(tzinfo=utc)<max(interval_start,dtstart) and stored_metars[-1].report_time.replace(tzinfo=utc)>min(interval_end,dtend)
+        if task is not None:
+            raise task.retry(exc=e,countdown=remaining+1)
         else:
-            data_spans_interval=False        
+            raise e
+
+def fetch_missing_metars(session,windows,window_expansion=metar_window_expansion,task=None):
+    """
+    Fetch the METARs missing to cover windows at several stations, with the
+    gaps of all windows merged into one fetch plan
+
+    windows: List of (station, dtstart, dtend) tuples. Reports are needed
+        from window_expansion before dtstart to window_expansion after dtend.
+    """
+
+    from pytz import utc
+    import transaction
+
+    from .fetch_planner import plan_fetches
+
+    tm=transaction.manager
+
+    while True:
+
+        missing=[]
 
         with tm:
-            last_fetch=session.query(
-                WeatherFetchLog
-            ).filter(
-                WeatherFetchLog.station==station,
-                WeatherFetchLog.dtstart==interval_start,
-                WeatherFetchLog.dtend==interval_end
-            ).order_by(WeatherFetchLog.time.desc()).first()
+            for station,dtstart,dtend in windows:
 
-        if last_fetch is not None:
+                # Convert times to UTC
+                dtstart=dtstart.astimezone(utc)
+                dtend=dtend.astimezone(utc)
 
-            # Label fetches more than 2 days old as stale
-            stale_fetch = (datetime.utcnow() - last_fetch.time) > timedelta(2)
+                missing+=[(station,gap_start,gap_end) for gap_start,gap_end in
+                          required_gaps(session,station.id,dtstart,dtend,
+                                        window_expansion)]
 
-            # Data fetched less than 2 hours after interval_end could have new
-            # reports added
-            data_could_have_changed = (last_fetch.time.replace(tzinfo=utc) - interval_end) < timedelta(seconds=3600)
+        if len(missing)==0:
+            break
 
-            # We don't want to re-try fetches from the last 15 minutes
-            very_recent_fetch = (datetime.now() - last_fetch.time) < timedelta(seconds=900)
+        # Merge the gaps into as few requests as possible
+        busy=download_planned_metars(session,plan_fetches(missing),task)
 
-            needs_update = (
-                not data_spans_interval
-                and (stale_fetch or data_could_have_changed)
-                and not very_recent_fetch)
+        if len(busy)==0:
+            break
 
-        else:
-            needs_update = not data_spans_interval
+        # Another task is fetching part of a window. Once it finishes,
+        # check again what is still missing.
+        wait_for_fetches(busy,task)
 
-        if needs_update:
-            metars+=download_metars(station,interval_start,interval_end,
-                                    dbsession=session,task=task)
+def get_metars(session,station,dtstart,dtend,window_expansion=metar_window_expansion,task=None,records=False):
+    """
+    Stored METARs of a station from window_expansion before dtstart to
+    window_expansion after dtend, fetching any that are missing
 
-        else:
-            metars+=[metar for metar in stored_metars if
-                     metar.report_time.replace(tzinfo=utc)>interval_start
-                     and metar.report_time.replace(tzinfo=utc)<=interval_end]
+    records: Return observation records (see load_observations) instead of
+        StationWeatherData instances
+    """
+
+    from pytz import utc
+    import transaction
+
+    logger.debug('Getting METARS from range {} - {}'.format(dtstart,dtend))
+
+    tm=transaction.manager
 
-        # Start next interval at beginning of the next day
-        interval_start=day_start+timedelta(1)
+    fetch_missing_metars(session,[(station,dtstart,dtend)],window_expansion,task)
+
+    # Apply window expansion
+    dtstart_exp=dtstart.astimezone(utc)-window_expansion
+    dtend_exp=dtend.astimezone(utc)+window_expansion
+
+    with tm:
+        if records:
+            metars=load_observations(session,station.id,dtstart_exp,dtend_exp)
+        else:
+            metars=get_stored_metars(session,station,dtstart_exp,dtend_exp)
 
     return metars
 
+def required_gaps(session,station_id,dtstart,dtend,window_expansion=metar_window_expansion):
+    """
+    Parts of a station's expanded window whose reports still need to be
+    fetched, from the coverage index.
+
+    A window needs the reports bracketing dtstart - dtend, not all of its
+    expansion. If the station's coverage reaches bracket_intervals typical
+    reporting intervals (see station_quality) past both ends, those reports
+    have been fetched and nothing is missing. Otherwise, or if the
+    station's reporting interval is not known yet, every gap in the
+    expanded window is.
+
+    Returns: List of (dtstart, dtend) tuples in UTC
+    """
+
+    from .coverage import coverage_gaps
+    from ..models.cycling_models import StationQuality
+
+    report_interval=session.query(StationQuality.report_interval).filter(
+        StationQuality.station_id==station_id).scalar()
+
+    if report_interval:
+        margin=min(timedelta(seconds=report_interval*bracket_intervals),
+                   window_expansion)
+
+        if len(coverage_gaps(session,station_id,dtstart-margin,dtend+margin))==0:
+            return []
+
+    return coverage_gaps(session,station_id,dtstart-window_expansion,
+                         dtend+window_expansion)
+
 def get_stored_metars(session,station,dtstart,dtend):
 
     from pytz import utc
     import transaction
+    from sqlalchemy.orm import joinedload
 
-    stored_metars=session.query(StationWeatherData).filter(
+    stored_metars=session.query(StationWeatherData).options(
+        joinedload(StationWeatherData.station)
+    ).filter(
         StationWeatherData.station==station
     ).filter(
         StationWeatherData.report_time>=dtstart
@@ -389,8 +770,105 @@ def get_stored_metars(session,station,dtstart,dtend):
 
     return stored_metars
 
-def fetch_metars_for_ride(session,ride,task=None):
+def load_observations(session,station_id,dtstart,dtend):
+    """
+    Observation records of a station's stored METARs, without creating ORM
+    instances. Days already loaded by this or another worker are taken from
+    the observation cache.
+
+    Returns: Structured array of weather_math.observation_dtype sorted by
+        report time
+    """
+
+    from .observation_cache import get_observation_cache
+
+    records=get_observation_cache().load(session,station_id,dtstart,dtend)
+
+    logger.debug('Loaded {} METARS for station {}'.format(len(records),station_id))
+
+    return records
+
+def query_observations(session,station_id,dtstart,dtend):
+    """
+    Observation records of a station's stored METARs, loaded with one column
+    query
+    """
+
+    from .coverage import to_naive_utc
+    from .weather_math import observation_fields, observation_records
+
+    rows=session.query(
+        *[getattr(StationWeatherData,field) for field in observation_fields[:-1]],
+        Location.elevation
+    ).select_from(StationWeatherData).outerjoin(
+        Location,StationWeatherData.wx_station==Location.id
+    ).filter(
+        StationWeatherData.wx_station==station_id,
+        StationWeatherData.report_time>=to_naive_utc(dtstart),
+        StationWeatherData.report_time<=to_naive_utc(dtend)
+    ).all()
+
+    return observation_records(rows)
+
+def ride_midpoint(ride):
+    """
+    Point halfway between a ride's start and end locations, or whichever of
+    them has coordinates
+
+    Returns: (lat, lon) tuple, or None if neither location has coordinates
+    """
+
+    if (ride.startloc.lat is None or ride.startloc.lon is None) \
+       and (ride.endloc.lat is None or ride.endloc.lon is None):
+        return None
+
+    if ride.startloc.lat is None or ride.startloc.lon is None:
+        return ride.endloc.lat,ride.endloc.lon
+    elif ride.endloc.lat is None or ride.endloc.lon is None:
+        return ride.startloc.lat,ride.startloc.lon
+    else:
+        return ((ride.startloc.lat+ride.endloc.lat)*0.5,
+                (ride.startloc.lon+ride.endloc.lon)*0.5)
+
+def ride_altitude(ride):
+
+    if ride.startloc.elevation is None:
+        return ride.endloc.elevation
+    elif ride.endloc.elevation is None:
+        return ride.startloc.elevation
+    else:
+        return (ride.startloc.elevation+ride.endloc.elevation)*0.5
+
+def ride_weather_stations(session,ride,dtstart,dtend,nearby=None):
+    """
+    Weather stations near a ride, in the order to try them. Stations known
+    to have no reports for the ride are left out.
+
+    nearby: Optional dict caching the stations near each ride midpoint
+    """
+
     from .locations import get_nearby_locations
+    from .station_quality import rank_stations
+
+    lat_mid,lon_mid=ride_midpoint(ride)
+
+    if nearby is None: nearby={}
+
+    if (lat_mid,lon_mid) not in nearby:
+        nearby[lat_mid,lon_mid]=get_nearby_locations(session,lat_mid,lon_mid).filter(Location.loctype_id==2).limit(10).all()
+
+    # Try the stations most likely to have reports first
+    return rank_stations(session,nearby[lat_mid,lon_mid],dtstart,dtend,
+                         metar_window_expansion)
+
+def fetch_metars_for_ride(session,ride,task=None,records=False):
+    """
+    METARs from the first nearby station whose reports span a ride
+
+    records: Return observation records (see load_observations) instead of
+        StationWeatherData instances
+    """
+
     from pytz import utc
     import transaction
 
@@ -399,39 +877,25 @@ def fetch_metars_for_ride(session,ride,task=None):
     if (
             ride.start_time_ is None
             or ride.end_time_ is None
-            or (
-                (ride.startloc.lat is None
-                 or ride.startloc.lon is None)
-                and
-                (ride.endloc.lat is None
-                 or ride.endloc.lon is None)
-            )
+            or ride_midpoint(ride) is None
     ):
         # Incomplete time/location data, can't search for METARS
         return []
 
-    if ride.startloc.lat is None or ride.startloc.lon is None:
-        lat_mid=ride.endloc.lat
-        lon_mid=ride.endloc.lon
-    elif ride.endloc.lat is None or ride.endloc.lon is None:
-        lat_mid=ride.startloc.lat
-        lon_mid=ride.startloc.lon
-    else:
-        lat_mid=(ride.startloc.lat+ride.endloc.lat)*0.5
-        lon_mid=(ride.startloc.lon+ride.endloc.lon)*0.5
-
     with tm:
         dtstart,dtend=ride_times_utc(ride)
 
     with tm:
-        nearby_stations=get_nearby_locations(session,lat_mid,lon_mid).filter(Location.loctype_id==2).limit(10).all()
+        nearby_stations=ride_weather_stations(session,ride,dtstart,dtend)
 
     for station in nearby_stations:
 
-        metars=get_metars(session,station,dtstart,dtend,task=task)
+        metars=get_metars(session,station,dtstart,dtend,task=task,
+                          records=records)
 
         if len(metars)>0:
-            data_spans_interval=metars[0].report_time.replace(tzinfo=utc)<dtstart and metars[-1].report_time.replace(tzinfo=utc)>dtend
+            first,last=report_time_range(metars)
+            data_spans_interval=first<dtstart and last>dtend
         else:
             data_spans_interval=False
 
@@ -440,123 +904,109 @@ def fetch_metars_for_ride(session,ride,task=None):
         
     return []
 
-def weather_to_numeric(weathers):
-    totalrain=0
-    totalsnow=0
-    for weather in weathers:
-        rain=0
-        if weather[2]=='BR':rain+=0.1
-        elif weather[2]=='DZ':rain+=0.3
-        elif weather[2]=='RA':rain+=0.3
-        
-        if rain>0:
-            if weather[0]=='+': rain+=0.1
-            if weather[0]=='-': rain-=0.1
-        
-        snow=0
-        if weather[2]=='SN':snow+=0.5
-        elif weather[2]=='SG':snow+=0.5
-        elif weather[2]=='IC':snow+=0.5
-        elif weather[2]=='PL':snow+=0.5
-        
-        if snow>0:
-            if weather[0]=='+': snow+=0.2
-            if weather[0]=='-': snow-=0.2
-        totalrain+=rain
-        totalsnow+=snow
-    return totalrain,totalsnow
+def report_time_range(metars):
+    """
+    Times of the first and last of a list of StationWeatherData instances,
+    or of an array of observation records, as UTC datetimes
+    """
+
+    from pytz import utc
+    import numpy as np
+
+    if isinstance(metars,np.ndarray):
+        times=metars['report_time'].astype(datetime)
+    else:
+        times=[metar.report_time for metar in metars]
+
+    return min(times).replace(tzinfo=utc),max(times).replace(tzinfo=utc)
 
+@timed('weather_average_seconds')
 def average_weather(metars,dtstart,dtend,altitude):
+    """
+    Time average of the weather over dtstart - dtend
 
-    from scipy.interpolate import interp1d
+    metars: StationWeatherData instances or observation records
+    """
 
     from pytz import utc
     import numpy as np
 
-    metars=sorted(metars, key=lambda metar: metar.report_time)
-    
-    total_time=min(metars[-1].report_time.replace(tzinfo=utc),dtend)-max(metars[0].report_time.replace(tzinfo=utc),dtstart)
-
-    values={
-        'wind_e':0,
-        'wind_n':0,
-        'temperature':0,
-        'gust':0,
-        'dewpoint':0,
-        'rain':0,
-        'snow':0,
-        'pressure':0
-    }
-    
-    logger.debug('Averaging {} METARS'.format(len(metars)))
+    from .weather_math import average_variables, metar_records, observation_times, observation_array, average_observations, wind_to_polar
+
+    records=metar_records(metars)
+
+    logger.debug('Averaging {} METARS'.format(len(records)))
 
     logger.info('Ride time: {} - {}'.format(dtstart,dtend))
 
-    dtstart64=np.datetime64(dtstart.astimezone(utc))
-    dtend64=np.datetime64(dtend.astimezone(utc))
-
-    times=np.array([np.datetime64(metar.report_time.replace(tzinfo=utc)) for metar in metars])
-    start_ind=np.searchsorted(times,dtstart64)
-    end_ind=np.searchsorted(times,dtend64)
-
-    rainsnow = [weather_to_numeric(
-                Metar.Metar(metar.metar,
-                            year=metar.report_time.year,
-                            month=metar.report_time.month,
-                            utcdelta=0,strict=False).weather)
-                for metar in metars]
-
-    winddir=np.array([metar.winddir for metar in metars],dtype=float)
-    windspeed=np.array([metar.windspeed for metar in metars],dtype=float)
-
-    for key in values.keys():
-
-        if key == 'rain':
-            obs = np.array([precip[0] for precip in rainsnow]).astype(float)
-        elif key == 'snow':
-            obs = np.array([precip[1] for precip in rainsnow]).astype(float)
-        elif key=='wind_e':
-            obs=np.cos((90-winddir)*np.pi/180)*windspeed
-        elif key=='wind_n':
-            obs=np.sin((90-winddir)*np.pi/180)*windspeed
-        else:
-            obs=np.array([getattr(metar.weather_at_altitude(altitude),key) for metar in metars]).astype(float)
+    def microseconds(dt):
+        return np.datetime64(dt,'us').astype(float)
 
-        obs_valid=np.isfinite(obs)
+    averages=average_observations(
+        observation_times(records),observation_array(records,altitude),
+        microseconds(dtstart.astimezone(utc).replace(tzinfo=None)),
+        microseconds(dtend.astimezone(utc).replace(tzinfo=None)))
 
-        if np.count_nonzero(obs_valid)<2:
-            values[key] = np.nan
-            continue
+    return wind_to_polar(dict(zip(average_variables,averages)))
 
-        if times[obs_valid][0]>dtstart64 or times[obs_valid][-1]<dtend64:
-            values[key] = np.nan
-            continue
+@timed('weather_average_rides_seconds')
+def average_rides_weather(metars,rides,window_expansion=metar_window_expansion):
+    """
+    Average the weather of many rides from one station's reports at once
 
-        interpolator=interp1d(times[obs_valid].astype(float),obs[obs_valid])
+    metars: StationWeatherData instances or observation records
+    rides: List of (dtstart, dtend, altitude) tuples
 
-        obs_start=interpolator(dtstart64.astype(float))
-        obs_end=interpolator(dtend64.astype(float))
+    Returns: List with the averages of each ride, as from average_weather,
+        or None for rides without reports from within window_expansion
+        before and after them
+    """
 
-        # Observations taken during interval
-        mid_mask=np.logical_and(obs_valid,np.logical_and(times>dtstart64,times<dtend64))
+    from pytz import utc
+    import numpy as np
+
+    from .weather_math import average_variables, metar_records, observation_times, observation_array, average_intervals, wind_to_polar
+
+    records=metar_records(metars)
+
+    def microseconds(dt):
+        return np.datetime64(dt,'us').astype(float)
+
+    times=observation_times(records)
+    starts=np.array([microseconds(dtstart.astimezone(utc).replace(tzinfo=None))
+                     for dtstart,dtend,altitude in rides])
+    ends=np.array([microseconds(dtend.astimezone(utc).replace(tzinfo=None))
+                   for dtstart,dtend,altitude in rides])
+    max_gap=window_expansion.total_seconds()*1e6
 
-        obs_avg=np.trapz(
-            np.concatenate([[obs_start],obs[mid_mask],[obs_end]]),
-            np.concatenate([[dtstart64],times[mid_mask],[dtend64]]).astype(float)
-        )/(dtend64-dtstart64).astype(float)
+    results=[None]*len(rides)
 
-        values[key] = obs_avg
+    if len(times)<2:
+        return results
 
-    # Convert wind components to polar coordinates
-    winddir=(90-np.arctan2(values['wind_n'],values['wind_e'])*180/np.pi)%360
-    values['winddir']=winddir
-    values['windspeed']=np.sqrt(values['wind_n']**2+values['wind_e']**2)
+    # Rides with a report shortly before and another shortly after them
+    before=np.searchsorted(times,starts,side='left')-1
+    after=np.searchsorted(times,ends,side='right')
+    spans=(before>=0)&(after<len(times))
+    spans[spans]&=(times[before[spans]]>=starts[spans]-max_gap) \
+        &(times[after[spans]]<=ends[spans]+max_gap)
 
-    # Delete Cartesian wind components
-    del values['wind_n']
-    del values['wind_e']
+    # Temperature and pressure depend on altitude, so rides are averaged
+    # together with the others at the same altitude
+    by_altitude={}
+    for index,(dtstart,dtend,altitude) in enumerate(rides):
+        if spans[index]:
+            by_altitude.setdefault(altitude,[]).append(index)
 
-    return values
+    for altitude,indices in by_altitude.items():
+
+        averages=average_intervals(times,observation_array(records,altitude),
+                                   starts[indices],ends[indices])
+
+        for index,row in zip(indices,averages):
+            results[index]=wind_to_polar(dict(zip(average_variables,row)))
+
+    return results
 
 def ride_times_utc(ride):
     from pytz import timezone,utc
@@ -589,7 +1039,6 @@ def update_location_rides_weather(location_id):
     import transaction
 
     dbsession=session_factory()
-    dbsession.expire_on_commit=False
     tm=transaction.manager
 
     with tm:
@@ -600,43 +1049,37 @@ def update_location_rides_weather(location_id):
             ( Ride.startloc_id == location_id ) |
             ( Ride.endloc_id == location_id ) ).order_by(func.random()).limit(update_weather_group_max)
 
-    from celery import chord
+        ride_ids=[ride.id for ride in location_rides]
 
-    # Update ride weather for all rides and re-train prediction model when
-    # finished
-    chord(
-       update_ride_weather.signature((ride.id,),dict(train_model=False), countdown=random_delay(i*2+1)) for i,ride in enumerate(location_rides)
-    )(after_fetch_tasks.s())
+    if len(ride_ids)>0:
+        # Update ride weather for all rides and re-train prediction model
+        # when finished
+        update_rides_weather.delay(ride_ids)
 
     return location_id
 
 @celery.task(ignore_result=False)
 def fill_missing_weather():
+    """
+    Update the weather of the rides due in the weather backlog
+    """
+
     from ..celery import session_factory
-    from sqlalchemy import or_
+    from ..celeryconfig import backfill_queue
+    from .backlog import claim_rides
 
     import transaction
     dbsession=session_factory()
-    dbsession.expire_on_commit=False
     tm=transaction.manager
 
     with tm:
-        rides_without_weather=dbsession.query(Ride).filter(
-            or_(Ride.wxdata==None, RideWeatherData.wx_station==None)
-        ).outerjoin(
-            RideWeatherData,Ride.wxdata_id == RideWeatherData.id
-        ).order_by(func.random()).limit(update_weather_group_max)
-
-        from celery import chord, group
+        ride_ids=claim_rides(dbsession,update_weather_group_max)
 
-        ride_ids=[ride.id for ride in rides_without_weather]
-
-        if rides_without_weather.count()>0:
-            # Update ride weather for all rides and re-train prediction model when
-            # finished
-            chord(
-                update_ride_weather.signature((ride_id,), dict(train_model=False), countdown=random_delay(i*2+1)) for i,ride_id in enumerate(ride_ids)
-            )(after_fetch_tasks.s())
+    if len(ride_ids)>0:
+        # Update ride weather for all rides and re-train prediction model
+        # when finished. Kept off the interactive queue, so weather for
+        # newly saved rides doesn't wait behind it.
+        update_rides_weather.apply_async((ride_ids,),queue=backfill_queue)
 
     return ride_ids
 
@@ -645,86 +1088,277 @@ def schedule_fill_missing_weather(sender,**kwargs):
     from celery.schedules import crontab
     sender.add_periodic_task(crontab(minute=5), fill_missing_weather.s())
 
-@celery.task(bind=True,ignore_result=False,rate_limit='1/s',max_retries=4,retry_backoff=True)
+# Recorded for rides no nearby station's reports span. New reports or
+# stations may still turn up, so these rides are retried later.
+uncovered_error='No weather reports span the ride'
+
+def ride_weather_failure(ride,dtstart,dtend):
+    """
+    Why a ride's weather can't be found without editing the ride
+
+    Returns: (error message, permanent) tuple, or None if the ride has
+        everything its weather needs
+    """
+
+    if ride.startloc is None or ride.endloc is None:
+        return ('Ride has no start or end location',True)
+
+    if ride_midpoint(ride) is None:
+        return ('Ride locations have no coordinates',True)
+
+    if dtstart is None or dtend is None:
+        return ('Ride has no start or end time',True)
+
+    return None
+
+@celery.task(bind=True,ignore_result=False,max_retries=4,retry_backoff=True)
 def update_ride_weather(self,ride_id, train_model=True):
 
     from pytz import utc
     from ..celery import session_factory
+    from .backlog import record_outcomes
     import transaction
-    import numpy as np
 
     logger.debug('Received update weather task for ride {}'.format(ride_id))
 
     tm=transaction.manager
 
     dbsession=session_factory()
-    dbsession.expire_on_commit=False
-
-    conn=dbsession.bind
-    if conn.dialect.name!='sqlite':
-        conn.execute('UNLOCK TABLES')
-    pass
 
     with tm:
 
         ride=dbsession.query(Ride).filter(Ride.id==ride_id).one()
         dtstart,dtend=ride_times_utc(ride)
-        if dtstart is None or dtend is None:
+        failure=ride_weather_failure(ride,dtstart,dtend)
+        if failure is not None:
+            record_outcomes(dbsession,failures={ride_id:failure})
             return
 
-    metars=fetch_metars_for_ride(dbsession,ride,task=self)
+    try:
+        metars=fetch_metars_for_ride(dbsession,ride,task=self,records=True)
 
-    if len(metars)==0: return
+        if len(metars)>0:
+            first,last=report_time_range(metars)
 
-    metar_times=[metar.report_time.replace(tzinfo=utc) for metar in metars]
+        if len(metars)==0 or last<dtend or first>dtstart:
+            # METARs do not span time of ride
+            with tm:
+                record_outcomes(dbsession,failures={ride_id:(uncovered_error,False)})
+            return
 
-    if max(metar_times)<dtend or min(metar_times)>dtstart:
-        # METARs do not span time of ride
-        return
+        averages=average_weather(metars,dtstart,dtend,ride_altitude(ride))
+    except Retry:
+        raise
+    except Exception as e:
+        record_task_failure(dbsession,{ride_id:(repr(e),False)})
+        raise
+    logger.debug('Ride weather average values: {}'.format(averages))
 
-    with tm:
+    if len(averages)>0:
+        with tm:
+            ride=dbsession.query(Ride).filter(Ride.id==ride_id).one()
+            set_ride_weather(ride,averages,int(metars['wx_station'][0]))
+            record_outcomes(dbsession,updated=[ride_id])
+
+    if train_model:
+        from .regression import request_training
+        request_training()
+
+    return ride_id
 
-        metars=[dbsession.query(type(metar)).get(metar.id) for metar in metars]
+def set_ride_weather(ride,averages,station_id):
 
-        if ride.startloc.elevation is None:
-            altitude=ride.endloc.elevation
-        elif ride.endloc.elevation is None:
-            altitude=ride.startloc.elevation
+    import numpy as np
+
+    if ride.wxdata is None:
+        ride.wxdata=RideWeatherData()
+    for key,value in averages.items():
+        if np.isnan(value):
+            # Store NaN values as None
+            setattr(ride.wxdata,key,None)
         else:
-            altitude=(ride.startloc.elevation+ride.endloc.elevation)*0.5
+            # Store the value
+            setattr(ride.wxdata,key,value)
+    ride.wxdata.wx_station=station_id
 
-        averages=average_weather(metars,dtstart,dtend,altitude)
-        logger.debug('Ride weather average values: {}'.format(averages))
+def merge_ride_windows(windows,window_expansion=metar_window_expansion):
+    """
+    Merge ride times whose expanded windows overlap
 
-        if len(averages)>0:
-            ride=dbsession.query(Ride).filter(Ride.id==ride_id).one()
-            if ride.wxdata is None:
-                ride.wxdata=RideWeatherData()
-            for key,value in averages.items():
-                if np.isnan(value):
-                    # Store NaN values as None
-                    setattr(ride.wxdata,key,None)
+    windows: List of (dtstart, dtend) tuples
+
+    Returns: List of (dtstart, dtend) tuples in chronological order
+    """
+
+    merged=[]
+
+    for dtstart,dtend in sorted(windows):
+        if len(merged)>0 and dtstart-window_expansion<=merged[-1][1]+window_expansion:
+            merged[-1]=(merged[-1][0],max(merged[-1][1],dtend))
+        else:
+            merged.append((dtstart,dtend))
+
+    return merged
+
+def load_window_observations(session,station_id,windows,window_expansion=metar_window_expansion):
+    """
+    Observation records of a station for a list of merged ride windows
+
+    windows: List of (dtstart, dtend) tuples, as from merge_ride_windows
+    """
+
+    import numpy as np
+
+    records=[load_observations(session,station_id,dtstart-window_expansion,
+                               dtend+window_expansion)
+             for dtstart,dtend in windows]
+
+    records=np.concatenate(records)
+
+    # Expanded windows of neighbouring clusters may share reports
+    return records[np.unique(records['id'],return_index=True)[1]]
+
+def record_task_failure(dbsession,failures):
+    """
+    Count a failed attempt for rides whose task raised. Otherwise the
+    backlog would hand the rides out again after each lease, forever.
+    """
+
+    from .backlog import record_outcomes
+    import transaction
+
+    try:
+        with transaction.manager:
+            record_outcomes(dbsession,failures=failures)
+    except Exception as e:
+        logger.error('Could not record failed weather updates: {}'.format(e))
+
+def find_rides_weather(dbsession,rides,candidates,task=None):
+    """
+    Average the weather of rides at their best station whose reports span
+    the ride, fetching missing reports
+
+    rides: dict mapping ride ids to (dtstart, dtend, altitude) tuples
+    candidates: dict mapping ride ids to stations in order of preference
+
+    Returns: dict mapping ride ids to (averages, station id) tuples, for
+        the rides whose weather was found
+    """
+
+    import transaction
+
+    tm=transaction.manager
+
+    results={}
+    rank=0
+    pending=[ride_id for ride_id in rides if len(candidates[ride_id])>0]
+
+    while len(pending)>0:
+
+        groups={}
+        for ride_id in pending:
+            station=candidates[ride_id][rank]
+            groups.setdefault(station.id,(station,[]))[1].append(ride_id)
+
+        windows={station_id:merge_ride_windows(
+            [rides[ride_id][:2] for ride_id in group])
+                 for station_id,(station,group) in groups.items()}
+
+        fetch_missing_metars(
+            dbsession,
+            [(station,dtstart,dtend) for station_id,(station,group) in groups.items()
+             for dtstart,dtend in windows[station_id]],
+            task=task)
+
+        uncovered=[]
+
+        for station_id,(station,group) in groups.items():
+
+            with tm:
+                records=load_window_observations(
+                    dbsession,station_id,windows[station_id])
+
+            averages=average_rides_weather(
+                records,[rides[ride_id] for ride_id in group])
+
+            for ride_id,values in zip(group,averages):
+                if values is None:
+                    uncovered.append(ride_id)
                 else:
-                    # Store the value
-                    setattr(ride.wxdata,key,value)
-            ride.wxdata.station=metars[0].station
+                    results[ride_id]=(values,station_id)
 
-    if train_model:
-        from .regression import train_all_models
-        train_all_models.delay()
+        rank+=1
+        pending=[ride_id for ride_id in uncovered
+                 if len(candidates[ride_id])>rank]
 
-    return ride_id
+    return results
 
-@celery.task(ignore_result=False)
-def after_fetch_tasks(ride_ids):
+@celery.task(bind=True,ignore_result=False,max_retries=4,retry_backoff=True)
+def update_rides_weather(self,ride_ids,train_model=True):
+    """
+    Update the weather of many rides together.
 
-    if len(ride_ids)==0:
-        return
+    The weather stations of each ride are ranked once, the reports missing
+    for all rides at their current station are fetched with one fetch plan,
+    and each station's rides are averaged in one pass. Rides their station's
+    reports don't span move on to their next station. All ride weather is
+    written in one transaction.
 
-    if all(ride_id is None for ride_id in ride_ids):
-        return
+    Returns: ids of the rides updated
+    """
 
-    from .regression import train_all_models
-    train_all_models.delay()
+    from ..celery import session_factory
+    from .backlog import record_outcomes
+    import transaction
 
-    return ride_ids
+    logger.debug('Received update weather task for {} rides'.format(len(ride_ids)))
+
+    tm=transaction.manager
+
+    dbsession=session_factory()
+
+    rides={}
+    candidates={}
+    nearby={}
+    failures={}
+
+    with tm:
+        for ride in dbsession.query(Ride).filter(Ride.id.in_(ride_ids)):
+
+            dtstart,dtend=ride_times_utc(ride)
+
+            failure=ride_weather_failure(ride,dtstart,dtend)
+
+            if failure is not None:
+                failures[ride.id]=failure
+                continue
+
+            rides[ride.id]=(dtstart,dtend,ride_altitude(ride))
+            candidates[ride.id]=ride_weather_stations(
+                dbsession,ride,dtstart,dtend,nearby)
+
+    try:
+        results=find_rides_weather(dbsession,rides,candidates,task=self)
+    except Retry:
+        raise
+    except Exception as e:
+        failures.update({ride_id:(repr(e),False) for ride_id in rides})
+        record_task_failure(dbsession,failures)
+        raise
+
+    for ride_id in rides:
+        if ride_id not in results:
+            failures[ride_id]=(uncovered_error,False)
+
+    with tm:
+        for ride in dbsession.query(Ride).filter(Ride.id.in_(results.keys())):
+            set_ride_weather(ride,*results[ride.id])
+        record_outcomes(dbsession,results.keys(),failures)
+
+    if len(results)>0 and train_model:
+        from .regression import request_training
+        request_training()
+
+    logger.info('Updated the weather of {} of {} rides'.format(len(results),len(ride_ids)))
+
+    return sorted(results)
@@ -0,0 +1,271 @@
+import numpy as np
+
+# Variables averaged over a ride, in the column order of observation arrays
+average_variables=['wind_e','wind_n','temperature','gust','dewpoint','rain','snow','pressure']
+
+# Fields of observation records, the weather computations' compact copy of
+# StationWeatherData rows and their station's elevation
+observation_fields=['id','wx_station','report_time','winddir','windspeed',
+                    'temperature','gust','dewpoint','rain','snow','pressure',
+                    'elevation']
+
+observation_dtype=np.dtype(
+    [('id',np.int64),('wx_station',np.int64),('report_time','datetime64[us]')]
+    +[(field,np.float64) for field in observation_fields[3:]])
+
+def observation_records(rows):
+    """
+    Structured array of observations sorted by report time
+
+    rows: Tuples of values in the order of observation_fields, as returned by
+        a column query, with None for missing values
+    """
+
+    rows=[tuple(np.nan if value is None else value for value in row)
+          for row in rows]
+
+    records=np.array(rows,dtype=observation_dtype)
+
+    return records[np.argsort(records['report_time'],kind='stable')]
+
+def metar_records(metars):
+    """
+    Observation records of StationWeatherData instances sorted by report
+    time. Arrays of records are sorted and returned as they are.
+    """
+
+    if isinstance(metars,np.ndarray):
+        return metars[np.argsort(metars['report_time'],kind='stable')]
+
+    return observation_records(
+        (metar.id or 0,metar.wx_station or 0,metar.report_time,metar.winddir,
+         metar.windspeed,metar.temperature,metar.gust,metar.dewpoint,
+         metar.rain,metar.snow,metar.pressure,
+         metar.station.elevation if metar.station is not None else None)
+        for metar in metars)
+
+def observation_times(records):
+    """
+    Report times of observation records in microseconds since the epoch
+    """
+
+    return records['report_time'].astype(np.int64).astype(float)
+
+def observation_array(records,altitude=None):
+    """
+    Observations as an array with one row per record and one column per
+    variable in average_variables. Missing values are NaN. Temperature and
+    pressure are adjusted to altitude as in
+    StationWeatherData.weather_at_altitude.
+    """
+
+    temperature=records['temperature']
+    pressure=records['pressure']
+    elevation=records['elevation']
+
+    if altitude is not None:
+        pressure=pressure*np.where(
+            np.isfinite(temperature),
+            np.exp(-altitude/((temperature+273.15)*29.263)),
+            1.)
+        temperature=np.where(
+            np.isfinite(elevation),
+            temperature-(altitude-elevation)*6.4/1000,
+            temperature)
+
+    winddir=records['winddir']
+    windspeed=records['windspeed']
+
+    return np.column_stack([
+        np.cos((90-winddir)*np.pi/180)*windspeed,
+        np.sin((90-winddir)*np.pi/180)*windspeed,
+        temperature,
+        records['gust'],
+        records['dewpoint'],
+        records['rain'],
+        records['snow'],
+        pressure,
+    ])
+
+def fill_gaps(times,obs):
+    """
+    Replace each NaN that has valid values before and after it in its column
+    by linear interpolation between them. NaNs before the first or after the
+    last valid value of a column are kept.
+
+    times: Increasing 1-D array of observation times
+    obs: 2-D array with one row per time
+    """
+
+    n,k=obs.shape
+
+    valid=np.isfinite(obs)
+    index=np.arange(n)[:,np.newaxis]
+
+    # Nearest valid row at or before, and at or after, each row
+    prev=np.maximum.accumulate(np.where(valid,index,-1),axis=0)
+    following=np.minimum.accumulate(np.where(valid,index,n)[::-1],axis=0)[::-1]
+
+    inside=(prev>=0)&(following<n)
+    prev=np.where(inside,prev,0)
+    following=np.where(inside,following,0)
+
+    columns=np.arange(k)[np.newaxis,:]
+    t0=times[prev]
+    span=times[following]-t0
+    weight=np.divide(times[:,np.newaxis]-t0,span,
+                     out=np.zeros_like(span,dtype=float),where=span>0)
+
+    filled=obs[prev,columns]*(1-weight)+obs[following,columns]*weight
+
+    return np.where(inside,filled,np.nan)
+
+def interpolate_rows(times,values,t):
+    """
+    Linearly interpolate every column of values at time t, with the same
+    arithmetic as scipy's interp1d
+    """
+
+    i=np.clip(np.searchsorted(times,t),1,len(times)-1)
+
+    t0=times[i-1]
+    t1=times[i]
+
+    interpolated=(values[i]-values[i-1])/(t1-t0)*(t-t0)+values[i-1]
+
+    # At an observation time the previous row may be before a column's
+    # first valid value
+    if times[i]==t:
+        interpolated=np.where(np.isfinite(interpolated),interpolated,values[i])
+
+    return interpolated
+
+def average_observations(times,obs,tstart,tend):
+    """
+    Time average of each column of obs over tstart - tend, linearly
+    interpolating between valid observations.
+
+    Columns without a valid observation at or before tstart and another at
+    or after tend average to NaN.
+
+    times: Increasing 1-D array of observation times
+    obs: 2-D array with one row per time and NaN for missing values
+
+    Returns: 1-D array of averages
+    """
+
+    n,k=obs.shape
+
+    if n<2:
+        return np.full(k,np.nan)
+
+    valid=np.isfinite(obs)
+    any_valid=valid.any(axis=0)
+    first=np.where(any_valid,times[np.argmax(valid,axis=0)],np.inf)
+    last=np.where(any_valid,times[n-1-np.argmax(valid[::-1],axis=0)],-np.inf)
+    spans=(valid.sum(axis=0)>=2)&(first<=tstart)&(last>=tend)
+
+    # Filled values lie on the lines between valid values, so including
+    # them leaves the trapezoid integral of each column unchanged
+    filled=fill_gaps(times,obs)
+
+    mid=(times>tstart)&(times<tend)
+
+    t=np.concatenate([[tstart],times[mid],[tend]])
+
+    # One contiguous row per variable, so each is summed as a 1-D
+    # integral would be
+    y=np.ascontiguousarray(np.vstack([interpolate_rows(times,filled,tstart),
+                                      filled[mid],
+                                      interpolate_rows(times,filled,tend)]).T)
+
+    averages=np.trapz(y,t,axis=1)/(tend-tstart)
+
+    return np.where(spans,averages,np.nan)
+
+def average_intervals(times,obs,tstarts,tends,max_gap=np.inf):
+    """
+    Time averages of each column of obs over many intervals at once.
+
+    The integral of each column from the first observation is computed once
+    as a cumulative trapezoid sum, so each interval costs two binary
+    searches. Values are interpolated as in average_observations.
+
+    An interval's average of a column is NaN unless the column has a valid
+    observation at most max_gap before the interval starts and another at
+    most max_gap after it ends.
+
+    times: Increasing 1-D array of observation times
+    obs: 2-D array with one row per time and NaN for missing values
+    tstarts, tends: 1-D arrays of interval start and end times
+
+    Returns: 2-D array with one row of averages per interval
+    """
+
+    tstarts=np.asarray(tstarts,dtype=float)
+    tends=np.asarray(tends,dtype=float)
+
+    n,k=obs.shape
+    m=len(tstarts)
+
+    if n<2:
+        return np.full((m,k),np.nan)
+
+    valid=np.isfinite(obs)
+    index=np.arange(n)[:,np.newaxis]
+
+    # Times of the nearest valid observation at or before, and at or
+    # after, each row
+    prev=np.maximum.accumulate(np.where(valid,index,-1),axis=0)
+    following=np.minimum.accumulate(np.where(valid,index,n)[::-1],axis=0)[::-1]
+    prev_time=np.where(prev>=0,times[np.maximum(prev,0)],-np.inf)
+    following_time=np.where(following<n,times[np.minimum(following,n-1)],np.inf)
+
+    filled=fill_gaps(times,obs)
+
+    # Integral of each column from the first observation to each row
+    steps=np.diff(times)[:,np.newaxis]*(filled[1:]+filled[:-1])/2
+    cumulative=np.vstack([np.zeros((1,k)),np.cumsum(np.nan_to_num(steps),axis=0)])
+
+    def integral_to(t):
+        i=np.clip(np.searchsorted(times,t,side='right')-1,0,n-2)
+        t0=times[i][:,np.newaxis]
+        span=times[i+1][:,np.newaxis]-t0
+        dt=t[:,np.newaxis]-t0
+        weight=np.divide(dt,span,out=np.zeros_like(dt),where=span>0)
+        value=filled[i]*(1-weight)+filled[i+1]*weight
+        # Past the last observation only the row itself counts
+        value=np.where(weight==0,filled[i],value)
+        return cumulative[i]+dt*(filled[i]+value)/2
+
+    start_row=np.clip(np.searchsorted(times,tstarts,side='right')-1,0,n-1)
+    end_row=np.clip(np.searchsorted(times,tends,side='left'),0,n-1)
+
+    covered=(times[start_row][:,np.newaxis]<=tstarts[:,np.newaxis]) \
+        & (prev_time[start_row]>=tstarts[:,np.newaxis]-max_gap) \
+        & (times[end_row][:,np.newaxis]>=tends[:,np.newaxis]) \
+        & (following_time[end_row]<=tends[:,np.newaxis]+max_gap) \
+        & (tends>tstarts)[:,np.newaxis]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        averages=(integral_to(tends)-integral_to(tstarts)) \
+            /(tends-tstarts)[:,np.newaxis]
+
+    return np.where(covered,averages,np.nan)
+
+def wind_to_polar(values):
+    """
+    Replace the wind_e and wind_n averages in a dict of averages by winddir
+    and windspeed
+    """
+
+    # Convert wind components to polar coordinates
+    winddir=(90-np.arctan2(values['wind_n'],values['wind_e'])*180/np.pi)%360
+    values['winddir']=winddir
+    values['windspeed']=np.sqrt(values['wind_n']**2+values['wind_e']**2)
+
+    # Delete Cartesian wind components
+    del values['wind_n']
+    del values['wind_e']
+
+    return values
@@ -0,0 +1,168 @@
+import threading
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+default_config_uri='/run/secrets/production.ini'
+
+default_ogimet_url='https://www.ogimet.com/display_metars2.php'
+
+def load_settings(config_uri=default_config_uri):
+    """
+    Read the application settings from a config file without creating the
+    application
+    """
+
+    from pyramid.paster import get_appsettings
+
+    try:
+        return get_appsettings(config_uri)
+    except FileNotFoundError:
+        logger.warning('Settings file {} does not exist, using default weather settings'.format(config_uri))
+        return {}
+
+class worker_context(object):
+    """
+    Resources a worker process keeps between tasks: the application
+    settings, a pooled HTTP session and concurrent fetcher for OGIMET, the
+    weather station registry, the station observation cache, the model
+    training scheduler and the METAR parser settings.
+
+    The context is built once per process, from the settings loaded by
+    bootstrap_pyramid when there are any. reload() rereads the config file
+    and replaces the resources. request_reload() makes every worker do so
+    before its next download, if Redis is available.
+    """
+
+    version_key='worker_context:version'
+
+    def __init__(self,settings=None,config_uri=default_config_uri,redis=None):
+        from .stations import station_registry
+        from .observation_cache import observation_cache
+        from .training_scheduler import training_scheduler
+
+        self.config_uri=config_uri
+        self.redis=redis
+        self.lock=threading.RLock()
+        self.version=self.get_version()
+        self.http_session=None
+        self.fetcher=None
+        self.stations=station_registry(redis=redis)
+        self.observations=observation_cache(redis=redis)
+        self.training=training_scheduler(redis=redis)
+
+        self.load(settings)
+
+    def load(self,settings=None):
+
+        from .async_fetch import concurrent_fetcher, pooled_session, ogimet_fetch_concurrency
+        from .observation_cache import observation_cache_size
+        from .training_scheduler import training_quiet_period
+        from .weather import metar_store_batch_size
+
+        if settings is None:
+            settings=load_settings(self.config_uri)
+
+        concurrency=int(settings.get('ogimet_fetch_concurrency',
+                                     ogimet_fetch_concurrency))
+
+        with self.lock:
+            self.close()
+
+            self.settings=settings
+            self.ogimet_url=settings.get('ogimet_url',default_ogimet_url)
+            self.metar_store_batch_size=int(settings.get(
+                'metar_store_batch_size',metar_store_batch_size))
+            self.observations.maxsize=int(settings.get(
+                'observation_cache_size',observation_cache_size))
+            self.training.quiet_period=float(settings.get(
+                'train_model_quiet_period',training_quiet_period))
+            self.http_session=pooled_session(concurrency)
+            self.fetcher=concurrent_fetcher(concurrency,session=self.http_session)
+
+    def close(self):
+
+        with self.lock:
+            if self.fetcher is not None:
+                self.fetcher.close()
+                self.fetcher=None
+            if self.http_session is not None:
+                self.http_session.close()
+                self.http_session=None
+
+    def reload(self,settings=None):
+        """
+        Reread the settings and replace the HTTP session and fetcher. Cached
+        stations and observations are dropped.
+        """
+
+        logger.info('Reloading worker context')
+
+        with self.lock:
+            self.load(settings)
+            self.stations.clear()
+            self.observations.clear()
+
+    def get_version(self):
+
+        if self.redis is None:
+            return None
+
+        return self.redis.get(self.version_key)
+
+    def check_version(self):
+        """
+        Reload if another process has requested it
+        """
+
+        if self.redis is None:
+            return
+
+        version=self.get_version()
+
+        with self.lock:
+            if version!=self.version:
+                self.version=version
+                self.reload()
+
+    def request_reload(self):
+        """
+        Reload this context and ask every other worker to reload theirs
+        """
+
+        self.reload()
+
+        if self.redis is not None:
+            self.redis.incr(self.version_key)
+            self.version=self.get_version()
+
+context=None
+context_lock=threading.Lock()
+
+def init_worker_context(settings=None):
+    """
+    Build this process's context, replacing any existing one
+    """
+
+    global context
+
+    from ..celery import get_redis
+
+    with context_lock:
+        if context is not None:
+            context.close()
+        context=worker_context(settings,redis=get_redis())
+
+    return context
+
+def get_worker_context():
+
+    global context
+
+    with context_lock:
+        if context is None:
+            from ..celery import get_redis
+            context=worker_context(redis=get_redis())
+
+    return context
@@ -30,3 +30,5 @@ def includeme(config):
     config.add_route('equipment_table','/equipment/list')
     config.add_route('ogimet_requests','/ogimet_rate_limiting')
     config.add_route('fill_missing_weather','/fill_missing_weather')
+    config.add_route('weather_cache_stats','/weather_cache_stats')
+    config.add_route('metrics','/metrics')
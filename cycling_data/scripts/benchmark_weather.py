@@ -0,0 +1,433 @@
+import argparse
+import sys
+import time
+
+def synthetic_ogimet_text(days,station='KDCA',interval_minutes=60):
+    """
+    Generate an OGIMET text response with one report per interval for the
+    given number of days. Every third report is split over two lines, as
+    OGIMET does for long reports.
+    """
+
+    from datetime import datetime, timedelta
+
+    lines=[
+        '##########################################################',
+        '# Query made at 01/19/2020 16:18:32 UTC',
+        '##########################################################',
+        '',
+        '###################################',
+        '#  METAR/SPECI from {}'.format(station),
+        '###################################',
+    ]
+
+    t=datetime(2005,1,1)
+    end=t+timedelta(days)
+    i=0
+
+    while t<end:
+        head='{} METAR {} {}Z 20007KT 5SM BR SCT250 04/03 A3031 RMK'.format(
+            t.strftime('%Y%m%d%H%M'),station,t.strftime('%d%H%M'))
+        if i%3==0:
+            lines.append(head)
+            lines.append('                        AO2 SLP261 T00390028=')
+        else:
+            lines.append(head+' AO2 SLP261 T00390028=')
+        t+=timedelta(minutes=interval_minutes)
+        i+=1
+
+    return '\n'.join(lines)+'\n'
+
+def extract_metars_partition(text):
+    """
+    The previous extractor, which re-partitions the remaining text for
+    every report. Kept here for comparison.
+    """
+
+    from datetime import datetime
+
+    dates=[]
+    metars=[]
+
+    while True:
+
+        head,sep,text=text.partition('=\n')
+
+        if len(head)==0: break
+
+        if head.startswith('#') or head.startswith('\n'):
+            head,sep,text=text.partition('\n')
+
+        if head[:12].isdigit():
+            date=datetime.strptime(head[:12],'%Y%m%d%H%M%S')
+            dates.append(date)
+            metar=head[13:]
+            if(metar.endswith('$')): metar=metar[:-1]
+            if metar.startswith('METAR') or metar.startswith('SPECI'):
+                metars.append(metar)
+
+    return dates,metars
+
+def average_weather_loop(metars,dtstart,dtend,altitude):
+    """
+    Previous implementation of average_weather, kept for comparison
+    """
+
+    from scipy.interpolate import interp1d
+
+    from pytz import utc
+    import numpy as np
+
+    metars=sorted(metars, key=lambda metar: metar.report_time)
+    
+    total_time=min(metars[-1].report_time.replace(tzinfo=utc),dtend)-max(metars[0].report_time.replace(tzinfo=utc),dtstart)
+
+    values={
+        'wind_e':0,
+        'wind_n':0,
+        'temperature':0,
+        'gust':0,
+        'dewpoint':0,
+        'rain':0,
+        'snow':0,
+        'pressure':0
+    }
+    
+    dtstart64=np.datetime64(dtstart.astimezone(utc))
+    dtend64=np.datetime64(dtend.astimezone(utc))
+
+    times=np.array([np.datetime64(metar.report_time.replace(tzinfo=utc)) for metar in metars])
+    start_ind=np.searchsorted(times,dtstart64)
+    end_ind=np.searchsorted(times,dtend64)
+
+    winddir=np.array([metar.winddir for metar in metars],dtype=float)
+    windspeed=np.array([metar.windspeed for metar in metars],dtype=float)
+
+    for key in values.keys():
+
+        if key in ('rain','snow'):
+            # Decoded from the report when it was stored
+            obs=np.array([getattr(metar,key) for metar in metars],dtype=float)
+        elif key=='wind_e':
+            obs=np.cos((90-winddir)*np.pi/180)*windspeed
+        elif key=='wind_n':
+            obs=np.sin((90-winddir)*np.pi/180)*windspeed
+        else:
+            obs=np.array([getattr(metar.weather_at_altitude(altitude),key) for metar in metars]).astype(float)
+
+        obs_valid=np.isfinite(obs)
+
+        if np.count_nonzero(obs_valid)<2:
+            values[key] = np.nan
+            continue
+
+        if times[obs_valid][0]>dtstart64 or times[obs_valid][-1]<dtend64:
+            values[key] = np.nan
+            continue
+
+        interpolator=interp1d(times[obs_valid].astype(float),obs[obs_valid])
+
+        obs_start=interpolator(dtstart64.astype(float))
+        obs_end=interpolator(dtend64.astype(float))
+
+        # Observations taken during interval
+        mid_mask=np.logical_and(obs_valid,np.logical_and(times>dtstart64,times<dtend64))
+
+        obs_avg=np.trapz(
+            np.concatenate([[obs_start],obs[mid_mask],[obs_end]]),
+            np.concatenate([[dtstart64],times[mid_mask],[dtend64]]).astype(float)
+        )/(dtend64-dtstart64).astype(float)
+
+        values[key] = obs_avg
+
+    # Convert wind components to polar coordinates
+    winddir=(90-np.arctan2(values['wind_n'],values['wind_e'])*180/np.pi)%360
+    values['winddir']=winddir
+    values['windspeed']=np.sqrt(values['wind_n']**2+values['wind_e']**2)
+
+    # Delete Cartesian wind components
+    del values['wind_n']
+    del values['wind_e']
+
+    return values
+
+def synthetic_station_reports(days,interval_minutes=60,missing_fraction=0.1,seed=0):
+    """
+    StationWeatherData reports with a daily temperature cycle and randomly
+    missing values
+    """
+
+    import random
+    import math
+    from datetime import datetime, timedelta
+    from ..models.cycling_models import Location, StationWeatherData
+
+    rng=random.Random(seed)
+
+    station=Location(name='KDCA',loctype_id=2,elevation=5.)
+
+    def maybe(value):
+        return None if rng.random()<missing_fraction else value
+
+    reports=[]
+    t0=datetime(2021,5,1)
+
+    for i in range(int(days*24*60/interval_minutes)):
+        report_time=t0+timedelta(minutes=i*interval_minutes+rng.uniform(-5,5))
+        temperature=15+8*math.sin(2*math.pi*report_time.hour/24)
+        reports.append(StationWeatherData(
+            station=station,
+            report_time=report_time,
+            windspeed=maybe(rng.uniform(0,20)),
+            winddir=maybe(rng.uniform(0,360)),
+            gust=maybe(rng.uniform(20,30)),
+            temperature=maybe(temperature),
+            dewpoint=maybe(temperature-rng.uniform(1,10)),
+            pressure=maybe(rng.uniform(1000,1030)),
+            rain=maybe(rng.choice([0,0,0,0.2,0.3])),
+            snow=maybe(0.)))
+
+    return reports
+
+def measure(fun,*args):
+    """
+    Run fun(*args) and return its run time (s) and peak traced memory (MB)
+    """
+
+    import tracemalloc
+
+    tracemalloc.start()
+    start=time.perf_counter()
+    fun(*args)
+    elapsed=time.perf_counter()-start
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed,peak/1e6
+
+def benchmark_parser(args):
+    import os
+    import tempfile
+    from collections import deque
+    from ..processing.ogimet_parser import iter_metars_from_ogimet
+
+    def stream_file(path):
+        with open(path) as fh:
+            # Consume the reports without keeping them
+            deque(iter_metars_from_ogimet(fh),maxlen=0)
+
+    print('{:>7} {:>9} {:>14} {:>14} {:>14} {:>14}'.format(
+        'months','reports','old time (s)','new time (s)','old peak (MB)','new peak (MB)'))
+
+    for months in args.months:
+
+        text=synthetic_ogimet_text(days=months*30,interval_minutes=args.interval)
+
+        with tempfile.NamedTemporaryFile('w',suffix='.txt',delete=False) as fh:
+            fh.write(text)
+            path=fh.name
+
+        try:
+            # The old extractor is given the text in memory, as it was
+            # in download_metars
+            if months<=args.max_old_months:
+                old_time,old_peak=measure(extract_metars_partition,text)
+            else:
+                old_time,old_peak=float('nan'),float('nan')
+
+            del text
+
+            new_time,new_peak=measure(stream_file,path)
+            with open(path) as fh:
+                count=sum(1 for report in iter_metars_from_ogimet(fh))
+        finally:
+            os.remove(path)
+
+        print('{:>7} {:>9} {:>14.3f} {:>14.3f} {:>14.2f} {:>14.2f}'.format(
+            months,count,old_time,new_time,old_peak,new_peak))
+
+def benchmark_average(args):
+    from datetime import timedelta
+    from pytz import utc
+    import numpy as np
+    from ..processing.weather import average_weather
+
+    print('{:>8} {:>8} {:>14} {:>14} {:>10} {:>12}'.format(
+        'reports','rides','old time (s)','new time (s)','speedup','max diff'))
+
+    for reports_per_ride in args.reports:
+
+        # Hourly reports, so a ride window holds about reports_per_ride
+        reports=synthetic_station_reports(days=args.rides+reports_per_ride/24+1)
+
+        windows=[]
+        for i in range(args.rides):
+            dtstart=(reports[0].report_time+timedelta(hours=24*i+3)).replace(tzinfo=utc)
+            dtend=dtstart+timedelta(hours=reports_per_ride)
+            window=[report for report in reports
+                    if dtstart-timedelta(hours=4)<=report.report_time.replace(tzinfo=utc)<=dtend+timedelta(hours=4)]
+            windows.append((window,dtstart,dtend))
+
+        results={}
+
+        def run(fun,key):
+            results[key]=[fun(window,dtstart,dtend,100.) for window,dtstart,dtend in windows]
+
+        old_time,old_peak=measure(run,average_weather_loop,'old')
+        new_time,new_peak=measure(run,average_weather,'new')
+
+        max_diff=0.
+        for old,new in zip(results['old'],results['new']):
+            for key in old:
+                if np.isnan(old[key]) and np.isnan(new[key]): continue
+                max_diff=max(max_diff,abs(old[key]-new[key]))
+
+        print('{:>8} {:>8} {:>14.4f} {:>14.4f} {:>10.1f} {:>12.2e}'.format(
+            reports_per_ride,args.rides,old_time,new_time,old_time/new_time,max_diff))
+
+def benchmark_rides(args):
+    from datetime import timedelta
+    from pytz import utc
+    import numpy as np
+    from ..processing.weather import average_weather, average_rides_weather
+
+    print('{:>8} {:>8} {:>14} {:>14} {:>10} {:>12}'.format(
+        'days','rides','per ride (s)','batch (s)','speedup','max diff'))
+
+    for rides_per_day in args.rides_per_day:
+
+        reports=synthetic_station_reports(days=args.days,interval_minutes=30)
+        t0=reports[0].report_time.replace(tzinfo=utc)
+
+        rides=[]
+        for i in range(int(rides_per_day*(args.days-1))):
+            dtstart=t0+timedelta(hours=5+24*i/rides_per_day)
+            rides.append((dtstart,dtstart+timedelta(hours=1.5),100.))
+
+        results={}
+
+        def run_each():
+            # One station timeline per ride, as update_ride_weather builds it
+            results['each']=[average_weather(
+                [report for report in reports
+                 if dtstart-timedelta(hours=4)<=report.report_time.replace(tzinfo=utc)<=dtend+timedelta(hours=4)],
+                dtstart,dtend,altitude) for dtstart,dtend,altitude in rides]
+
+        def run_batch():
+            results['batch']=average_rides_weather(reports,rides)
+
+        each_time,each_peak=measure(run_each)
+        batch_time,batch_peak=measure(run_batch)
+
+        max_diff=0.
+        for each,batch in zip(results['each'],results['batch']):
+            for key in each:
+                if np.isnan(each[key]) and np.isnan(batch[key]): continue
+                max_diff=max(max_diff,abs(each[key]-batch[key]))
+
+        print('{:>8} {:>8} {:>14.4f} {:>14.4f} {:>10.1f} {:>12.2e}'.format(
+            args.days,len(rides),each_time,batch_time,each_time/batch_time,max_diff))
+
+def benchmark_context(args):
+    from pyramid.paster import bootstrap
+    from ..processing.worker_context import worker_context
+
+    def bootstrap_settings():
+        return bootstrap(args.config_uri)['registry'].settings
+
+    def bootstrap_url():
+        # What each download did before the worker context
+        return bootstrap_settings()['ogimet_url']
+
+    def repeat(fun,calls):
+        for i in range(calls):
+            fun()
+
+    context=None
+
+    def start_context(settings):
+        # As in bootstrap_pyramid, which passes its settings on
+        nonlocal context
+        context=worker_context(settings)
+
+    def context_url():
+        context.check_version()
+        return context.ogimet_url
+
+    # Import the application before timing anything
+    bootstrap_url()
+
+    # Workers bootstrap once at startup either way; the context is built
+    # in addition to that
+    old_startup,old_startup_peak=measure(bootstrap_url)
+    context_startup,context_peak=measure(start_context,bootstrap_settings())
+    new_startup=old_startup+context_startup
+    new_startup_peak=max(old_startup_peak,context_peak)
+
+    old_time,old_peak=measure(repeat,bootstrap_url,args.calls)
+    new_time,new_peak=measure(repeat,context_url,args.calls)
+
+    context.close()
+
+    print('{:>12} {:>14} {:>14} {:>14} {:>14}'.format(
+        '','old time (s)','new time (s)','old peak (MB)','new peak (MB)'))
+    print('{:>12} {:>14.6f} {:>14.6f} {:>14.2f} {:>14.2f}'.format(
+        'startup',old_startup,new_startup,old_startup_peak,new_startup_peak))
+    print('{:>12} {:>14.6f} {:>14.6f} {:>14.2f} {:>14.2f}'.format(
+        'per task',old_time/args.calls,new_time/args.calls,old_peak,new_peak))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the weather processing pipeline')
+    subparsers=parser.add_subparsers(dest='benchmark')
+    subparsers.required=True
+
+    parser_parser=subparsers.add_parser(
+        'parser',help='OGIMET response parsing')
+    parser_parser.add_argument(
+        '--months',type=int,nargs='+',default=[1,3,6,12,24],
+        help='Lengths of the synthetic station dumps, in months')
+    parser_parser.add_argument(
+        '--interval',type=int,default=20,
+        help='Minutes between synthetic reports')
+    parser_parser.add_argument(
+        '--max-old-months',type=int,default=12,
+        help='Skip the old parser for dumps longer than this')
+    parser_parser.set_defaults(func=benchmark_parser)
+
+    average_parser=subparsers.add_parser(
+        'average',help='Ride weather averaging')
+    average_parser.add_argument(
+        '--reports',type=int,nargs='+',default=[1,4,12,48],
+        help='Ride lengths, in hours (about one report an hour)')
+    average_parser.add_argument(
+        '--rides',type=int,default=200,
+        help='Number of rides averaged for each length')
+    average_parser.set_defaults(func=benchmark_average)
+
+    rides_parser=subparsers.add_parser(
+        'rides',help='Averaging many rides against one station timeline')
+    rides_parser.add_argument(
+        '--days',type=int,default=60,
+        help='Length of the station timeline, in days')
+    rides_parser.add_argument(
+        '--rides-per-day',type=float,nargs='+',default=[0.5,2,8],
+        help='Rides per day of the timeline')
+    rides_parser.set_defaults(func=benchmark_rides)
+
+    context_parser=subparsers.add_parser(
+        'context',help='Worker startup and per-task settings overhead')
+    context_parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    context_parser.add_argument(
+        '--calls',type=int,default=20,
+        help='Number of simulated tasks')
+    context_parser.set_defaults(func=benchmark_context)
+
+    return parser.parse_args(argv[1:])
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    args.func(args)
@@ -0,0 +1,394 @@
+import argparse
+import sys
+import os
+import json
+from collections import deque
+from datetime import datetime, timedelta
+
+from pyramid.paster import bootstrap, setup_logging
+
+from .. import models
+
+# Consecutive reports from a station further apart than this are not taken
+# as covering the time between them
+max_report_gap=timedelta(hours=3)
+
+# Column names recognized in CSV dumps, in order of preference
+csv_time_columns=['valid','observation_time','report_time','datetime','date','time']
+csv_metar_columns=['metar','raw_text','report']
+
+class line_counter(object):
+    """
+    Iterate over the lines of a file, counting the lines consumed
+    """
+
+    def __init__(self,lines):
+        self.lines=iter(lines)
+        self.count=0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line=next(self.lines)
+        self.count+=1
+        return line
+
+    def skip_to(self,line_number):
+        while self.count<line_number:
+            try:
+                next(self)
+            except StopIteration:
+                break
+
+def open_archive(path):
+    import gzip
+
+    if path.endswith('.gz'):
+        return gzip.open(path,'rt',encoding='utf-8',errors='replace')
+
+    return open(path,encoding='utf-8',errors='replace')
+
+def archive_format(path):
+    name=path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.lower().endswith('.csv') else 'ogimet'
+
+def iter_ogimet_reports(lines,skip=0):
+    """
+    Yield (date, metar, line) tuples from an OGIMET text archive, where line
+    is the number of lines read through the end of the report
+    """
+
+    from ..processing.ogimet_parser import iter_metars_from_ogimet
+
+    lines.skip_to(skip)
+
+    for date,metar in iter_metars_from_ogimet(lines):
+        yield date,metar,lines.count
+
+def parse_csv_time(value):
+    """
+    Parse an ISO 8601 report time into a naive UTC datetime, like the times
+    from every other source
+    """
+
+    from ..processing.coverage import to_naive_utc
+
+    value=value.strip()
+    if value.endswith('Z'): value=value[:-1]
+    return to_naive_utc(datetime.fromisoformat(value.replace('T',' ')))
+
+def iter_csv_reports(lines,skip=0):
+    """
+    Yield (date, metar, line) tuples from a CSV dump with a column of report
+    times and a column of raw METAR codes, such as the Iowa Environmental
+    Mesonet ASOS downloads or the NOAA Aviation Weather Center METAR
+    files. Lines before the header are skipped.
+    """
+
+    import csv
+
+    reader=csv.reader(lines)
+
+    for header in reader:
+        columns=[column.strip().lower() for column in header]
+        time_column=next((columns.index(name) for name in csv_time_columns
+                          if name in columns),None)
+        metar_column=next((columns.index(name) for name in csv_metar_columns
+                           if name in columns),None)
+        if time_column is not None and metar_column is not None:
+            break
+    else:
+        raise ValueError('No report time and METAR columns found')
+
+    lines.skip_to(skip)
+
+    for row in reader:
+
+        if len(row)<=max(time_column,metar_column): continue
+
+        metar=row[metar_column].strip()
+        if metar in ('','M'): continue
+
+        if metar.endswith('='): metar=metar[:-1]
+
+        try:
+            date=parse_csv_time(row[time_column])
+        except ValueError:
+            continue
+
+        yield date,metar,lines.count
+
+def iter_chunks(reports,chunk_size):
+    """
+    Group reports into chunks
+
+    Yields: (reports, line) tuples, where reports is a list of (date,
+        metar) tuples and line is the number of lines read through the end
+        of the chunk
+    """
+
+    chunk=[]
+    line=0
+
+    for date,metar,line in reports:
+        chunk.append((date,metar))
+        if len(chunk)>=chunk_size:
+            yield chunk,line
+            chunk=[]
+
+    if len(chunk)>0:
+        yield chunk,line
+
+def parse_reports(reports):
+    """
+    Parse reports into StationWeatherData attribute values. Runs in a worker
+    process.
+
+    Returns: List of (station name, fields) tuples and the number of reports
+        that could not be parsed
+    """
+
+    from ..processing.weather import parse_metar_code
+    from ..models.cycling_models import metar_fields
+
+    parsed=[]
+    failed=0
+
+    for date,code in reports:
+        try:
+            metar,parse_error=parse_metar_code(date,code)
+        except Exception:
+            failed+=1
+            continue
+
+        if metar.station_id is None or metar.time is None:
+            failed+=1
+            continue
+
+        fields=metar_fields(metar)
+        fields['parse_error']=parse_error
+        parsed.append((metar.station_id,fields))
+
+    return parsed,failed
+
+def load_state(path):
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as fh:
+        return json.load(fh)
+
+def save_state(path,state):
+
+    # Replace the file in one step so an interrupted write cannot corrupt it
+    tmp_path=path+'.tmp'
+    with open(tmp_path,'w') as fh:
+        json.dump(state,fh,indent=1)
+    os.replace(tmp_path,path)
+
+class archive_importer(object):
+    """
+    Store parsed reports and the coverage they imply, one chunk per
+    transaction, recording progress in the state file after each chunk.
+    """
+
+    def __init__(self,dbsession,state,state_path,registry):
+        self.dbsession=dbsession
+        self.state=state
+        self.state_path=state_path
+        self.registry=registry
+        self.stored=0
+        self.failed=0
+
+    def store_chunk(self,file_state,reports,failed,line):
+
+        import transaction
+        from ..processing.weather import store_metar_fields
+
+        store_metar_fields(reports,self.dbsession,self.registry,reload=False)
+
+        with transaction.manager:
+            self.record_coverage(file_state['runs'],reports)
+
+        self.stored+=len(reports)
+        self.failed+=failed
+
+        file_state['line']=line
+        save_state(self.state_path,self.state)
+
+    def record_coverage(self,runs,reports):
+        """
+        Extend the runs of reports of each station with a chunk and record
+        the time they gained as fetched. Runs are kept in the file state, so
+        they continue across chunks and resumed imports.
+        """
+
+        from ..models.cycling_models import WeatherFetchLog
+        from ..processing.coverage import record_coverage
+        from ..processing.station_quality import record_report_days
+
+        times={}
+        for station_name,fields in reports:
+            times.setdefault(station_name,[]).append(fields['report_time'])
+
+        station_ids=self.registry.resolve(self.dbsession,times.keys())
+
+        fetch_time=datetime.utcnow()
+
+        # Lock the stations' coverage in the same order in every importer
+        for station_name,station_times in sorted(times.items()):
+
+            station_id=station_ids[station_name]
+
+            run=runs.get(station_name)
+            if run is not None:
+                run_start,run_end=[datetime.fromisoformat(t) for t in run]
+            else:
+                run_start=run_end=None
+
+            # Earlier chunks recorded the run up to its end
+            recorded_end=run_end
+
+            intervals=[]
+
+            for report_time in sorted(station_times):
+                if run_end is not None and report_time<=run_end:
+                    continue
+                if run_end is None or report_time-run_end>max_report_gap:
+                    if run_end is not None and run_end>recorded_end:
+                        intervals.append((recorded_end,run_end))
+                    run_start=recorded_end=report_time
+                run_end=report_time
+
+            if run_end>recorded_end:
+                intervals.append((recorded_end,run_end))
+
+            runs[station_name]=[run_start.isoformat(),run_end.isoformat()]
+
+            for dtstart,dtend in intervals:
+                self.dbsession.add(WeatherFetchLog(time=fetch_time,
+                                                   station_id=station_id,
+                                                   dtstart=dtstart,
+                                                   dtend=dtend))
+                record_coverage(self.dbsession,station_id,dtstart,dtend,fetch_time)
+                record_report_days(self.dbsession,station_id,dtstart,dtend,fetch_time)
+
+    def import_archive(self,path,archive_format,pool,chunk_size,max_pending):
+
+        key=os.path.abspath(path)
+        stat=os.stat(path)
+
+        file_state=self.state.get(key)
+
+        if file_state is None or file_state['size']!=stat.st_size \
+           or file_state['mtime']!=stat.st_mtime:
+            file_state={'size':stat.st_size,'mtime':stat.st_mtime,
+                        'line':0,'runs':{},'complete':False}
+            self.state[key]=file_state
+
+        if file_state['complete']:
+            print('{}: already imported'.format(path))
+            return
+
+        if file_state['line']>0:
+            print('{}: resuming after line {}'.format(path,file_state['line']))
+
+        self.stored=0
+        self.failed=0
+
+        with open_archive(path) as fh:
+
+            lines=line_counter(fh)
+
+            if archive_format=='csv':
+                reports=iter_csv_reports(lines,file_state['line'])
+            else:
+                reports=iter_ogimet_reports(lines,file_state['line'])
+
+            # Parse chunks in the worker processes while storing earlier
+            # ones, keeping only a few chunks in memory
+            pending=deque()
+
+            for chunk,line in iter_chunks(reports,chunk_size):
+                pending.append((pool.apply_async(parse_reports,(chunk,)),line))
+                if len(pending)>=max_pending:
+                    result,line=pending.popleft()
+                    self.store_chunk(file_state,*result.get(),line)
+                    print('{}: {} reports stored, line {}'.format(path,self.stored,line))
+
+            while len(pending)>0:
+                result,line=pending.popleft()
+                self.store_chunk(file_state,*result.get(),line)
+
+        file_state['complete']=True
+        save_state(self.state_path,self.state)
+
+        print('{}: done, {} reports stored, {} could not be parsed'.format(
+            path,self.stored,self.failed))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Import METAR reports from local archive files without contacting OGIMET')
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        'archives',nargs='+',
+        help='Archive files: OGIMET text responses or CSV METAR dumps, optionally gzipped'
+    )
+    parser.add_argument(
+        '--format',choices=['auto','ogimet','csv'],default='auto',
+        help='Archive format (default: guess from the file extension)'
+    )
+    parser.add_argument(
+        '--workers',type=int,default=os.cpu_count(),
+        help='Number of parser processes'
+    )
+    parser.add_argument(
+        '--chunk-size',type=int,default=2000,
+        help='Reports stored per transaction'
+    )
+    parser.add_argument(
+        '--state-file',default='import_metar_archive.state.json',
+        help='File recording import progress, used to resume interrupted imports'
+    )
+    parser.add_argument(
+        '--restart',action='store_true',
+        help='Ignore the progress recorded in the state file'
+    )
+    return parser.parse_args(argv[1:])
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+
+    import multiprocessing
+    import transaction
+    from ..processing.stations import station_registry
+
+    env = bootstrap(args.config_uri)
+    settings=env['registry'].settings
+
+    engine=models.get_engine(settings)
+    session_factory=models.get_session_factory(engine)
+    dbsession=models.get_tm_session(session_factory,transaction.manager)
+
+    state={} if args.restart else load_state(args.state_file)
+
+    # Only stations that already exist are cached, so the import needs no
+    # invalidation from other processes
+    importer=archive_importer(dbsession,state,args.state_file,station_registry())
+
+    workers=max(args.workers,1)
+
+    with multiprocessing.Pool(workers) as pool:
+        for path in args.archives:
+            if args.format=='auto':
+                path_format=archive_format(path)
+            else:
+                path_format=args.format
+            importer.import_archive(path,path_format,pool,
+                                    args.chunk_size,max_pending=2*workers)
@@ -0,0 +1,126 @@
+import argparse
+import sys
+import os
+from collections import deque
+
+from pyramid.paster import bootstrap, setup_logging
+
+from .. import models
+
+class ride_weather_recomputer(object):
+    """
+    Recompute ride weather station by station: observations and rides are
+    read in this process, averaged in the worker processes and written back
+    here with bulk updates.
+    """
+
+    def __init__(self,dbsession):
+        self.dbsession=dbsession
+        self.updated=0
+        self.rides=0
+
+    def load_station(self,station_id):
+
+        import transaction
+        from ..processing.recompute import station_rides, station_observations
+
+        with transaction.manager:
+            rides=station_rides(self.dbsession,station_id)
+            if len(rides)==0:
+                return None,rides
+            records=station_observations(self.dbsession,station_id,rides)
+
+        return records,rides
+
+    def store(self,station_id,rides,mappings):
+
+        from ..processing.recompute import write_ride_weather
+
+        write_ride_weather(self.dbsession,mappings)
+
+        self.rides+=len(rides)
+        self.updated+=len(mappings)
+
+        print('Station {}: {} of {} rides updated'.format(
+            station_id,len(mappings),len(rides)))
+
+    def recompute(self,station_ids,pool,max_pending):
+
+        from ..processing.recompute import compute_station_weather
+
+        # Average stations in the worker processes while loading and
+        # storing others, keeping only a few stations in memory
+        pending=deque()
+
+        for station_id in station_ids:
+
+            records,rides=self.load_station(station_id)
+
+            if len(rides)==0:
+                continue
+
+            pending.append((station_id,rides,pool.apply_async(
+                compute_station_weather,(records,rides))))
+
+            if len(pending)>=max_pending:
+                station_id,rides,result=pending.popleft()
+                self.store(station_id,rides,result.get())
+
+        while len(pending)>0:
+            station_id,rides,result=pending.popleft()
+            self.store(station_id,rides,result.get())
+
+        print('Done, {} of {} rides updated'.format(self.updated,self.rides))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Recompute the weather of every ride from stored observations, without contacting OGIMET')
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--station',type=int,nargs='+',
+        help='Only recompute rides with weather from these station ids'
+    )
+    parser.add_argument(
+        '--workers',type=int,default=os.cpu_count(),
+        help='Number of averaging processes'
+    )
+    parser.add_argument(
+        '--train',action='store_true',
+        help='Queue re-training of the prediction models when finished'
+    )
+    return parser.parse_args(argv[1:])
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+
+    import multiprocessing
+    import transaction
+    from ..processing.recompute import ride_weather_stations
+
+    env = bootstrap(args.config_uri)
+    settings=env['registry'].settings
+
+    engine=models.get_engine(settings)
+    session_factory=models.get_session_factory(engine)
+    dbsession=models.get_tm_session(session_factory,transaction.manager)
+
+    if args.station is not None:
+        station_ids=args.station
+    else:
+        with transaction.manager:
+            station_ids=ride_weather_stations(dbsession)
+
+    recomputer=ride_weather_recomputer(dbsession)
+
+    workers=max(args.workers,1)
+
+    with multiprocessing.Pool(workers) as pool:
+        recomputer.recompute(station_ids,pool,max_pending=2*workers)
+
+    if args.train and recomputer.updated>0:
+        from ..processing.regression import request_training
+        request_training()
@@ -11,6 +11,8 @@ import re
 
 import json
 
+import time
+
 from datetime import datetime, timedelta
 
 from pytz import timezone, UTC
@@ -71,6 +73,27 @@ def dict_to_postdata(inputdict):
 mock_task_result=Mock()
 mock_task_result.task_id=0
 
+def get_test_redis(testcase):
+    """
+    Client for a scratch Redis database, emptied first. Skips the test if no
+    Redis server is reachable.
+    """
+
+    import os
+    import redis
+
+    client=redis.Redis.from_url(
+        os.environ.get('TEST_REDIS_URL','redis://localhost:6379/15'))
+
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        testcase.skipTest('No Redis server available')
+
+    client.flushdb()
+
+    return client
+
 def dummy_request(dbsession):
     return testing.DummyRequest(dbsession=dbsession)
 
@@ -97,6 +120,13 @@ class BaseTest(unittest.TestCase):
         from .celery import celery
         celery.conf.update(CELERY_ALWAYS_EAGER=True)
 
+        # Cached station ids and observations refer to rows of a previous
+        # test's database
+        from .processing.stations import get_station_registry
+        from .processing.observation_cache import get_observation_cache
+        get_station_registry().clear()
+        get_observation_cache().clear()
+
     def init_database(self):
         from .models.meta import Base
         Base.metadata.create_all(self.engine)
@@ -394,7 +424,7 @@ class MetarTests(BaseTest):
         
         self.init_database()
 
-    @patch('cycling_data.processing.regression.train_all_models.delay')
+    @patch('cycling_data.processing.regression.request_training')
     @patch('cycling_data.processing.weather.fetch_metars',return_value=mock_ogimet_response)
     def test_fetch_metars_for_ride(self,fetch_metars,train_model):
 
@@ -497,15 +527,15 @@ class MetarTests(BaseTest):
 
             with patch.object(weather,'fetch_metars', return_value=mock_ogimet_response) as fetch_metars_21jul:
 
-                with self.assertRaisesRegex(
-                        RuntimeError,'Too soon since last OGIMET query'):
-                    metars=fetch_metars_for_ride(
-                        session,ride_that_produces_negative_windspeed)
+                metars=fetch_metars_for_ride(
+                    session,ride_that_produces_negative_windspeed)
 
-                fetch_metars_21jul.assert_called_with(
+                # The expanded ride window crosses midnight UTC, but both
+                # days should be fetched in a single request
+                fetch_metars_21jul.assert_called_once_with(
                     'KDCA',
                     ride_that_produces_negative_windspeed.start_time-window_expansion,
-                    ride_that_produces_negative_windspeed.start_time.astimezone(UTC).replace(hour=23,minute=59,second=59),
+                    ride_that_produces_negative_windspeed.end_time+window_expansion,
                     url='https://www.ogimet.com/display_metars2.php'
                 )
 
@@ -532,13 +562,13 @@ class MetarTests(BaseTest):
             ride=session.query(Ride).filter(Ride.id==ride.id).one()
 
             for key in MetarTests.ride_average_weather.keys():
-                self.assertEqual(getattr(ride.wxdata,key),
-                                 MetarTests.ride_average_weather[key],
-                                 'Discrepancy for key {}'.format(key))
+                self.assertAlmostEqual(getattr(ride.wxdata,key),
+                                       MetarTests.ride_average_weather[key],
+                                       msg='Discrepancy for key {}'.format(key))
                 query=session.query(RideWeatherData).with_entities(
                         getattr(RideWeatherData,key)
                 ).filter(RideWeatherData.id==ride.wxdata_id)
-                self.assertEqual(
+                self.assertAlmostEqual(
                     getattr(query.one(),key),
                     MetarTests.ride_average_weather[key])
 
@@ -558,13 +588,13 @@ class MetarTests(BaseTest):
             ride_with_incomplete_endpoint=session.query(Ride).filter(Ride.id==ride_with_incomplete_endpoint.id).one()
 
             for key in MetarTests.ride_average_weather.keys():
-                self.assertEqual(getattr(ride.wxdata,key),
-                                 MetarTests.ride_average_weather[key],
-                                 'Discrepancy for key {}'.format(key))
+                self.assertAlmostEqual(getattr(ride.wxdata,key),
+                                       MetarTests.ride_average_weather[key],
+                                       msg='Discrepancy for key {}'.format(key))
                 query=session.query(RideWeatherData).with_entities(
                         getattr(RideWeatherData,key)
                 ).filter(RideWeatherData.id==ride_with_incomplete_endpoint.wxdata_id)
-                self.assertEqual(
+                self.assertAlmostEqual(
                     getattr(query.one(),key),
                     MetarTests.ride_with_incomplete_endpoint_average_weather[key])
 
@@ -581,16 +611,1583 @@ class MetarTests(BaseTest):
             ride_with_incomplete_startpoint=session.query(Ride).filter(Ride.id==ride_with_incomplete_startpoint.id).one()
 
             for key in MetarTests.ride_average_weather.keys():
-                self.assertEqual(getattr(ride.wxdata,key),
-                                 MetarTests.ride_average_weather[key],
-                                 'Discrepancy for key {}'.format(key))
+                self.assertAlmostEqual(getattr(ride.wxdata,key),
+                                       MetarTests.ride_average_weather[key],
+                                       msg='Discrepancy for key {}'.format(key))
                 query=session.query(RideWeatherData).with_entities(
                         getattr(RideWeatherData,key)
                 ).filter(RideWeatherData.id==ride_with_incomplete_startpoint.wxdata_id)
-                self.assertEqual(
+                self.assertAlmostEqual(
                     getattr(query.one(),key),
                     MetarTests.ride_with_incomplete_endpoint_average_weather[key])
 
+    @patch('cycling_data.processing.regression.request_training')
+    @patch('cycling_data.processing.weather.check_ogimet_request_rate',
+           side_effect=lambda *args: time.time())
+    @patch('cycling_data.processing.weather.fetch_metars',return_value=mock_ogimet_response)
+    def test_update_rides_weather(self,fetch_metars,check_rate,train_model):
+
+        from .processing.weather import update_rides_weather
+        from .models import Ride
+
+        from sqlalchemy.orm import Session
+        from zope.sqlalchemy import ZopeTransactionExtension
+
+        session=Session(self.engine, extension=ZopeTransactionExtension())
+        session.expire_on_commit=False
+
+        import cycling_data
+        with patch.object(cycling_data.celery,'session_factory',
+                          return_value=session):
+
+            with transaction.manager:
+                start=Location(name='Washington Monument',lat=washington_monument.lat,
+                               lon=washington_monument.lon,elevation=washington_monument.elevation)
+                end=Location(name='US Capitol',lat=us_capitol.lat,
+                             lon=us_capitol.lon,elevation=us_capitol.elevation)
+                session.add(Location(name='KDCA',lat=dca.lat,lon=dca.lon,
+                                     elevation=dca.elevation,loctype_id=2))
+                session.add(Location(name='KBWI',lat=bwi.lat,lon=bwi.lon,
+                                     elevation=bwi.elevation,loctype_id=2))
+
+                # The last ride ends after the last report
+                for start_time in (datetime(2005,1,1,10),datetime(2005,1,1,10,20),
+                                   datetime(2005,1,1,14)):
+                    session.add(Ride(start_time=start_time,
+                                     end_time=start_time+timedelta(minutes=15),
+                                     startloc=start,endloc=end))
+
+            with transaction.manager:
+                ride_ids=[ride.id for ride in session.query(Ride).order_by(Ride.start_time)]
+
+            updated=update_rides_weather(ride_ids)
+
+            self.assertEqual(updated,ride_ids[:2])
+
+            # One request for the rides' common window at the nearest
+            # station, and one at the next station for the remaining ride
+            self.assertEqual([call[0][0] for call in fetch_metars.call_args_list],
+                             ['KDCA','KBWI'])
+            train_model.assert_called_once()
+
+            with transaction.manager:
+                ride=session.query(Ride).filter(Ride.id==ride_ids[0]).one()
+                self.assertEqual(ride.wxdata.station.name,'KDCA')
+                for key,value in MetarTests.ride_average_weather.items():
+                    if value is None:
+                        self.assertIsNone(getattr(ride.wxdata,key))
+                    else:
+                        self.assertAlmostEqual(getattr(ride.wxdata,key),value,msg=key)
+                self.assertIsNone(session.query(Ride).filter(Ride.id==ride_ids[2]).one().wxdata)
+
+class FetchPlannerTests(unittest.TestCase):
+
+    def test_plan_fetches(self):
+        from .processing.fetch_planner import plan_fetches, split_by_day
+
+        t0=datetime(2021,3,1,tzinfo=UTC)
+
+        missing=[
+            ('KDCA',t0+timedelta(hours=20),t0+timedelta(hours=23,minutes=59,seconds=59)),
+            ('KDCA',t0+timedelta(days=1),t0+timedelta(days=1,hours=4)),
+            ('KBWI',t0+timedelta(hours=2),t0+timedelta(hours=6)),
+            ('KDCA',t0+timedelta(days=1,hours=2),t0+timedelta(days=1,hours=3)),
+            ('KDCA',t0+timedelta(days=5),t0+timedelta(days=5,hours=1)),
+        ]
+
+        plan=plan_fetches(missing)
+
+        self.assertEqual(plan,[
+            ('KDCA',t0+timedelta(hours=20),t0+timedelta(days=1,hours=4)),
+            ('KDCA',t0+timedelta(days=5),t0+timedelta(days=5,hours=1)),
+            ('KBWI',t0+timedelta(hours=2),t0+timedelta(hours=6)),
+        ])
+
+        # Intervals longer than the maximum span are split
+        plan=plan_fetches([('KDCA',t0,t0+timedelta(days=3))],
+                          max_span=timedelta(days=2))
+        self.assertEqual(plan,[
+            ('KDCA',t0,t0+timedelta(days=2)),
+            ('KDCA',t0+timedelta(days=2),t0+timedelta(days=3)),
+        ])
+
+        self.assertEqual(
+            split_by_day(t0+timedelta(hours=20),t0+timedelta(days=1,hours=4)),
+            [(t0+timedelta(hours=20),t0+timedelta(hours=23,minutes=59,seconds=59)),
+             (t0+timedelta(days=1),t0+timedelta(days=1,hours=4))])
+
+class InflightRegistryTests(unittest.TestCase):
+
+    def test_claim_and_release(self):
+        from .processing.inflight import inflight_registry
+
+        registry=inflight_registry()
+
+        t0=datetime(2021,3,1,tzinfo=UTC)
+
+        claim=registry.claim(1,t0+timedelta(hours=20),t0+timedelta(days=1,hours=2))
+        self.assertIsNotNone(claim)
+
+        # Overlapping day for the same station is refused
+        self.assertIsNone(registry.claim(1,t0+timedelta(days=1,hours=5),t0+timedelta(days=1,hours=6)))
+        self.assertGreater(registry.remaining(1,t0,t0+timedelta(hours=1)),0)
+
+        # Other stations and days are unaffected
+        self.assertIsNotNone(registry.claim(2,t0,t0+timedelta(hours=1)))
+        self.assertIsNotNone(registry.claim(1,t0+timedelta(days=2),t0+timedelta(days=2,hours=1)))
+
+        registry.release(claim)
+        self.assertEqual(registry.remaining(1,t0,t0+timedelta(hours=1)),0)
+        self.assertTrue(registry.wait(1,t0,t0+timedelta(hours=1),timeout=0))
+        self.assertIsNotNone(registry.claim(1,t0+timedelta(days=1,hours=5),t0+timedelta(days=1,hours=6)))
+
+class RateLimiterTests(BaseTest):
+
+    def setUp(self):
+        super(RateLimiterTests, self).setUp()
+        self.init_database()
+
+    def test_next_free_slot(self):
+        from .processing.ratelimit import next_free_slot
+
+        now=10000.
+
+        self.assertEqual(next_free_slot([],now,budget=3,window=3600,min_spacing=300),now)
+        self.assertEqual(next_free_slot([now-600],now,budget=3,window=3600,min_spacing=300),now)
+        self.assertEqual(next_free_slot([now-100],now,budget=3,window=3600,min_spacing=300),now+200)
+
+        # Budget exhausted: wait until the oldest request leaves the window
+        self.assertEqual(
+            next_free_slot([now-3000,now-2000,now-1000],now,budget=3,window=3600,min_spacing=300),
+            now+600)
+
+    def test_database_reservations(self):
+        from .processing.ratelimit import database_rate_limiter
+
+        limiter=database_rate_limiter(self.session,budget=3,window=3600,min_spacing=300)
+
+        now=time.time()
+
+        first=limiter.reserve('a',now)
+        self.assertAlmostEqual(first,now,places=3)
+
+        second=limiter.reserve('b',now)
+        self.assertAlmostEqual(second,now+300,places=3)
+
+        # Reserving again with the same token returns the same slot
+        self.assertAlmostEqual(limiter.reserve('b',now+10),second,places=3)
+
+        limiter.cancel('b')
+        self.assertAlmostEqual(limiter.reserve('c',now),now+300,places=3)
+
+        self.assertIsNone(limiter.circuit_until(now))
+
+    def test_release_abandoned_reservation(self):
+        from celery.exceptions import Retry
+        from .processing.ratelimit import database_rate_limiter, ogimet_min_spacing
+        from .processing.weather import check_ogimet_request_rate
+
+        limiter=database_rate_limiter(self.session)
+
+        now=time.time()
+        limiter.reserve('sent',now)
+
+        task=Mock()
+
+        with patch('cycling_data.processing.ratelimit.get_rate_limiter',
+                   return_value=limiter):
+
+            # A deferred task keeps its slot for when it is retried
+            task.retry.side_effect=lambda exc,eta: Retry(exc=exc,when=eta)
+            with self.assertRaises(Retry):
+                check_ogimet_request_rate(self.session,'deferred',task)
+            self.assertEqual(limiter.usage(now),2)
+
+            # A task out of retries releases it
+            def out_of_retries(exc,eta):
+                raise exc
+            task.retry.side_effect=out_of_retries
+            with self.assertRaises(RuntimeError):
+                check_ogimet_request_rate(self.session,'abandoned',task)
+            self.assertEqual(limiter.usage(now),2)
+
+        self.assertAlmostEqual(limiter.reserve('next',now),now+2*ogimet_min_spacing,places=3)
+
+    def test_redis_reservations(self):
+        from .processing.ratelimit import redis_rate_limiter
+
+        limiter=redis_rate_limiter(get_test_redis(self),budget=5,window=3600,
+                                   min_spacing=300,fast_spacing=2)
+
+        now=time.time()
+
+        self.assertAlmostEqual(limiter.reserve('a',now),now,places=3)
+        second=limiter.reserve('b',now)
+        self.assertAlmostEqual(second,now+300,places=3)
+        self.assertAlmostEqual(limiter.reserve('b',now+10),second,places=3)
+
+        # Fast requests fit between slow ones
+        self.assertAlmostEqual(limiter.reserve_fast('f1',now),now+2,places=3)
+        self.assertAlmostEqual(limiter.reserve_fast('f2',now),now+4,places=3)
+
+        limiter.cancel('b')
+        self.assertEqual(limiter.usage(now),3)
+        self.assertAlmostEqual(limiter.reserve('c',now),now+304,places=3)
+
+        # Once the budget of five requests is used up, the next waits until
+        # the first leaves the window
+        limiter.consume('c',now)
+        self.assertAlmostEqual(limiter.reserve('d',now),now+304,places=3)
+        self.assertAlmostEqual(limiter.reserve('e',now),now+3600,places=3)
+
+        limiter.trip(60)
+        self.assertIsNotNone(limiter.circuit_until(now))
+        self.assertIsNone(limiter.reserve('g',now))
+        self.assertIsNone(limiter.reserve_fast('f3',now))
+
+    def test_first_free_gap(self):
+        from .processing.ratelimit import first_free_gap
+
+        now=10000.
+
+        self.assertEqual(first_free_gap([],now,spacing=2),now)
+        self.assertEqual(first_free_gap([now-5,now+300],now,spacing=2),now)
+        self.assertEqual(first_free_gap([now-1,now+1,now+3],now,spacing=2),now+5)
+
+        # Fits between reservations far enough apart
+        self.assertEqual(first_free_gap([now,now+10],now,spacing=2),now+2)
+
+    def test_database_fast_reservations(self):
+        from .processing.ratelimit import database_rate_limiter
+
+        limiter=database_rate_limiter(self.session,budget=3,window=3600,
+                                      min_spacing=300,fast_spacing=2)
+
+        now=time.time()
+
+        slow=limiter.reserve('slow',now+60)
+
+        slots=[limiter.reserve_fast('fast{}'.format(i),now) for i in range(3)]
+
+        # Fast requests are spaced from each other but don't wait for the
+        # slow query budget
+        for slot,expected in zip(slots,[now,now+2,now+4]):
+            self.assertAlmostEqual(slot,expected,places=3)
+        self.assertAlmostEqual(limiter.reserve_fast('fast3',now+59),slow+2,places=3)
+
+    def test_release_unsent_recent_requests(self):
+        from .models.cycling_models import SentRequestLog
+        from .processing import weather
+        from .processing.ratelimit import database_rate_limiter
+
+        # As in the worker session
+        self.session.expire_on_commit=False
+
+        limiter=database_rate_limiter(self.session)
+
+        with transaction.manager:
+            for i in range(3):
+                self.session.add(Location(name='K{:03d}'.format(i),loctype_id=2))
+
+        stations=self.session.query(Location).order_by(Location.id).all()
+
+        dtend=datetime.now(UTC)
+        plan=[(station,dtend-timedelta(hours=2),dtend) for station in stations]
+
+        check=weather.check_ogimet_request_rate
+        calls=[]
+
+        # The circuit breaker opens before the last request gets its slot
+        def check_rate(*args,**kwargs):
+            calls.append(args)
+            if len(calls)==3:
+                raise RuntimeError('Last OGIMET request was rate limited')
+            return check(*args,**kwargs)
+
+        with patch('cycling_data.processing.ratelimit.get_rate_limiter',
+                   return_value=limiter), \
+             patch('cycling_data.processing.weather.check_ogimet_request_rate',
+                   side_effect=check_rate), \
+             patch('cycling_data.processing.async_fetch.get_concurrent_fetcher') as fetcher:
+            with self.assertRaises(RuntimeError):
+                weather.download_recent_metars(self.session,plan)
+
+        fetcher.assert_not_called()
+
+        # The slots of the first two requests are given back
+        with transaction.manager:
+            self.assertEqual(self.session.query(SentRequestLog).count(),0)
+        self.assertEqual(limiter.usage(),0)
+
+    def test_database_concurrent_reservations(self):
+        import tempfile
+        import threading
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import Session
+        from zope.sqlalchemy import ZopeTransactionExtension
+        from .models.meta import Base
+        from .processing.ratelimit import database_rate_limiter
+
+        tmpdir=tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        # Each worker has its own connection to a database file
+        engine=create_engine('sqlite:///{}/limiter.sqlite'.format(tmpdir.name))
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(engine)
+
+        sessions=[Session(engine,extension=ZopeTransactionExtension())
+                  for i in range(2)]
+        limiters=[database_rate_limiter(session,min_spacing=300)
+                  for session in sessions]
+
+        found=threading.Event()
+        resume=threading.Event()
+
+        # The first reservation stops after finding its slot, before its
+        # row is inserted and committed
+        def paused_slot(now):
+            slot=limiters[0].next_slot(now)
+            found.set()
+            resume.wait(10)
+            return slot
+
+        now=time.time()
+        slots={}
+
+        def reserve(i):
+            if i==0:
+                slots[i]=limiters[i].place('token0',now,300,paused_slot)
+            else:
+                slots[i]=limiters[i].reserve('token1',now)
+
+        threads=[threading.Thread(target=reserve,args=(i,)) for i in range(2)]
+
+        threads[0].start()
+        self.assertTrue(found.wait(10))
+        threads[1].start()
+
+        # The second reservation waits for the first to commit
+        threads[1].join(0.5)
+        self.assertTrue(threads[1].is_alive())
+
+        resume.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertAlmostEqual(slots[0],now,places=3)
+        self.assertAlmostEqual(slots[1],now+300,places=3)
+
+class TrainingSchedulerTests(BaseTest):
+
+    def setUp(self):
+        super(TrainingSchedulerTests, self).setUp()
+        self.init_database()
+
+    def test_coalesce_triggers(self):
+        from .processing.training_scheduler import training_scheduler
+        from .processing.regression import request_training
+        from .models.prediction import predict_vars
+
+        scheduler=training_scheduler(quiet_period=300)
+
+        with patch('cycling_data.processing.training_scheduler.get_training_scheduler',
+                   return_value=scheduler), \
+             patch('cycling_data.processing.regression.scheduled_training.apply_async') as scheduled_training:
+            for i in range(50):
+                request_training()
+
+            # One run is scheduled per model
+            self.assertEqual(scheduled_training.call_count,len(predict_vars))
+            self.assertEqual(
+                sorted(call[0][0][0] for call in scheduled_training.call_args_list),
+                sorted(predict_vars))
+
+            # Each trigger restarts the quiet period
+            now=time.time()
+            self.assertAlmostEqual(scheduler.quiet_remaining('avspeed',now),
+                                   scheduler.local_triggers['avspeed']+300-now)
+
+            # Once a run has started, one follow-up is scheduled
+            scheduler.unschedule('avspeed')
+            for i in range(50):
+                request_training(['avspeed'])
+            self.assertEqual(scheduled_training.call_count,len(predict_vars)+1)
+
+    def test_database_lock(self):
+        from .processing.training_scheduler import training_scheduler
+        from .models.prediction import get_model
+
+        scheduler=training_scheduler()
+
+        with transaction.manager:
+            model=get_model(self.session,'avspeed')
+            self.session.flush()
+            model_id=model.id
+
+        token=scheduler.acquire(self.session,model_id,'avspeed')
+        self.assertIsNotNone(token)
+
+        # Another worker can't train the model until the lock is released
+        self.assertIsNone(scheduler.acquire(self.session,model_id,'avspeed'))
+
+        scheduler.release(self.session,model_id,'avspeed',token)
+        stale=scheduler.acquire(self.session,model_id,'avspeed')
+        self.assertIsNotNone(stale)
+
+        # A lock older than its TTL by the database's clock is taken over
+        from sqlalchemy import func
+        from .models.cycling_models import PredictionModel
+
+        with transaction.manager:
+            server_now=self.session.query(func.now()).scalar()
+            self.session.query(PredictionModel).filter(
+                PredictionModel.id==model_id
+            ).update({PredictionModel.modified_date_:server_now-timedelta(
+                seconds=scheduler.lock_ttl+60)},synchronize_session=False)
+
+        token=scheduler.acquire(self.session,model_id,'avspeed')
+        self.assertIsNotNone(token)
+
+        # The worker whose lock was taken over can neither renew nor release
+        # it
+        self.assertFalse(scheduler.renew(self.session,model_id,'avspeed',stale))
+        scheduler.release(self.session,model_id,'avspeed',stale)
+        self.assertIsNone(scheduler.acquire(self.session,model_id,'avspeed'))
+
+        self.assertTrue(scheduler.renew(self.session,model_id,'avspeed',token))
+        scheduler.release(self.session,model_id,'avspeed',token)
+        self.assertIsNotNone(scheduler.acquire(self.session,model_id,'avspeed'))
+
+    def test_redis_scheduling(self):
+        from .processing.training_scheduler import training_scheduler
+
+        redis=get_test_redis(self)
+
+        scheduler=training_scheduler(redis,quiet_period=300,lock_ttl=3600)
+        key=scheduler.key('scheduled','avspeed')
+
+        self.assertTrue(scheduler.trigger('avspeed'))
+        self.assertFalse(scheduler.trigger('avspeed'))
+
+        # Triggers and requeued runs renew the scheduled flag
+        redis.pexpire(key,1000)
+        scheduler.trigger('avspeed')
+        self.assertGreater(redis.pttl(key),1000)
+
+        redis.pexpire(key,1000)
+        scheduler.keep_scheduled('avspeed')
+        self.assertGreater(redis.pttl(key),1000)
+
+        token=scheduler.acquire(None,None,'avspeed')
+        self.assertIsNotNone(token)
+        self.assertIsNone(scheduler.acquire(None,None,'avspeed'))
+
+        # Only the holder's token releases the lock
+        scheduler.release(None,None,'avspeed','other')
+        self.assertIsNone(scheduler.acquire(None,None,'avspeed'))
+        scheduler.release(None,None,'avspeed',token)
+        self.assertIsNotNone(scheduler.acquire(None,None,'avspeed'))
+
+    def test_redis_lock_renewal(self):
+        from .processing.training_scheduler import training_scheduler
+
+        redis=get_test_redis(self)
+
+        scheduler=training_scheduler(redis,lock_ttl=0.6)
+
+        token=scheduler.acquire(None,None,'avspeed')
+
+        # Training that outlasts the lock's TTL keeps the lock
+        with scheduler.hold(None,None,'avspeed',token):
+            time.sleep(1.5)
+            self.assertIsNone(scheduler.acquire(None,None,'avspeed'))
+
+        self.assertFalse(scheduler.renew(None,None,'avspeed','other'))
+
+        scheduler.release(None,None,'avspeed',token)
+        self.assertIsNotNone(scheduler.acquire(None,None,'avspeed'))
+
+class TaskRoutingTests(unittest.TestCase):
+
+    def test_task_queues(self):
+        from .celery import celery
+        from .celeryconfig import interactive_queue, backfill_queue, training_queue
+
+        router=celery.amqp.router
+
+        def queue(name,**options):
+            return router.route(options,'cycling_data.processing.'+name)['queue'].name
+
+        self.assertEqual(queue('weather.update_ride_weather'),interactive_queue)
+        self.assertEqual(queue('weather.update_rides_weather'),interactive_queue)
+        self.assertEqual(queue('weather.update_location_rides_weather'),interactive_queue)
+        self.assertEqual(queue('weather.fill_missing_weather'),backfill_queue)
+        self.assertEqual(queue('prefetch.prefetch_weather'),backfill_queue)
+        self.assertEqual(queue('recompute.recompute_station_weather'),backfill_queue)
+        self.assertEqual(queue('regression.scheduled_training'),training_queue)
+        self.assertEqual(queue('regression.train_model'),training_queue)
+
+        # Backfill batches are sent to the backfill queue explicitly
+        self.assertEqual(queue('weather.update_rides_weather',queue=backfill_queue),
+                         backfill_queue)
+
+class OgimetParserTests(unittest.TestCase):
+
+    def test_iter_metars_from_ogimet(self):
+        import io
+        from .processing.ogimet_parser import iter_metars_from_ogimet, ogimet_response_reader
+
+        response=ogimet_response_reader(io.StringIO(MetarTests.ogimet_text_dca))
+        reports=list(iter_metars_from_ogimet(response))
+
+        self.assertEqual(len(reports),9)
+        self.assertEqual(reports[0][0],datetime(2005,1,1,10,51))
+        self.assertEqual(reports[-1][0],datetime(2005,1,1,18,51))
+
+        # Reports continued over several lines are kept whole
+        self.assertTrue(reports[1][1].startswith('METAR KDCA 011151Z'))
+        self.assertTrue(reports[1][1].endswith('53013'))
+
+        self.assertTrue(response.found_reports)
+        self.assertFalse(response.rate_limited)
+
+        response=ogimet_response_reader(io.StringIO(MetarTests.ogimet_text_quota_exceeded))
+        self.assertEqual(list(iter_metars_from_ogimet(response)),[])
+        self.assertTrue(response.rate_limited)
+
+class MetarStoreTests(BaseTest):
+
+    def setUp(self):
+        super(MetarStoreTests, self).setUp()
+        self.init_database()
+
+    def test_parse_and_store_metars(self):
+        import io
+        from metar import Metar
+        from .processing.ogimet_parser import iter_metars_from_ogimet
+        from .processing.weather import parse_and_store_metars
+        from .models.cycling_models import StationWeatherData
+
+        metars=[
+            (Metar.Metar(code,year=date.year,month=date.month,strict=False),False)
+            for date,code in iter_metars_from_ogimet(
+                io.StringIO(MetarTests.ogimet_text_dca))]
+
+        stored=parse_and_store_metars(metars[:5],self.session)
+        first_ids=[wxdata.id for wxdata in stored]
+
+        self.assertEqual(len(set(first_ids)),5)
+        self.assertEqual(stored[0].station.name,'KDCA')
+
+        # Reports already stored are returned rather than inserted again,
+        # including repeats within a batch
+        stored=parse_and_store_metars(metars[3:]+metars[:1]+metars[-1:],self.session)
+
+        self.assertEqual([wxdata.id for wxdata in stored[:2]],first_ids[3:5])
+        self.assertEqual(stored[-2].id,first_ids[0])
+        self.assertEqual(stored[-1].id,stored[-3].id)
+        self.assertEqual(self.session.query(StationWeatherData).count(),len(metars))
+        self.assertEqual(self.session.query(Location).count(),1)
+
+    def test_stored_precipitation(self):
+        from metar import Metar
+        from .processing.weather import parse_and_store_metars, average_weather
+
+        codes=[
+            (datetime(2005,1,1,10,51),'METAR KDCA 011051Z 20007KT 5SM -RA BR SCT250 04/03 A3031'),
+            (datetime(2005,1,1,11,51),'METAR KDCA 011151Z 22003KT 6SM BR BKN250 04/03 A3034'),
+        ]
+
+        stored=parse_and_store_metars(
+            [(Metar.Metar(code,year=date.year,month=date.month,strict=False),False)
+             for date,code in codes],self.session)
+
+        self.assertEqual([wxdata.weather for wxdata in stored],['-RA BR','BR'])
+        self.assertAlmostEqual(stored[0].rain,0.2)
+        self.assertEqual(stored[1].rain,0)
+        self.assertEqual(stored[0].snow,0)
+
+        # Averaging uses the stored values without parsing the reports again
+        with patch('metar.Metar.Metar',side_effect=AssertionError):
+            values=average_weather(stored,datetime(2005,1,1,11,21,tzinfo=UTC),
+                                   datetime(2005,1,1,11,51,tzinfo=UTC),None)
+
+        self.assertAlmostEqual(values['rain'],0.05)
+
+    def test_load_observations(self):
+        import io
+        from metar import Metar
+        from .processing.ogimet_parser import iter_metars_from_ogimet
+        from .processing.weather import parse_and_store_metars, load_observations, get_stored_metars, average_weather
+        from .processing.weather_math import metar_records
+
+        stored=parse_and_store_metars(
+            [(Metar.Metar(code,year=date.year,month=date.month,strict=False),False)
+             for date,code in iter_metars_from_ogimet(
+                 io.StringIO(MetarTests.ogimet_text_dca))],self.session)
+        station=stored[0].station
+
+        with transaction.manager:
+            station.elevation=16.
+        with transaction.manager:
+            station=self.session.query(Location).filter(Location.name=='KDCA').one()
+            records=load_observations(self.session,station.id,
+                                      datetime(2005,1,1,tzinfo=UTC),
+                                      datetime(2005,1,2,tzinfo=UTC))
+            expected=metar_records(get_stored_metars(
+                self.session,station,datetime(2005,1,1),datetime(2005,1,2)))
+
+        self.assertEqual(len(records),len(expected))
+        self.assertTrue((records['report_time'][1:]>=records['report_time'][:-1]).all())
+        for field in records.dtype.names:
+            np.testing.assert_array_equal(records[field],expected[field],err_msg=field)
+
+        dtstart=datetime(2005,1,1,11,tzinfo=UTC)
+        dtend=datetime(2005,1,1,12,tzinfo=UTC)
+        np.testing.assert_equal(average_weather(records,dtstart,dtend,10.),
+                                average_weather(expected,dtstart,dtend,10.))
+
+class ObservationCacheTests(BaseTest):
+
+    def setUp(self):
+        super(ObservationCacheTests, self).setUp()
+        self.init_database()
+
+    def store_metars(self):
+        import io
+        from metar import Metar
+        from .processing.ogimet_parser import iter_metars_from_ogimet
+        from .processing.weather import parse_and_store_metars
+
+        metars=[(Metar.Metar(code,year=date.year,month=date.month,strict=False),False)
+                for date,code in iter_metars_from_ogimet(
+                    io.StringIO(MetarTests.ogimet_text_dca))]
+
+        stored=parse_and_store_metars(metars[:-1],self.session)
+
+        return stored[0].wx_station,metars[-1:]
+
+    def test_cache(self):
+        from .processing.weather import parse_and_store_metars, load_observations
+        from .processing.observation_cache import get_observation_cache
+
+        station_id,last_metar=self.store_metars()
+
+        # Without Redis nothing is cached
+        cache=get_observation_cache()
+        cache.clear()
+        stats=cache.stats()['worker']
+
+        dtstart=datetime(2005,1,1,10,tzinfo=UTC)
+        dtend=datetime(2005,1,1,20,tzinfo=UTC)
+
+        with transaction.manager:
+            first=load_observations(self.session,station_id,dtstart,dtend)
+        with transaction.manager:
+            second=load_observations(self.session,station_id,dtstart,dtend)
+
+        np.testing.assert_array_equal(first['id'],second['id'])
+        self.assertEqual(cache.stats()['worker']['misses'],stats['misses']+2)
+        self.assertEqual(cache.stats()['worker']['hits'],stats['hits'])
+        self.assertEqual(cache.stats()['worker']['entries'],0)
+
+        parse_and_store_metars(last_metar,self.session)
+
+        with transaction.manager:
+            third=load_observations(self.session,station_id,dtstart,dtend)
+
+        self.assertEqual(len(third),len(first)+1)
+
+    def test_shared_cache(self):
+        from .processing.weather import parse_and_store_metars
+        from .processing.observation_cache import observation_cache
+
+        redis=get_test_redis(self)
+
+        station_id,last_metar=self.store_metars()
+
+        # Two workers sharing the cache through Redis
+        cache=observation_cache(redis=redis)
+        other=observation_cache(redis=redis)
+
+        dtstart=datetime(2005,1,1,10,tzinfo=UTC)
+        dtend=datetime(2005,1,1,20,tzinfo=UTC)
+
+        with transaction.manager:
+            first=cache.load(self.session,station_id,dtstart,dtend)
+        with transaction.manager:
+            second=cache.load(self.session,station_id,dtstart,dtend)
+        with transaction.manager:
+            shared=other.load(self.session,station_id,dtstart,dtend)
+
+        np.testing.assert_array_equal(first['id'],second['id'])
+        np.testing.assert_array_equal(first['id'],shared['id'])
+        self.assertEqual(cache.stats()['worker']['misses'],1)
+        self.assertEqual(cache.stats()['worker']['hits'],1)
+        self.assertEqual(other.stats()['worker']['redis_hits'],1)
+        self.assertEqual(cache.stats()['shared']['misses'],1)
+
+        # Storing a report in one worker invalidates the day in the other
+        parse_and_store_metars(last_metar,self.session)
+        cache.invalidate([(station_id,dtstart.date())])
+
+        with transaction.manager:
+            third=other.load(self.session,station_id,dtstart,dtend)
+
+        self.assertEqual(len(third),len(first)+1)
+        self.assertEqual(other.stats()['worker']['misses'],1)
+
+class RecomputeTests(BaseTest):
+
+    def setUp(self):
+        super(RecomputeTests, self).setUp()
+        self.init_database()
+
+    def test_recompute_station(self):
+        import io
+        from metar import Metar
+        from .models import Ride
+        from .models.cycling_models import RideWeatherData
+        from .processing.ogimet_parser import iter_metars_from_ogimet
+        from .processing.weather import parse_and_store_metars, average_weather, ride_altitude, ride_times_utc
+        from .processing.recompute import recompute_station, ride_weather_stations
+
+        stored=parse_and_store_metars(
+            [(Metar.Metar(code,year=date.year,month=date.month,strict=False),False)
+             for date,code in iter_metars_from_ogimet(
+                 io.StringIO(MetarTests.ogimet_text_dca))],self.session)
+        station_id=stored[0].wx_station
+
+        with transaction.manager:
+            start=Location(name='Start',lat=38.9,lon=-77.0,elevation=10.)
+            end=Location(name='End',lat=38.9,lon=-77.1,elevation=20.)
+            for start_time in (datetime(2005,1,1,7),datetime(2005,1,1,10)):
+                self.session.add(Ride(
+                    start_time=start_time,
+                    end_time=start_time+timedelta(minutes=30),
+                    startloc=start,endloc=end,
+                    wxdata=RideWeatherData(wx_station=station_id,temperature=-40.,rain=5.)))
+
+        with transaction.manager:
+            self.assertEqual(ride_weather_stations(self.session),[station_id])
+
+        with patch('cycling_data.processing.weather.fetch_metars',side_effect=AssertionError):
+            self.assertEqual(recompute_station(self.session,station_id),2)
+
+        with transaction.manager:
+            for ride in self.session.query(Ride):
+                dtstart,dtend=ride_times_utc(ride)
+                expected=average_weather(stored,dtstart,dtend,ride_altitude(ride))
+                self.assertEqual(ride.wxdata.wx_station,station_id)
+                for key,value in expected.items():
+                    if np.isnan(value):
+                        self.assertIsNone(getattr(ride.wxdata,key),key)
+                    else:
+                        self.assertAlmostEqual(getattr(ride.wxdata,key),value,msg=key)
+
+class BacklogTests(BaseTest):
+
+    def setUp(self):
+        super(BacklogTests, self).setUp()
+        self.init_database()
+
+    def backlog(self):
+        from .models.cycling_models import WeatherBacklog
+
+        with transaction.manager:
+            return {entry.ride_id:(entry.state,entry.attempts,entry.next_attempt)
+                    for entry in self.session.query(WeatherBacklog)}
+
+    def test_backlog(self):
+        from .models import Ride
+        from .processing.backlog import (claim_rides, record_outcomes,
+            backlog_grace_period, backlog_lease, retry_delay, backlog_counts)
+        from .processing.weather import uncovered_error
+
+        with transaction.manager:
+            start=Location(name='Start',lat=38.9,lon=-77.0,elevation=10.)
+            end=Location(name='End',lat=38.9,lon=-77.1,elevation=20.)
+            rides=[Ride(start_time=datetime(2005,1,1,7)+timedelta(days=i),
+                        end_time=datetime(2005,1,1,8)+timedelta(days=i),
+                        startloc=start,endloc=end)
+                   for i in range(3)]
+            self.session.add_all(rides)
+            self.session.flush()
+            ride_ids=[ride.id for ride in rides]
+
+        # New rides are queued, and left to the update queued when they
+        # were saved for the grace period
+        backlog=self.backlog()
+        self.assertEqual(sorted(backlog),ride_ids)
+        self.assertTrue(all(state=='pending' and attempts==0
+                            for state,attempts,next_attempt in backlog.values()))
+
+        now=max(next_attempt for state,attempts,next_attempt in backlog.values())
+
+        with transaction.manager:
+            self.assertEqual(claim_rides(self.session,10,now-backlog_grace_period),[])
+            self.assertEqual(claim_rides(self.session,2,now),ride_ids[:2])
+
+        # Claimed rides are leased
+        with transaction.manager:
+            self.assertEqual(claim_rides(self.session,10,now),ride_ids[2:])
+            self.assertEqual(claim_rides(self.session,10,now+backlog_lease),ride_ids)
+
+        with transaction.manager:
+            record_outcomes(
+                self.session,[ride_ids[0]],
+                {ride_ids[1]:(uncovered_error,False),
+                 ride_ids[2]:('Ride has no start or end time',True)},now=now)
+
+        backlog=self.backlog()
+        self.assertEqual(backlog[ride_ids[0]],('done',0,None))
+        self.assertEqual(backlog[ride_ids[1]],('pending',1,now+retry_delay(1)))
+        self.assertEqual(backlog[ride_ids[2]],('failed',1,None))
+
+        with transaction.manager:
+            self.assertEqual(backlog_counts(self.session),
+                             {'done':1,'pending':1,'failed':1})
+
+        # Retries back off
+        self.assertEqual(retry_delay(2),2*retry_delay(1))
+
+        # Editing a ride's times queues it again
+        with transaction.manager:
+            ride=self.session.query(Ride).filter(Ride.id==ride_ids[2]).one()
+            ride.end_time=datetime(2005,1,3,9)
+
+        self.assertEqual(self.backlog()[ride_ids[2]][:2],('pending',0))
+
+        # Other edits leave it alone
+        with transaction.manager:
+            ride=self.session.query(Ride).filter(Ride.id==ride_ids[0]).one()
+            ride.remarks='Windy'
+
+        self.assertEqual(self.backlog()[ride_ids[0]][0],'done')
+
+        with transaction.manager:
+            self.session.delete(
+                self.session.query(Ride).filter(Ride.id==ride_ids[0]).one())
+
+        self.assertNotIn(ride_ids[0],self.backlog())
+
+    @patch('cycling_data.processing.weather.fetch_missing_metars',
+           side_effect=RuntimeError('OGIMET unreachable'))
+    def test_failed_task(self,fetch_missing_metars):
+        from .models import Ride
+        from .processing.backlog import backlog_max_attempts
+        from .processing.weather import update_rides_weather
+
+        from sqlalchemy.orm import Session
+        from zope.sqlalchemy import ZopeTransactionExtension
+
+        session=Session(self.engine, extension=ZopeTransactionExtension())
+        session.expire_on_commit=False
+
+        import cycling_data
+        with patch.object(cycling_data.celery,'session_factory',
+                          return_value=session):
+
+            with transaction.manager:
+                session.add(Location(name='KDCA',lat=dca.lat,lon=dca.lon,
+                                     elevation=dca.elevation,loctype_id=2))
+                ride=Ride(start_time=datetime(2005,1,1,10),
+                          end_time=datetime(2005,1,1,11),
+                          startloc=Location(name='Start',lat=38.9,lon=-77.0,elevation=10.),
+                          endloc=Location(name='End',lat=38.9,lon=-77.1,elevation=20.))
+                session.add(ride)
+                session.flush()
+                ride_id=ride.id
+
+            # Each task that raises counts as an attempt, until the ride is
+            # given up on
+            for attempt in range(1,backlog_max_attempts+1):
+                with self.assertRaises(RuntimeError):
+                    update_rides_weather([ride_id])
+                state,attempts,next_attempt=self.backlog()[ride_id]
+                self.assertEqual(attempts,attempt)
+
+            self.assertEqual(state,'failed')
+            self.assertIsNone(next_attempt)
+            self.assertEqual(fetch_missing_metars.call_count,backlog_max_attempts)
+
+class StationRegistryTests(BaseTest):
+
+    def setUp(self):
+        super(StationRegistryTests, self).setUp()
+        self.init_database()
+
+    def test_eviction(self):
+        from .processing.stations import station_registry
+
+        registry=station_registry(maxsize=2)
+        registry.add('KDCA',1)
+        registry.add('KBWI',2)
+        self.assertEqual(registry.get('KDCA'),1)
+
+        # KBWI is now the least recently used
+        registry.add('KIAD',3)
+        self.assertIsNone(registry.get('KBWI'))
+        self.assertEqual(registry.get('KDCA'),1)
+        self.assertEqual(registry.get('KIAD'),3)
+
+    def test_resolve_and_invalidate(self):
+        from .processing.stations import get_station_registry
+
+        with transaction.manager:
+            self.session.add(Location(name='KDCA',loctype_id=2))
+            self.session.add(Location(name='Home'))
+
+        registry=get_station_registry()
+
+        resolved=registry.resolve(self.session,['KDCA','Home','KIAD'])
+        self.assertEqual(list(resolved),['KDCA'])
+        self.assertEqual(registry.get('KDCA'),resolved['KDCA'])
+
+        # Renaming a station drops it from the registry once committed
+        with transaction.manager:
+            location=self.session.query(Location).filter(Location.name=='KDCA').one()
+            location.name='KDCA2'
+            self.session.flush()
+            self.assertEqual(registry.get('KDCA'),resolved['KDCA'])
+
+        self.assertIsNone(registry.get('KDCA'))
+
+        # Rolled back changes leave it alone
+        registry.resolve(self.session,['KDCA2'])
+        transaction.begin()
+        location=self.session.query(Location).filter(Location.name=='KDCA2').one()
+        location.name='KDCA3'
+        self.session.flush()
+        transaction.abort()
+
+        self.assertEqual(registry.get('KDCA2'),resolved['KDCA'])
+
+class ArchiveImportTests(BaseTest):
+
+    def setUp(self):
+        super(ArchiveImportTests, self).setUp()
+        self.init_database()
+
+    def test_iter_ogimet_reports(self):
+        import io
+        from .scripts.import_metar_archive import line_counter, iter_ogimet_reports, iter_chunks
+
+        reports=list(iter_ogimet_reports(
+            line_counter(io.StringIO(MetarTests.ogimet_text_dca))))
+        self.assertEqual(len(reports),9)
+
+        chunks=list(iter_chunks(iter(reports),4))
+        self.assertEqual([len(chunk) for chunk,line in chunks],[4,4,1])
+
+        # Resuming after the end of a chunk continues with the next report
+        resumed=list(iter_ogimet_reports(
+            line_counter(io.StringIO(MetarTests.ogimet_text_dca)),chunks[0][1]))
+        self.assertEqual(resumed,reports[4:])
+
+    def test_iter_csv_reports(self):
+        import io
+        from .scripts.import_metar_archive import line_counter, iter_csv_reports
+
+        text='\n'.join([
+            'No errors',
+            '2 results',
+            'raw_text,station_id,observation_time',
+            'KDCA 011051Z 20007KT 5SM BR SCT250 04/03 A3031,KDCA,2005-01-01T10:51:00Z',
+            'KDCA 011151Z 22003KT 6SM BR BKN250 04/03 A3034,KDCA,2005-01-01T11:51:00Z',
+        ])
+
+        reports=list(iter_csv_reports(line_counter(io.StringIO(text))))
+
+        self.assertEqual([date for date,metar,line in reports],
+                         [datetime(2005,1,1,10,51),datetime(2005,1,1,11,51)])
+        self.assertTrue(reports[0][1].startswith('KDCA 011051Z'))
+
+        resumed=list(iter_csv_reports(line_counter(io.StringIO(text)),reports[0][2]))
+        self.assertEqual(resumed,reports[1:])
+
+    def test_parse_csv_time(self):
+        from .scripts.import_metar_archive import parse_csv_time
+
+        # Times with an offset are converted to naive UTC
+        self.assertEqual(parse_csv_time('2005-01-01T05:51:00-05:00'),
+                         datetime(2005,1,1,10,51))
+        self.assertEqual(parse_csv_time(' 2005-01-01 10:51 '),
+                         datetime(2005,1,1,10,51))
+
+    def test_record_coverage(self):
+        from .scripts.import_metar_archive import archive_importer
+        from .processing.stations import station_registry
+        from .models.cycling_models import WeatherFetchLog, WeatherCoverage
+
+        with transaction.manager:
+            self.session.add(Location(name='KDCA',loctype_id=2))
+
+        importer=archive_importer(self.session,{},None,station_registry())
+
+        start=datetime(2005,1,1)
+        runs={}
+
+        # Three chunks of one run of hourly reports, then a new run after a
+        # gap
+        chunks=[[start+timedelta(hours=5*i+j) for j in range(5)] for i in range(3)]
+        chunks.append([start+timedelta(hours=20+j) for j in range(3)])
+
+        for chunk in chunks:
+            with transaction.manager:
+                importer.record_coverage(
+                    runs,[('KDCA',{'report_time':report_time}) for report_time in chunk])
+
+        # Each chunk only records the time it added to its run
+        with transaction.manager:
+            self.assertEqual(
+                [(log.dtstart,log.dtend) for log in self.session.query(
+                    WeatherFetchLog).order_by(WeatherFetchLog.dtstart)],
+                [(start,start+timedelta(hours=4)),
+                 (start+timedelta(hours=4),start+timedelta(hours=9)),
+                 (start+timedelta(hours=9),start+timedelta(hours=14)),
+                 (start+timedelta(hours=20),start+timedelta(hours=22))])
+
+            self.assertEqual(
+                [(row.dtstart,row.dtend) for row in self.session.query(
+                    WeatherCoverage).order_by(WeatherCoverage.dtstart)],
+                [(start,start+timedelta(hours=14)),
+                 (start+timedelta(hours=20),start+timedelta(hours=22))])
+
+        self.assertEqual(runs['KDCA'],[(start+timedelta(hours=20)).isoformat(),
+                                       (start+timedelta(hours=22)).isoformat()])
+
+class ConcurrentFetcherTests(unittest.TestCase):
+
+    def test_fetch(self):
+        from .processing.async_fetch import concurrent_fetcher
+
+        fetcher=concurrent_fetcher(concurrency=4)
+
+        def get(url,station,dtstart,dtend,send_time):
+            time.sleep(0.2)
+            if station=='KBAD':
+                raise ValueError('HTTP error')
+            return station
+
+        t0=datetime(2021,5,1)
+        queries=[('K{:03d}'.format(i),t0,t0+timedelta(hours=1)) for i in range(8)]
+        queries[2]=('KBAD',t0,t0+timedelta(hours=1))
+
+        with patch.object(fetcher,'get',side_effect=get):
+            start=time.monotonic()
+            results=fetcher.fetch('http://ogimet',queries)
+            elapsed=time.monotonic()-start
+
+        # Eight requests at four at a time take two rounds
+        self.assertLess(elapsed,0.6)
+        self.assertGreater(elapsed,0.35)
+
+        self.assertEqual(results[:2],['K000','K001'])
+        self.assertIsInstance(results[2],ValueError)
+        self.assertEqual(results[7],'K007')
+
+        # Each request waits for its rate limiter slot
+        sent=[]
+
+        def ogimet_get(session,url,params,path):
+            sent.append(time.time())
+            return Mock()
+
+        with patch('cycling_data.processing.async_fetch.ogimet_get',side_effect=ogimet_get):
+            now=time.time()
+            fetcher.fetch('http://ogimet',queries[:3],[now,now+0.2,now+0.4])
+
+        sent=sorted(sent)
+        self.assertGreater(sent[1]-sent[0],0.15)
+        self.assertGreater(sent[2]-sent[1],0.15)
+
+class StationQualityTests(BaseTest):
+
+    def setUp(self):
+        super(StationQualityTests, self).setUp()
+        self.init_database()
+
+    def test_rank_stations(self):
+        from .models.cycling_models import StationWeatherData, StationReportDay
+        from .processing.station_quality import record_fetch, rank_stations
+
+        day=datetime(2021,5,1)
+
+        with transaction.manager:
+            for name in ['KBAD','KNEW','KDCA']:
+                self.session.add(Location(name=name,loctype_id=2))
+
+        stations={station.name:station for station in self.session.query(Location)}
+        ids={name:station.id for name,station in stations.items()}
+
+        report_times=[day+timedelta(minutes=52+60*i) for i in range(23)]
+
+        with transaction.manager:
+            for report_time in report_times:
+                self.session.add(StationWeatherData(wx_station=ids['KDCA'],
+                                                    report_time=report_time))
+
+        with transaction.manager:
+            record_fetch(self.session,ids['KBAD'],day,day+timedelta(1),[])
+            record_fetch(self.session,ids['KDCA'],day,day+timedelta(1),report_times)
+
+        with transaction.manager:
+            counts={row.station_id:row.reports for row in self.session.query(StationReportDay)}
+            self.assertEqual(counts,{ids['KBAD']:0,ids['KDCA']:23})
+
+            # KBAD is known to have no reports that day, and KDCA is known
+            # to have some
+            ranked=rank_stations(self.session,
+                                 [stations['KBAD'],stations['KNEW'],stations['KDCA']],
+                                 day+timedelta(hours=15),day+timedelta(hours=16),
+                                 timedelta(hours=4))
+            self.assertEqual([station.name for station in ranked],['KDCA','KNEW'])
+
+            # Nothing is known about either station the next day, but KBAD
+            # returned nothing the last time it was fetched
+            ranked=rank_stations(self.session,
+                                 [stations['KBAD'],stations['KNEW']],
+                                 day+timedelta(days=1,hours=15),day+timedelta(days=1,hours=16),
+                                 timedelta(hours=4))
+            self.assertEqual([station.name for station in ranked],['KNEW','KBAD'])
+
+class PrefetchTests(BaseTest):
+
+    def setUp(self):
+        super(PrefetchTests, self).setUp()
+        self.init_database()
+
+    def test_busiest_locations(self):
+        from .models import Ride
+        from .processing.prefetch import busiest_locations
+
+        with transaction.manager:
+            home=Location(name='Home',lat=38.9,lon=-77.0)
+            work=Location(name='Work',lat=38.8,lon=-77.1)
+            park=Location(name='Park',lat=38.7,lon=-77.2)
+            for startloc,endloc in [(home,work),(work,home),(home,park),(home,None)]:
+                self.session.add(Ride(start_time=datetime(2021,5,1,10,tzinfo=UTC),
+                                      end_time=datetime(2021,5,1,11,tzinfo=UTC),
+                                      startloc=startloc,endloc=endloc))
+
+        with transaction.manager:
+            self.assertEqual([location.name for location in busiest_locations(self.session,limit=2)],
+                             ['Home','Work'])
+
+    def test_idle_requests(self):
+        from .processing.prefetch import idle_requests
+
+        limiter=Mock()
+        limiter.circuit_until.return_value=None
+        limiter.usage.return_value=20
+        self.assertEqual(idle_requests(limiter,share=0.5,max_requests=10),7)
+
+        # Each run sends a few requests at most
+        limiter.usage.return_value=0
+        self.assertEqual(idle_requests(limiter,share=0.5,max_requests=4),4)
+
+        limiter.usage.return_value=30
+        self.assertEqual(idle_requests(limiter,share=0.5),0)
+
+        limiter.usage.return_value=0
+        limiter.circuit_until.return_value=time.time()+60
+        self.assertEqual(idle_requests(limiter,share=0.5),0)
+
+    def test_prefetched_ride_needs_no_download(self):
+        from .models.cycling_models import StationWeatherData, StationQuality
+        from .processing.coverage import record_coverage
+        from .processing.prefetch import prefetch_plan
+        from .processing.weather import get_metars
+
+        now=datetime.utcnow().replace(minute=0,second=0,microsecond=0)
+
+        with transaction.manager:
+            self.session.add(Location(name='KDCA',loctype_id=2))
+
+        station=self.session.query(Location).one()
+        station_id=station.id
+
+        self.assertEqual(len(prefetch_plan(self.session,[station],now,days=1)),1)
+
+        # Reports up to an hour ago, fetched by the prefetcher
+        with transaction.manager:
+            for hours in range(1,26):
+                self.session.add(StationWeatherData(
+                    wx_station=station_id,report_time=now-timedelta(hours=hours,minutes=9)))
+            record_coverage(self.session,station_id,now-timedelta(days=1),now,
+                            now+timedelta(hours=1))
+            self.session.add(StationQuality(station_id=station_id,
+                                            report_interval=3600.))
+
+        # A ride that ended two hours ago is covered by the stored reports,
+        # although the end of its window is not
+        with patch('cycling_data.processing.weather.download_planned_metars') as download:
+            metars=get_metars(self.session,station,
+                              (now-timedelta(hours=4)).replace(tzinfo=UTC),
+                              (now-timedelta(hours=2)).replace(tzinfo=UTC))
+
+        download.assert_not_called()
+        self.assertGreater(len(metars),0)
+
+        # A ride that ended an hour ago needs the reports after it
+        with patch('cycling_data.processing.weather.download_planned_metars',
+                   return_value=[]) as download:
+            get_metars(self.session,station,
+                       (now-timedelta(hours=3)).replace(tzinfo=UTC),
+                       (now-timedelta(hours=1)).replace(tzinfo=UTC))
+
+        download.assert_called_once()
+
+class WeatherMathTests(unittest.TestCase):
+
+    def test_fill_gaps(self):
+        from .processing.weather_math import fill_gaps
+
+        times=np.array([0.,1.,3.,4.])
+        obs=np.array([[np.nan,1.],[2.,np.nan],[np.nan,np.nan],[5.,4.]])
+
+        np.testing.assert_allclose(
+            fill_gaps(times,obs),
+            [[np.nan,1.],[2.,1.75],[4.,3.25],[5.,4.]])
+
+    def test_average_weather(self):
+        from .processing.weather import average_weather
+        from .scripts.benchmark_weather import synthetic_station_reports, average_weather_loop
+
+        reports=synthetic_station_reports(days=3,missing_fraction=0.3)
+        t0=reports[0].report_time.replace(tzinfo=UTC)
+
+        for start,hours in [(2,1),(5.5,0.3),(20,30),(0,2)]:
+            dtstart=t0+timedelta(hours=start)
+            dtend=dtstart+timedelta(hours=hours)
+            expected=average_weather_loop(reports,dtstart,dtend,150.)
+            values=average_weather(reports,dtstart,dtend,150.)
+
+            self.assertEqual(list(values),list(expected))
+            for key in expected:
+                np.testing.assert_allclose(values[key],expected[key],
+                                           rtol=1e-9,atol=1e-9,err_msg=key)
+
+    def test_average_rides_weather(self):
+        from .metrics import metrics_registry
+        from .processing.weather import average_weather, average_rides_weather
+        from .scripts.benchmark_weather import synthetic_station_reports
+
+        reports=synthetic_station_reports(days=3,missing_fraction=0.3)
+        t0=reports[0].report_time.replace(tzinfo=UTC)
+
+        rides=[(t0+timedelta(hours=start),
+                t0+timedelta(hours=start+hours),altitude)
+               for start,hours,altitude in [(2,1,150.),(5.5,0.3,20.),
+                                             (20,30,150.),(70,10,150.)]]
+
+        metrics=metrics_registry()
+
+        with patch('cycling_data.metrics.get_metrics',return_value=metrics):
+            results=average_rides_weather(reports,rides)
+
+        # The batch is timed as a whole
+        self.assertEqual(
+            metrics.collect()['weather_average_rides_seconds',(),'count'],1)
+
+        # The last ride ends after the last report
+        self.assertIsNone(results[-1])
+
+        for (dtstart,dtend,altitude),values in zip(rides[:-1],results[:-1]):
+            expected=average_weather(reports,dtstart,dtend,altitude)
+            self.assertEqual(list(values),list(expected))
+            for key in expected:
+                np.testing.assert_allclose(values[key],expected[key],
+                                           rtol=1e-9,atol=1e-9,err_msg=key)
+
+    def test_merge_ride_windows(self):
+        from .processing.weather import merge_ride_windows
+
+        t0=datetime(2021,5,1)
+        h=timedelta(hours=1)
+
+        self.assertEqual(
+            merge_ride_windows([(t0+20*h,t0+21*h),(t0,t0+h),(t0+8*h,t0+9*h)]),
+            [(t0,t0+9*h),(t0+20*h,t0+21*h)])
+
+class MetricsTests(BaseTest):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        self.init_database()
+
+    def test_render(self):
+        from .metrics import metrics_registry, render
+
+        metrics=metrics_registry()
+
+        metrics.inc('ogimet_requests_total',path='single',outcome='200')
+        metrics.inc('ogimet_requests_total',path='single',outcome='200')
+        metrics.observe('http_request_seconds',0.02,route='rides',status=200)
+        metrics.observe('http_request_seconds',3,route='rides',status=200)
+
+        text=render(metrics.collect(),{'weather_backlog_rides':{(('state','pending'),):4}})
+
+        self.assertIn('# TYPE ogimet_requests_total counter',text)
+        self.assertIn('ogimet_requests_total{outcome="200",path="single"} 2.0',text)
+        self.assertIn('# TYPE http_request_seconds histogram',text)
+        self.assertIn('http_request_seconds_bucket{route="rides",status="200",le="0.01"} 0.0',text)
+        self.assertIn('http_request_seconds_bucket{route="rides",status="200",le="0.025"} 1.0',text)
+        self.assertIn('http_request_seconds_bucket{route="rides",status="200",le="+Inf"} 2.0',text)
+        self.assertIn('http_request_seconds_sum{route="rides",status="200"} 3.02',text)
+        self.assertIn('http_request_seconds_count{route="rides",status="200"} 2.0',text)
+        self.assertIn('weather_backlog_rides{state="pending"} 4.0',text)
+
+    def test_shared_gauges(self):
+        from .metrics import metrics_registry
+
+        redis=get_test_redis(self)
+
+        metrics=metrics_registry(redis)
+        metrics.add_gauge('db_pool_checked_out',lambda: 2)
+
+        # Another process's gauges are summed with this one's
+        redis.hset(metrics.gauges_key_prefix+'otherhost:1',
+                   json.dumps(['db_pool_checked_out',[]]),3)
+
+        self.assertEqual(metrics.collect_gauges(),{'db_pool_checked_out':{():5.}})
+        self.assertGreater(redis.ttl(metrics.gauges_key()),0)
+
+        # A process that exits drops its gauges
+        metrics.close()
+        self.assertEqual(metrics_registry(redis).collect_gauges(),
+                         {'db_pool_checked_out':{():3.}})
+
+    def test_metrics_view(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        from .metrics import metrics_registry
+        from .views.metrics import metrics_views
+
+        self.config.get_settings()['metrics.token']='secret'
+        self.config.testing_securitypolicy(permissive=False)
+
+        metrics=metrics_registry()
+        metrics.observe('weather_average_seconds',0.001)
+
+        request=testing.DummyRequest(dbsession=self.session)
+
+        with patch('cycling_data.metrics.get_metrics',return_value=metrics), \
+             patch('cycling_data.metrics.queue_depths',return_value={'training':3}):
+
+            self.assertRaises(HTTPForbidden,metrics_views(request).metrics)
+
+            request.headers['Authorization']='Bearer secret'
+            with transaction.manager:
+                response=metrics_views(request).metrics()
+
+        self.assertIn('weather_average_seconds_count 1.0',response.text)
+        self.assertIn('celery_queue_messages{queue="training"} 3.0',response.text)
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir=tempfile.TemporaryDirectory()
+        self.settings={
+            'worker_sqlalchemy.url':'sqlite:///{}/worker.sqlite'.format(self.tmpdir.name),
+            'worker_sqlalchemy.pool_size':'1',
+            'worker_sqlalchemy.max_overflow':'0',
+            'worker_sqlalchemy.pool_timeout':'1'}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_pool_metrics(self):
+        from sqlalchemy.exc import TimeoutError
+        from .models.worker_pool import get_worker_engine, pool_metrics
+        from .metrics import metrics_registry, render
+
+        registry=metrics_registry()
+        metrics=pool_metrics(registry)
+        engine=get_worker_engine(self.settings,metrics=metrics)
+
+        conn=engine.connect()
+        conn.execute('select 1')
+
+        self.assertEqual(registry.collect_gauges(),{'db_pool_checked_out':{():1}})
+
+        # The pool is bounded, so a second checkout times out
+        self.assertRaises(TimeoutError,engine.connect)
+
+        conn.close()
+
+        # Connections are replaced when the pool is recreated
+        engine.dispose()
+        with engine.connect() as conn:
+            conn.execute('select 1')
+
+        stats=metrics.stats()
+        self.assertEqual(stats['checkouts'],2)
+        self.assertEqual(stats['checkins'],2)
+        self.assertEqual(stats['connects'],2)
+        self.assertEqual(stats['timeouts'],1)
+        self.assertEqual(stats['checked_out'],0)
+        self.assertGreaterEqual(stats['max_wait_time'],1)
+
+        # The counts are exported with the other metrics
+        text=render(registry.collect(),registry.collect_gauges())
+        self.assertIn('db_pool_events_total{event="checkout"} 2.0',text)
+        self.assertIn('db_pool_events_total{event="timeout"} 1.0',text)
+        self.assertIn('# TYPE db_pool_checked_out gauge',text)
+        self.assertIn('db_pool_checked_out 0.0',text)
+        self.assertIn('db_pool_wait_seconds_count 3.0',text)
+
+        engine.dispose()
+
+    def test_task_session(self):
+        from . import celery
+        from .models.worker_pool import get_worker_engine
+
+        engine=get_worker_engine(self.settings,metrics=celery.db_pool_metrics)
+        celery.worker_session.configure(bind=engine)
+
+        try:
+            celery.enter_task_session()
+
+            session=celery.session_factory()
+            self.assertIs(celery.session_factory(),session)
+
+            with transaction.manager:
+                session.execute('select 1')
+
+            # A task run inside another leaves the outer task's session open
+            celery.enter_task_session()
+            celery.remove_task_session()
+            self.assertIs(celery.session_factory(),session)
+
+            celery.remove_task_session()
+            self.assertIsNot(celery.session_factory(),session)
+        finally:
+            celery.worker_session.remove()
+            celery.worker_session.configure(bind=None)
+            engine.dispose()
+
+class WorkerContextTests(unittest.TestCase):
+
+    def tearDown(self):
+        from .processing.worker_context import init_worker_context
+        init_worker_context({})
+
+    def test_context(self):
+        from .processing.worker_context import init_worker_context, default_ogimet_url
+        from .processing.weather import get_ogimet_url
+        from .processing.stations import get_station_registry
+        from .processing.async_fetch import get_concurrent_fetcher
+
+        context=init_worker_context({'ogimet_url':'http://fake_ogimet'})
+        self.assertEqual(get_ogimet_url(),'http://fake_ogimet')
+        self.assertIs(get_station_registry(),context.stations)
+        self.assertIs(get_concurrent_fetcher().session,context.http_session)
+
+        get_station_registry().add('KDCA',1)
+        http_session=context.http_session
+
+        context.reload({})
+        self.assertEqual(get_ogimet_url(),default_ogimet_url)
+        self.assertIsNot(context.http_session,http_session)
+        self.assertIsNone(get_station_registry().get('KDCA'))
+
+class CoverageTests(BaseTest):
+
+    def setUp(self):
+        super(CoverageTests, self).setUp()
+        self.init_database()
+
+    def test_merge_coverage(self):
+        from .processing.coverage import merge_coverage
+
+        t0=datetime(2021,5,1)
+        h=timedelta(hours=1)
+
+        merged=merge_coverage([
+            (t0,t0+4*h,t0+30*h,True),
+            (t0+4*h,t0+6*h,t0+40*h,True),
+            (t0+5*h,t0+8*h,t0+8*h,False),
+        ])
+
+        # Final coverage wins over the overlapping provisional interval
+        self.assertEqual(merged,[
+            (t0,t0+6*h,t0+40*h,True),
+            (t0+6*h,t0+8*h,t0+8*h,False)
+        ])
+
+    def test_coverage_gaps(self):
+        from .processing.coverage import record_coverage, coverage_gaps
+
+        with transaction.manager:
+            self.session.add(Location(name='KDCA',loctype_id=2))
+        with transaction.manager:
+            station_id=self.session.query(Location.id).filter(Location.name=='KDCA').scalar()
+
+        t0=datetime(2021,5,1)
+        h=timedelta(hours=1)
+        now=t0+24*h
+
+        def gaps(dtstart,dtend,now=now):
+            with transaction.manager:
+                return [(a.replace(tzinfo=None),b.replace(tzinfo=None)) for a,b in
+                        coverage_gaps(self.session,station_id,dtstart,dtend,now)]
+
+        self.assertEqual(gaps(t0,t0+4*h),[(t0,t0+4*h)])
+
+        with transaction.manager:
+            record_coverage(self.session,station_id,t0+h,t0+3*h,now)
+            record_coverage(self.session,station_id,t0+3*h,t0+5*h,now)
+            record_coverage(self.session,station_id,t0+7*h,t0+24*h,now)
+
+        self.assertEqual(gaps(t0,t0+8*h),[(t0,t0+h),(t0+5*h,t0+7*h)])
+
+        # Nothing after now is missing
+        self.assertEqual(gaps(t0+2*h,t0+30*h),[(t0+5*h,t0+7*h)])
+
+        # The last hour before the fetch is provisional and expires
+        self.assertEqual(gaps(t0+20*h,t0+24*h,now+h),[(t0+23*h,t0+24*h)])
+
+        with transaction.manager:
+            from .models.cycling_models import WeatherCoverage
+            self.assertEqual(self.session.query(WeatherCoverage).count(),3)
+
+    def test_overlapping_coverage(self):
+        from sqlalchemy.dialects import mysql
+        from sqlalchemy.orm import Session
+        from zope.sqlalchemy import ZopeTransactionExtension
+        from .processing.coverage import record_coverage, station_lock
+        from .models.cycling_models import WeatherCoverage
+
+        with transaction.manager:
+            self.session.add(Location(name='KDCA',loctype_id=2))
+        with transaction.manager:
+            station_id=self.session.query(Location.id).filter(Location.name=='KDCA').scalar()
+
+        t0=datetime(2021,5,1)
+        h=timedelta(hours=1)
+        now=t0+48*h
+
+        # Writers lock the station's row
+        self.assertIn('FOR UPDATE',str(station_lock(self.session,station_id).statement.compile(
+            dialect=mysql.dialect())))
+
+        # Overlapping and touching windows recorded by different workers
+        sessions=[Session(self.engine,extension=ZopeTransactionExtension())
+                  for i in range(2)]
+        for i,(dtstart,dtend) in enumerate([(t0,t0+3*h),(t0+2*h,t0+5*h),(t0+h,t0+4*h),
+                                            (t0+5*h,t0+6*h),(t0+8*h,t0+9*h)]):
+            with transaction.manager:
+                record_coverage(sessions[i%2],station_id,dtstart,dtend,now)
+
+        with transaction.manager:
+            rows=[(row.dtstart,row.dtend) for row in self.session.query(
+                WeatherCoverage).order_by(WeatherCoverage.dtstart)]
+
+        self.assertEqual(rows,[(t0,t0+6*h),(t0+8*h,t0+9*h)])
+
 class ModelTests(BaseTest):
 
     rideCount=50
@@ -0,0 +1,54 @@
+from pyramid.view import view_config
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.response import Response
+
+def metrics_authorized(request):
+    """
+    Scrapers send the metrics.token setting as a bearer token. Logged in
+    users may view the metrics too.
+    """
+
+    import hmac
+
+    token=request.registry.settings.get('metrics.token')
+    authorization=request.headers.get('Authorization','')
+
+    if token and hmac.compare_digest(authorization,'Bearer '+token):
+        return True
+
+    return bool(request.has_permission('view'))
+
+class metrics_views(object):
+
+    def __init__(self, request):
+        self.request = request
+
+    @view_config(route_name='metrics',permission=NO_PERMISSION_REQUIRED)
+    def metrics(self):
+
+        """
+        Pipeline and view metrics of all processes, in the Prometheus text
+        format
+        """
+
+        from ..metrics import get_metrics, render, queue_depths
+        from ..processing.backlog import backlog_counts
+
+        if not metrics_authorized(self.request):
+            raise HTTPForbidden()
+
+        backlog=backlog_counts(self.request.dbsession)
+
+        metrics=get_metrics()
+
+        # Gauges reported by each process, such as worker pool connections
+        gauges=metrics.collect_gauges()
+
+        gauges.update({
+            'celery_queue_messages':{(('queue',name),):depth for name,depth in queue_depths().items()},
+            'weather_backlog_rides':{(('state',state),):count for state,count in backlog.items()},
+        })
+
+        return Response(render(metrics.collect(),gauges),
+                        content_type='text/plain',charset='utf-8')
@@ -17,3 +17,21 @@ class weather_views(object):
         fill_missing_weather_task=fill_missing_weather.delay()
 
         return {'fill_missing_weather_task_id':fill_missing_weather_task.task_id}
+
+    @view_config(route_name='weather_cache_stats',renderer='json')
+    def weather_cache_stats(self):
+
+        """
+        Hit and miss counts of the station observation cache, totalled over
+        all workers. The cache is disabled without Redis.
+        """
+
+        from ..celery import get_redis
+        from ..processing.observation_cache import shared_stats
+
+        redis=get_redis()
+
+        if redis is None:
+            return {'enabled':False}
+
+        return dict(shared_stats(redis),enabled=True)
@@ -132,5 +132,7 @@ fi
 
 # Update images for running services
 docker-machine ssh $host_prefix-master docker service update --image jhaiduce/cycling-pyramid ${stack_name}_worker
+docker-machine ssh $host_prefix-master docker service update --image jhaiduce/cycling-pyramid ${stack_name}_worker_backfill
+docker-machine ssh $host_prefix-master docker service update --image jhaiduce/cycling-pyramid ${stack_name}_worker_training
 docker-machine ssh $host_prefix-master docker service update --image jhaiduce/cycling-pyramid ${stack_name}_celerybeat
 docker-machine ssh $host_prefix-master docker service update --image jhaiduce/cycling-pyramid ${stack_name}_cycling_web
@@ -1,48 +1,276 @@
-from wsgiref.simple_server import make_server
+"""
+Local stand-in for the OGIMET METAR service, for integration and load
+testing.
+
+Responses are served from an indexed SQLite store. On a miss, the request
+is either forwarded to OGIMET and the response stored (proxy mode), or
+answered with synthetic reports that depend only on the station and time
+(synthetic mode, which needs no network access).
+
+Configuration is read from the environment:
+
+FAKE_OGIMET_MODE            'proxy' (default) or 'synthetic'
+FAKE_OGIMET_CACHE_DIR       Directory of the response store
+FAKE_OGIMET_PORT            Port to listen on (default 80)
+FAKE_OGIMET_THREADS         Number of server threads (default 16)
+FAKE_OGIMET_LATENCY         Mean delay added to each response, in seconds
+FAKE_OGIMET_LATENCY_JITTER  Maximum random deviation from that delay
+FAKE_OGIMET_SORRY_RATE      Fraction of requests answered with the quota
+                            exceeded message
+FAKE_OGIMET_DB_ERROR_RATE   Fraction of requests answered with a database
+                            error
+FAKE_OGIMET_SEED            Seed for latency and error injection
+"""
+
 from pyramid.config import Configurator
 from pyramid.response import Response
+from datetime import datetime, timedelta
 import os
 import json
+import math
+import random
+import sqlite3
+import threading
+import time
 import logging
 log = logging.getLogger(__name__)
 
+sorry_text='#Sorry, Your quota limit for slow queries rate has been reached'
+
+database_error_text="""##########################################################
+# Query made at {now} UTC
+##########################################################
+SELECT command denied to user 'ogimet'@'localhost' for table 'metars'
+"""
+
+def env_float(name,default=0.):
+    return float(os.environ.get(name,default))
+
+def request_key(params):
+    """
+    Canonical form of a query, used as the store key
+    """
+
+    return json.dumps(sorted(params.items()))
+
+def request_interval(params):
+    """
+    Interval covered by a display_metars2.php query
+    """
+
+    dtstart=datetime(int(params['ano']),int(params['mes']),int(params['day']),
+                     int(params['hora']))
+    dtend=datetime(int(params['anof']),int(params['mesf']),int(params['dayf']),
+                   int(params['horaf']),int(params.get('minf',0)))
+
+    return dtstart,dtend
+
+class response_store(object):
+    """
+    OGIMET responses kept in SQLite, indexed by query. Each thread uses its
+    own connection.
+    """
+
+    def __init__(self,cache_dir):
+        self.path=os.path.join(cache_dir,'ogimet-cache.sqlite')
+        self.local=threading.local()
+
+        conn=self.connection()
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('create table if not exists responses ('
+                     'key text primary key, params text, text text, '
+                     'stored real)')
+        conn.commit()
+
+        json_file=os.path.join(cache_dir,'ogimet-cache.json')
+        if os.path.isfile(json_file):
+            self.import_json(json_file)
+
+    def connection(self):
+        conn=getattr(self.local,'conn',None)
+        if conn is None:
+            conn=sqlite3.connect(self.path,timeout=30)
+            self.local.conn=conn
+        return conn
+
+    def import_json(self,json_file):
+        """
+        Load a cache written by the previous version of this server
+        """
+
+        with open(json_file) as fh:
+            stored_cache=json.load(fh)
+
+        conn=self.connection()
+        with conn:
+            for item in stored_cache:
+                conn.execute(
+                    'insert or ignore into responses values (?,?,?,?)',
+                    (request_key(item['params']),json.dumps(item['params']),
+                     item['text'],time.time()))
+
+        # Keep the old file around, but don't import it again
+        os.replace(json_file,json_file+'.imported')
+        log.info('Imported {} cached responses from {}'.format(len(stored_cache),json_file))
+
+    def get(self,params):
+        row=self.connection().execute(
+            'select text from responses where key=?',
+            (request_key(params),)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self,params,text):
+        conn=self.connection()
+        with conn:
+            conn.execute(
+                'insert or replace into responses values (?,?,?,?)',
+                (request_key(params),json.dumps(dict(params)),text,time.time()))
+
+def synthetic_metar(station,time_):
+    """
+    Deterministic METAR for a station and report time.
+
+    Values follow a daily temperature cycle with day-to-day variation, and
+    depend only on the station and the time, so repeated queries return
+    identical reports.
+    """
+
+    day_rng=random.Random('{}{}'.format(station,time_.strftime('%Y%m%d')))
+    rng=random.Random('{}{}'.format(station,time_.strftime('%Y%m%d%H%M')))
+
+    day_of_year=time_.timetuple().tm_yday
+    seasonal=12-14*math.cos(2*math.pi*(day_of_year-15)/365)
+    daily=6*math.cos(2*math.pi*(time_.hour-20)/24)
+    temperature=round(seasonal+daily+day_rng.uniform(-5,5)+rng.uniform(-1,1))
+    dewpoint=temperature-round(day_rng.uniform(1,12))
+
+    winddir=(int(day_rng.uniform(0,36))*10+int(rng.uniform(-3,3))*10)%360 or 360
+    windspeed=max(0,round(day_rng.uniform(2,15)+rng.uniform(-4,4)))
+    gust=windspeed+round(rng.uniform(5,12)) if windspeed>12 else None
+
+    altimeter=round(3000+day_rng.uniform(-60,60)+rng.uniform(-3,3))
+
+    def temp_code(t):
+        return 'M{:02d}'.format(-t) if t<0 else '{:02d}'.format(t)
+
+    wind='00000KT' if windspeed==0 else '{:03d}{:02d}{}KT'.format(
+        winddir,windspeed,'G{:02d}'.format(gust) if gust else '')
+
+    sky=rng.choice(['SKC','FEW050','SCT080','BKN120','OVC015','FEW030 BKN250'])
+
+    return 'METAR {} {}Z {} 10SM {} {}/{} A{:04d} RMK AO2'.format(
+        station,time_.strftime('%d%H%M'),wind,sky,
+        temp_code(temperature),temp_code(dewpoint),altimeter)
+
+def synthetic_response(params):
+    """
+    OGIMET text response with one report an hour, at 51 minutes past
+    """
+
+    station=params['lugar']
+    dtstart,dtend=request_interval(params)
+
+    lines=[
+        '##########################################################',
+        '# Query made at {} UTC'.format(datetime.utcnow().strftime('%m/%d/%Y %H:%M:%S')),
+        '# Time interval: from {} to {} UTC'.format(
+            dtstart.strftime('%m/%d/%Y %H:%M'),dtend.strftime('%m/%d/%Y %H:%M')),
+        '##########################################################',
+        '',
+        '###################################',
+        '#  METAR/SPECI from {}'.format(station),
+        '###################################',
+    ]
+
+    report_time=dtstart.replace(minute=51)
+    if report_time<dtstart:
+        report_time+=timedelta(hours=1)
+
+    while report_time<=dtend:
+        lines.append('{} {}='.format(report_time.strftime('%Y%m%d%H%M'),
+                                     synthetic_metar(station,report_time)))
+        report_time+=timedelta(hours=1)
+
+    return '\n'.join(lines)+'\n'
+
 class ogimet_proxy(object):
 
-    cache_file='/app/ogimet-cache/ogimet-cache.json'
+    def __init__(self,cache_dir='/app/ogimet-cache',mode='proxy',
+                 latency=0,latency_jitter=0,sorry_rate=0,db_error_rate=0,
+                 seed=None):
+        self.store=response_store(cache_dir)
+        self.mode=mode
+        self.latency=latency
+        self.latency_jitter=latency_jitter
+        self.sorry_rate=sorry_rate
+        self.db_error_rate=db_error_rate
+        self.rng=random.Random(seed)
+        self.rng_lock=threading.Lock()
 
-    def __init__(self):
-        self.cache={}
-        if os.path.isfile('ogimet-cache.json'):
-            with open(self.cache_file,'r') as fh:
-                stored_cache=json.load(fh)
+    @classmethod
+    def from_environ(cls):
+        seed=os.environ.get('FAKE_OGIMET_SEED')
+        return cls(
+            cache_dir=os.environ.get('FAKE_OGIMET_CACHE_DIR','/app/ogimet-cache'),
+            mode=os.environ.get('FAKE_OGIMET_MODE','proxy'),
+            latency=env_float('FAKE_OGIMET_LATENCY'),
+            latency_jitter=env_float('FAKE_OGIMET_LATENCY_JITTER'),
+            sorry_rate=env_float('FAKE_OGIMET_SORRY_RATE'),
+            db_error_rate=env_float('FAKE_OGIMET_DB_ERROR_RATE'),
+            seed=int(seed) if seed is not None else None)
 
-                for item in stored_cache:
-                    self.cache[frozenset(item['params'].items())]=item.text
+    def fetch(self,params):
 
-    def write_cache(self):
-        with open(self.cache_file,'w') as fh:
-            stored_cache=[{'params':dict(params),'text':text}
-                          for params,text in self.cache.items()]
-            json.dump(stored_cache,fh,indent=4)
+        text=self.store.get(params)
+
+        if text is not None:
+            return text
+
+        if self.mode=='synthetic':
+            return synthetic_response(params)
 
-    def ogimet_request(self,request):
         import requests
 
-        try:
-            text=self.cache[frozenset(request.params.items())]
-        except KeyError:
-            log.info('Fetching OGIMET data for {}'.format(request.params))
-            text=requests.get('https://ogimet.com/display_metars2.php',params=request.params).text
-            if 'METAR' in text:
-                self.cache[frozenset(request.params.items())]=text
-                self.write_cache()
-        return Response(text)
+        log.info('Fetching OGIMET data for {}'.format(params))
+        text=requests.get('https://ogimet.com/display_metars2.php',params=params).text
+        if 'METAR' in text:
+            self.store.put(params,text)
 
-if __name__ == '__main__':
+        return text
+
+    def ogimet_request(self,request):
+
+        params=dict(request.params)
+
+        with self.rng_lock:
+            delay=self.latency+self.rng.uniform(-1,1)*self.latency_jitter
+            failure=self.rng.random()
+
+        if delay>0:
+            time.sleep(delay)
+
+        if failure<self.sorry_rate:
+            return Response(sorry_text)
+
+        if failure<self.sorry_rate+self.db_error_rate:
+            return Response(database_error_text.format(
+                now=datetime.utcnow().strftime('%m/%d/%Y %H:%M:%S')))
+
+        return Response(self.fetch(params),content_type='text/plain')
+
+def make_app(proxy):
     with Configurator() as config:
         config.add_route('ogimet_request', '/')
-        proxy=ogimet_proxy()
+        config.add_route('ogimet_display_metars', '/display_metars2.php')
         config.add_view(proxy.ogimet_request, route_name='ogimet_request')
-        app = config.make_wsgi_app()
-    server = make_server('0.0.0.0', 80, app)
-    server.serve_forever()
+        config.add_view(proxy.ogimet_request, route_name='ogimet_display_metars')
+        return config.make_wsgi_app()
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    logging.basicConfig(level=logging.INFO)
+
+    app=make_app(ogimet_proxy.from_environ())
+    serve(app,host='0.0.0.0',port=int(os.environ.get('FAKE_OGIMET_PORT',80)),
+          threads=int(os.environ.get('FAKE_OGIMET_THREADS',16)))
@@ -146,6 +146,7 @@ def generate_secrets(
     pyramid_session_secret=binascii.hexlify(
         bytes(write_password(secrets_dir+'/pyramid_session_secret',length=32),'ascii'))
     rabbitmq_password=write_password(secrets_dir+'/cycling_rabbitmq_password')
+    metrics_token=write_password(secrets_dir+'/metrics_token')
 
     ini_text=open(ini_template).read().format(
         mysql_production_password_encoded=quote_plus(db_app_pw).replace('%','%%'),
@@ -157,6 +158,7 @@ def generate_secrets(
         pyramid_auth_secret=pyramid_auth_secret.replace('%','%%'),
         session_secret=pyramid_session_secret.decode('ascii').replace('%','%%'),
         rabbitmq_password_encoded=quote_plus(rabbitmq_password).replace('%','%%'),
+        metrics_token=metrics_token.replace('%','%%'),
     )
     open(os.path.join(secrets_dir,iniout),'w').write(ini_text)
 
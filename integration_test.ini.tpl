@@ -26,10 +26,16 @@ sqlalchemy.echo = true
 worker_sqlalchemy.url = mysql://cycling_worker:{mysql_worker_password_encoded}@ci_db_1:3306/cycling
 worker_sqlalchemy.pool_recycle=3600
 worker_sqlalchemy.pool_pre_ping = true
+worker_sqlalchemy.pool_size = 2
+worker_sqlalchemy.max_overflow = 3
+worker_sqlalchemy.pool_timeout = 30
 worker_sqlalchemy.echo = true
 
 auth.secret={pyramid_auth_secret}
 
+# Bearer token Prometheus sends to /metrics
+metrics.token={metrics_token}
+
 sqlalchemy_admin.url = mysql://root:{mysql_root_password_encoded}@ci_db_1:3306
 mysql_cycling_password={mysql_production_password}
 mysql_worker_password={mysql_worker_password}
@@ -99,11 +99,14 @@ setup(
         ],
         'console_scripts': [
             'initialize_cycling_data_db=cycling_data.scripts.initialize_db:main',
+            'import_metar_archive=cycling_data.scripts.import_metar_archive:main',
             'regression_test=cycling_data.scripts.regression_test:main',
             'import_from_old_db=cycling_data.scripts.import_from_old_db:main',
             'plot_speed_deltas=cycling_data.scripts.plot_speed_deltas:main',
             'plot_odometer_deltas=cycling_data.scripts.plot_odometer_deltas:main',
-            'docker_secrets_to_ini=cycling_data.scripts.docker_secrets_to_ini:main'
+            'docker_secrets_to_ini=cycling_data.scripts.docker_secrets_to_ini:main',
+            'benchmark_weather=cycling_data.scripts.benchmark_weather:main',
+            'recompute_ride_weather=cycling_data.scripts.recompute_ride_weather:main'
         ],
     },
     package_data = {